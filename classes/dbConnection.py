@@ -9,12 +9,36 @@ It also handles the error, info and warning messages
 
 import pg
 import pgdb
+import os
 import platform
 import ConfigParser
 import inspect
 import re
+import numbers
 from datetime import datetime
 from decimal import Decimal
+from cStringIO import StringIO
+
+
+def copy_value(value):
+    """
+    format a value for COPY ... FROM STDIN (text format)
+    """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, numbers.Integral):
+        return str(int(value))
+    elif isinstance(value, numbers.Real):
+        # repr to keep all the digits of the float
+        return repr(float(value))
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
 
 class dbErrInsert(Exception):
@@ -33,6 +57,33 @@ class dbErrDelete(Exception):
     pass
 
 
+# per-process cache of open connections, used by the jobs sent to the nodes (see get_connection)
+_connections = dict()
+
+
+def get_connection(configfile='gnss_data.cfg', use_float=False):
+    """
+    Returns a connection to the database that is reused by all the jobs that run in this process. The connection is
+    opened the first time it is requested and is checked before it is handed out. If it is dead, a new one is opened.
+    The key includes the process id: a connection inherited through a fork is never shared with the parent process.
+    The connection is only reused by the jobs that run in the same process: the batched jobs (JobServer.submit_batch)
+    and the jobs of the local process pool. dispynode runs each non-batched job in a new forked process, so each one of
+    these jobs opens its own connection.
+    :param configfile: config file with the postgres section
+    :param use_float: same as in Cnn
+    :return: a Cnn object
+    """
+    key = (os.getpid(), configfile, use_float)
+
+    cnn = _connections.get(key)
+
+    if cnn is None or not cnn.is_alive():
+        cnn = Cnn(configfile, use_float)
+        _connections[key] = cnn
+
+    return cnn
+
+
 class Cnn(pg.DB):
 
     def __init__(self, configfile, use_float=False):
@@ -82,13 +133,40 @@ class Cnn(pg.DB):
             except Exception as e:
                 raise e
 
-        # open a conenction to a cursor
-        self.cursor_conn = pgdb.connect(host=self.options['hostname'],
-                                        user=self.options['username'],
-                                        password=self.options['password'],
-                                        database=self.options['database'])
+        # the connection used by executemany is opened on demand (see cursor_conn)
+        self._cursor_conn = None
+        self._cursor = None
+
+    @property
+    def cursor_conn(self):
+        # open a connection to a cursor, only when needed
+        if self._cursor_conn is None:
+            self._cursor_conn = pgdb.connect(host=self.options['hostname'],
+                                             user=self.options['username'],
+                                             password=self.options['password'],
+                                             database=self.options['database'])
+        return self._cursor_conn
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self._cursor = self.cursor_conn.cursor()
+        return self._cursor
+
+    def is_alive(self):
+        """
+        check that the connection can still be used, and leave it in a clean state (no transaction open) so that the
+        next job can use it
+        :return: True if the connection is usable
+        """
+        try:
+            if self.active_transaction:
+                self.rollback_transac()
 
-        self.cursor = self.cursor_conn.cursor()
+            self.query('SELECT 1')
+            return True
+        except Exception:
+            return False
 
     def query_float(self, command, as_dict=False):
 
@@ -142,14 +220,51 @@ class Cnn(pg.DB):
 
     def executemany(self, sql, parameters):
 
+        # the transaction lives in cursor_conn, not in this connection
         try:
-            self.begin_transac()
             self.cursor_conn.executemany(sql, parameters)
             self.cursor_conn.commit()
         except pg.Error:
-            self.rollback_transac()
+            self.cursor_conn.rollback()
             raise
 
+    def copy_records(self, table, columns, rows, ignore_duplicates=True):
+        """
+        bulk insert using COPY FROM STDIN. The rows are copied to a temporary staging table and then moved to table
+        in the same transaction
+        :param table: name of the table
+        :param columns: list of column names
+        :param rows: list of tuples with the values in the same order as columns
+        :param ignore_duplicates: skip the rows that already exist in table (INSERT ... ON CONFLICT DO NOTHING).
+        Otherwise, a duplicate row aborts the whole insert
+        :return: nothing. Raises dbErrInsert if the rows could not be inserted
+        """
+        stream = StringIO()
+
+        for row in rows:
+            stream.write('\t'.join([copy_value(value) for value in row]) + '\n')
+
+        if not stream.tell():
+            return
+
+        stream.seek(0)
+
+        fields = ', '.join(['"%s"' % column for column in columns])
+        staging = 'copy_' + table.lower()
+
+        try:
+            # the staging table only has the requested columns (no constraints) and it is dropped on commit
+            self.cursor.execute('CREATE TEMP TABLE %s ON COMMIT DROP AS SELECT %s FROM %s WITH NO DATA'
+                                % (staging, fields, table))
+            self.cursor.copy_from(stream, staging)
+            self.cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s%s'
+                                % (table, fields, fields, staging,
+                                   ' ON CONFLICT DO NOTHING' if ignore_duplicates else ''))
+            self.cursor_conn.commit()
+        except pg.Error as e:
+            self.cursor_conn.rollback()
+            raise dbErrInsert(e)
+
     def update(self, table, row=None, **kw):
 
         try:
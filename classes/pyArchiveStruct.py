@@ -357,6 +357,26 @@ class RinexStruct():
 
         return stninfo,path2stninfo
 
+    def rinex_path_from_record(self, field, with_filename=True):
+        """
+        Build the archive path of a rinex from a record of the rinex table (or rinex_proc) that contains at least the
+        archive level columns and the Filename
+        :param field: dictionary with the rinex record
+        :param with_filename: if set, returns a path including the filename. Otherwise, just returns the path
+        :return: a path with or without filename
+        """
+        keys = []
+        for level in self.levels:
+            keys.append(str(field[level['rinex_col_in']]).zfill(level['TotalChars']))
+
+        if with_filename:
+            # database stores rinex, we want crinez
+            return "/".join(keys) + "/" + \
+                   field['Filename'].replace(field['Filename'].split('.')[-1],
+                                             field['Filename'].split('.')[-1].replace('o', 'd.Z'))
+        else:
+            return "/".join(keys)
+
     def build_rinex_path(self, NetworkCode, StationCode, ObservationYear, ObservationDOY,
                          with_filename=True, filename=None, rinexobj=None):
         """
@@ -402,18 +422,7 @@ class RinexStruct():
                         ObservationYear) + ' AND "ObservationDOY" = ' + str(ObservationDOY))
 
             if rs.ntuples() != 0:
-                field = rs.dictresult()[0]
-                keys = []
-                for level in self.levels:
-                    keys.append(str(field[level['rinex_col_in']]).zfill(level['TotalChars']))
-
-                if with_filename:
-                    # database stores rinex, we want crinez
-                    return "/".join(keys) + "/" + \
-                           field['Filename'].replace(field['Filename'].split('.')[-1],
-                                                     field['Filename'].split('.')[-1].replace('o', 'd.Z'))
-                else:
-                    return "/".join(keys)
+                return self.rinex_path_from_record(rs.dictresult()[0], with_filename)
             else:
                 return None
         else:
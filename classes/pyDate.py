@@ -9,6 +9,7 @@ Class that handles all the date conversions betweem different systems and format
 """
 
 import math
+import numpy as np
 from datetime import datetime
 from json import JSONEncoder
 
@@ -216,6 +217,114 @@ def parse_stninfo(stninfo_datetime):
         return int(sdate[0]), int(sdate[1]), int(sdate[2]), int(sdate[3]), int(sdate[4])
 
 
+# DDG: vectorized versions of the conversions above. These take array-like inputs and return numpy arrays, and produce
+# exactly the same values as the scalar functions (and the Date class). Use them when converting whole time series
+# instead of creating one Date object per epoch.
+
+# first day of each month (zero based) for regular and leap years
+_LDAY = np.array([[0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365],
+                  [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366]])
+
+
+def _year_vec(year):
+    # handle 2 digit years the same way the Date class does
+    year = np.asarray(year).astype(int)
+
+    return np.where(year < 1900, np.where(year > 80, year + 1900, year + 2000), year)
+
+
+def _leap_vec(year):
+    return (year % 4 == 0).astype(int)
+
+
+def yeardoy2fyear_vec(year, doy, hour=12, minute=0, second=0):
+
+    year = _year_vec(year)
+    doy = np.asarray(doy).astype(int)
+
+    diy = 365. + _leap_vec(year)
+
+    if np.any(doy < 1) or np.any(doy > diy):
+        raise pyDateException('invalid day of year')
+
+    return year + ((doy - 1) + np.asarray(hour).astype(int) / 24. + minute / 1440. + second / 86400.) / diy
+
+
+def yeardoy2mjd_vec(year, doy):
+
+    year = _year_vec(year)
+    doy = np.asarray(doy).astype(int)
+
+    if np.any(doy < 1) or np.any(doy > 365 + _leap_vec(year)):
+        raise pyDateException('day of year input is invalid')
+
+    # modified julian date of January 1st (same expression used by date2gpsDate with month = 13 of year - 1)
+    mjd0 = np.floor(365.25 * (year - 1)).astype(int) + int(math.floor(30.6001 * 14.)) + 1 - 679019
+
+    return mjd0 + doy - 1
+
+
+def mjd2date_vec(mjd):
+
+    jd = np.asarray(mjd).astype(float) + 2400000.5
+
+    ijd = np.floor(jd + 0.5)
+
+    a = ijd + 32044.
+    b = np.floor((4. * a + 3.) / 146097.)
+    c = a - np.floor((b * 146097.) / 4.)
+
+    d = np.floor((4. * c + 3.) / 1461.)
+    e = c - np.floor((1461. * d) / 4.)
+    m = np.floor((5. * e + 2.) / 153.)
+
+    day   = e - np.floor((153. * m + 2.) / 5.) + 1.
+    month = m + 3. - 12. * np.floor(m / 10.)
+    year  = b * 100. + d - 4800. + np.floor(m / 10.)
+
+    return year.astype(int), month.astype(int), day.astype(int)
+
+
+def mjd2yeardoy_vec(mjd):
+
+    year, month, day = mjd2date_vec(mjd)
+
+    doy = _LDAY[_leap_vec(year), month - 1] + day
+
+    return year, doy
+
+
+def mjd2fyear_vec(mjd, hour=12, minute=0, second=0):
+
+    year, doy = mjd2yeardoy_vec(mjd)
+
+    return yeardoy2fyear_vec(year, doy, hour, minute, second)
+
+
+def fyear2yeardoy_vec(fyear):
+
+    fyear = np.asarray(fyear).astype(float)
+
+    year = np.floor(fyear)
+    days = 365. + _leap_vec(year.astype(int))
+
+    doy = np.floor(days * (fyear - year)) + 1
+
+    return year.astype(int), doy.astype(int)
+
+
+def gpsDate2mjd_vec(gpsWeek, gpsWeekDay):
+
+    return np.asarray(gpsWeek).astype(int) * 7 + 44244 + np.asarray(gpsWeekDay).astype(int)
+
+
+def mjd2gpsDate_vec(mjd):
+
+    mjd = np.asarray(mjd).astype(int)
+
+    return (mjd - 44244) // 7, (mjd - 44244) % 7
+
+
 class Date(object):
 
     def __init__(self, **kwargs):
@@ -493,3 +602,57 @@ class Date(object):
             _, fyear = date2doy(self.year, self.month, self.day, 23, 59, 59)
             return fyear
 
+
+
+class DateArray(object):
+    """
+    Vectorized counterpart of the Date class: holds the same attributes (year, doy, month, day, fyear, mjd, gpsWeek and
+    gpsWeekDay) as numpy arrays. Accepts year + doy, mjd, fyear or gpsweek + gpsweekday as input. The time of day is
+    always 12:00:00 (the Date default), which is what the time series code uses.
+    """
+
+    def __init__(self, **kwargs):
+
+        kwargs = dict((key.lower(), arg) for key, arg in kwargs.items())
+
+        if 'year' in kwargs and 'doy' in kwargs:
+            self.year = _year_vec(kwargs['year'])
+            self.doy = np.asarray(kwargs['doy']).astype(int)
+            self.mjd = yeardoy2mjd_vec(self.year, self.doy)
+
+        elif 'gpsweek' in kwargs and 'gpsweekday' in kwargs:
+            self.mjd = gpsDate2mjd_vec(kwargs['gpsweek'], kwargs['gpsweekday'])
+            self.year, self.doy = mjd2yeardoy_vec(self.mjd)
+
+        elif 'mjd' in kwargs:
+            self.mjd = np.asarray(kwargs['mjd']).astype(int)
+            self.year, self.doy = mjd2yeardoy_vec(self.mjd)
+
+        elif len(set(kwargs.keys()) & {'fyear', 'fractionalyear', 'fracyear'}):
+            fyear = [kwargs[key] for key in ('fyear', 'fractionalyear', 'fracyear') if key in kwargs][0]
+            self.year, self.doy = fyear2yeardoy_vec(fyear)
+            self.mjd = yeardoy2mjd_vec(self.year, self.doy)
+
+        else:
+            raise pyDateException('not enough independent input args to compute full date')
+
+        self.fyear = yeardoy2fyear_vec(self.year, self.doy)
+        _, self.month, self.day = mjd2date_vec(self.mjd)
+        self.gpsWeek, self.gpsWeekDay = mjd2gpsDate_vec(self.mjd)
+
+    def __len__(self):
+        return self.mjd.size
+
+    def __getitem__(self, item):
+        return Date(mjd=int(self.mjd[item]))
+
+    def __iter__(self):
+        for mjd in self.mjd:
+            yield Date(mjd=int(mjd))
+
+    def __repr__(self):
+        return 'pyDate.DateArray(' + str(len(self)) + ' dates)'
+
+    def dates(self):
+        # list of Date objects, for code that still needs them
+        return [Date(year=int(year), doy=int(doy)) for year, doy in zip(self.year, self.doy)]
@@ -20,6 +20,7 @@ from Utils import rotlg2ct
 from os.path import getmtime
 from itertools import repeat
 from pyBunch import Bunch
+from collections import OrderedDict
 from pprint import pprint
 import traceback
 import warnings
@@ -107,6 +108,8 @@ CO_SEISMIC_DECAY = 1
 CO_SEISMIC_JUMP_DECAY = 2
 
 EQ_MIN_DAYS = 15
+# safety factor applied to the maximum distance of influence of an earthquake when selecting the events from the db
+EQ_RADIUS_MARGIN = 1.1
 JP_MIN_DAYS = 5
 
 DEFAULT_RELAXATION = np.array([0.5])
@@ -121,6 +124,9 @@ DATABASE = 1
 
 VERSION = '1.1.0'
 
+# number of fitted ETMs kept in memory by EtmCache
+ETM_CACHE_SIZE = 500
+
 
 class pyETMException(Exception):
 
@@ -238,7 +244,8 @@ class PppSoln(object):
 
             self.solutions = len(self.table)
 
-            self.ts_blu = np.array([pyDate.Date(year=item[3], doy=item[4]).fyear for item in self.blunders])
+            self.ts_blu = pyDate.yeardoy2fyear_vec([item[3] for item in self.blunders],
+                                                   [item[4] for item in self.blunders])
 
             if self.solutions >= 1:
                 a = np.array(self.table)
@@ -246,13 +253,13 @@ class PppSoln(object):
                 self.x = a[:, 0]
                 self.y = a[:, 1]
                 self.z = a[:, 2]
-                self.t = np.array([pyDate.Date(year=item[0], doy=item[1]).fyear for item in a[:, 3:5]])
-                self.mjd = np.array([pyDate.Date(year=item[0], doy=item[1]).mjd for item in a[:, 3:5]])
+                self.t = pyDate.yeardoy2fyear_vec(a[:, 3], a[:, 4])
+                self.mjd = pyDate.yeardoy2mjd_vec(a[:, 3], a[:, 4])
 
                 # continuous time vector for plots
                 ts = np.arange(np.min(self.mjd), np.max(self.mjd) + 1, 1)
                 self.mjds = ts
-                self.ts = np.array([pyDate.Date(mjd=tts).fyear for tts in ts])
+                self.ts = pyDate.mjd2fyear_vec(ts)
             else:
                 if len(self.blunders) >= 1:
                     raise pyETMException('No viable PPP solutions available for %s.%s (all blunders!)\n'
@@ -344,15 +351,15 @@ class GamitSoln(object):
                     self.x = a[nb, 0]
                     self.y = a[nb, 1]
                     self.z = a[nb, 2]
-                    self.t = np.array([pyDate.Date(year=item[0], doy=item[1]).fyear for item in a[nb, 3:5]])
-                    self.mjd = np.array([pyDate.Date(year=item[0], doy=item[1]).mjd for item in a[nb, 3:5]])
+                    self.t = pyDate.yeardoy2fyear_vec(a[nb, 3], a[nb, 4])
+                    self.mjd = pyDate.yeardoy2mjd_vec(a[nb, 3], a[nb, 4])
 
-                    self.date = [pyDate.Date(year=item[0], doy=item[1]) for item in a[nb, 3:5]]
+                    self.date = pyDate.DateArray(year=a[nb, 3], doy=a[nb, 4])
 
                     # continuous time vector for plots
                     ts = np.arange(np.min(self.mjd), np.max(self.mjd) + 1, 1)
                     self.mjds = ts
-                    self.ts = np.array([pyDate.Date(mjd=tts).fyear for tts in ts])
+                    self.ts = pyDate.mjd2fyear_vec(ts)
                 else:
                     dd = np.sqrt(np.square(np.sum(
                         np.square(a[:, 0:3] - np.array([stn['auto_x'], stn['auto_y'], stn['auto_z']])), axis=1)))
@@ -821,9 +828,13 @@ class Earthquakes:
         sdate = pyDate.Date(fyear=t.min() - 5)
         edate = pyDate.Date(fyear=t.max())
 
-        # get the earthquakes based on Mike's expression
-        jumps = cnn.query('SELECT * FROM earthquakes WHERE date BETWEEN \'%s\' AND \'%s\' ORDER BY date'
-                          % (sdate.yyyymmdd(), edate.yyyymmdd()))
+        # get the earthquakes based on Mike's expression. The score (m, below) is positive only for distances shorter
+        # than 10 ** (2.25 + 0.4901 / 0.8717 * (mag - 6.6928)) km and the latitude difference is a lower bound of the
+        # distance to the station: only load the events that can be within that distance
+        jumps = cnn.query('SELECT * FROM earthquakes WHERE date BETWEEN \'%s\' AND \'%s\' AND '
+                          'abs(lat - %.8f) * %.8f <= %.3f * power(10, %.8f + %.8f * mag) ORDER BY date'
+                          % (sdate.yyyymmdd(), edate.yyyymmdd(), lat, pi / 180 * 6371, EQ_RADIUS_MARGIN,
+                             2.25 - 0.4901 / 0.8717 * 6.6928, 0.4901 / 0.8717))
         jumps = jumps.dictresult()
 
         # check if data range returned any jumps
@@ -844,13 +855,23 @@ class Earthquakes:
                                                             hour=int(eqs[6]), minute=int(eqs[7]), second=int(eqs[8])))
                                 for eqs in eq[m > 0, :]))
 
+            # sorted by day and magnitude (dates are equal if they are on the same day)
             eq_jumps.sort(key=lambda x: (x[1], -x[0]))
 
+            # days and times of the events to find the events in each window
+            mjd = np.array([d.mjd for _, d in eq_jumps])
+            fyear = np.array([d.fyear for _, d in eq_jumps])
+
             # open the jumps table
             jp = cnn.query_float('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
                                  'AND soln = \'%s\' AND jump_type <> 0 AND object = \'jump\''
                                  % (NetworkCode, StationCode, soln.type), as_dict=True)
 
+            # the etm_params of each day
+            params = dict()
+            for j in jp:
+                params.setdefault((j['Year'], j['DOY']), []).append(j)
+
             # start by collapsing all earthquakes for the same day.
             # Do not allow more than one earthquake on the same day
             f_jumps = []
@@ -865,7 +886,12 @@ class Earthquakes:
                         continue
 
                 # obtain jumps in a EQ_MIN_DAYS window
-                jumps = [(m, d) for m, d in eq_jumps if date <= d < date + EQ_MIN_DAYS]
+                end_date = date + EQ_MIN_DAYS
+                lo = np.searchsorted(mjd, date.mjd, 'left')
+                hi = np.searchsorted(mjd, end_date.mjd, 'right')
+
+                jumps = [eq_jumps[k] for k in np.arange(lo, hi)[np.logical_and(fyear[lo:hi] >= date.fyear,
+                                                                               fyear[lo:hi] < end_date.fyear)]]
 
                 if len(jumps) > 1:
                     # if more than one jump, get the max magnitude
@@ -874,10 +900,10 @@ class Earthquakes:
                     # only keep the earthquake with the largest magnitude
                     for m, d in jumps:
 
-                        table = [j['action'] for j in jp if j['Year'] == d.year and j['DOY'] == d.doy]
+                        table = [j['action'] for j in params.get((d.year, d.doy), [])]
 
                         # get a different relaxation for this date
-                        relax = [j['relaxation'] for j in jp if j['Year'] == d.year and j['DOY'] == d.doy]
+                        relax = [j['relaxation'] for j in params.get((d.year, d.doy), [])]
 
                         if relax:
                             if relax[0] is not None:
@@ -905,9 +931,9 @@ class Earthquakes:
                                                        relaxation, 'mag=%.1f' % m, NO_EFFECT)]
                 else:
                     # add, unless marked in table with '-'
-                    table = [j['action'] for j in jp if j['Year'] == date.year and j['DOY'] == date.doy]
+                    table = [j['action'] for j in params.get((date.year, date.doy), [])]
                     # get a different relaxation for this date
-                    relax = [j['relaxation'] for j in jp if j['Year'] == date.year and j['DOY'] == date.doy]
+                    relax = [j['relaxation'] for j in params.get((date.year, date.doy), [])]
 
                     if relax:
                         if relax[0] is not None:
@@ -1352,6 +1378,161 @@ class Design(np.ndarray):
             return v
 
 
+def normal(A, P):
+    """
+    normal matrices of the design A with each row of weights P
+    :return: k x m x m array (k = rows of P)
+    """
+    return np.array([np.dot(A.T * w, A) for w in P])
+
+
+def solve_normal(normals, rhs=None):
+    """
+    solve (or invert if rhs is None) a list of stacks of normal equations. The stacks with the same number of
+    parameters are solved with a single call to numpy.linalg
+    :param normals: list of k x m x m arrays (m can be different for each element of the list)
+    :param rhs: list of k x m arrays or None
+    :return: list with the k x m solutions (or k x m x m inverses) of each element of normals
+    """
+    result = [None] * len(normals)
+
+    sizes = dict()
+    for i, N in enumerate(normals):
+        sizes.setdefault(N.shape[1], []).append(i)
+
+    for index in sizes.values():
+        N = np.concatenate([normals[i] for i in index])
+
+        try:
+            if rhs is None:
+                X = np.linalg.inv(N)
+            else:
+                u = np.concatenate([rhs[i] for i in index])
+                X = np.linalg.solve(N, u[:, :, None])[:, :, 0]
+
+        except np.linalg.LinAlgError:
+            if rhs is None:
+                # let the singular system raise the error
+                X = np.array([np.linalg.inv(n) for n in N])
+            else:
+                # at least one singular system in the stack: solve one by one
+                X = np.array([np.linalg.lstsq(n, b, rcond=-1)[0] for n, b in zip(N, u)])
+
+        k = 0
+        for i in index:
+            result[i] = X[k:k + normals[i].shape[0]]
+            k += normals[i].shape[0]
+
+    return result
+
+
+def robust_weights(v, factor):
+    """
+    normalized residuals and weights of the observations (Mike's method of equal weight until LIMIT sigma)
+    :param v: 3 x n residuals
+    :param factor: variance factor of each component
+    :return: 3 x n normalized residuals, 3 x n weights
+    """
+    eps = np.finfo(np.float).eps
+
+    s = np.abs(np.divide(v, factor[:, None]))
+
+    f = np.ones(v.shape)
+    sw = np.power(10, LIMIT - s[s > LIMIT])
+    sw[sw < eps] = eps
+    f[s > LIMIT] = sw
+
+    return s, np.square(np.divide(f, factor[:, None]))
+
+
+def adjust_lsq_batch(designs, observations):
+    """
+    robust least squares of the N, E and U components of many stations (same reweighting and chi**2 test of
+    ETM.adjust_lsq). The three components of a station share the design matrix but keep their own weights, variance
+    factor and outliers. Each iteration solves the normal equations of all the components that did not pass the chi**2
+    test, stacking the stations with the same number of parameters
+    :param designs: list of Design objects
+    :param observations: list of 3 x n arrays with the NEU observations of each station
+    :return: list with (C, sigma, index, v, factor, P) for each station, each element with one row per component
+    """
+    eps = np.finfo(np.float).eps
+
+    problems = []
+    for Ai, Li in zip(designs, observations):
+
+        dof = (Ai.shape[0] - Ai.shape[1])
+        A = Ai(constrains=True)
+        L = np.array([Ai.get_l(l, constrains=True) for l in Li])
+
+        problems.append(Bunch(Ai=Ai, A=A, L=L, dof=dof,
+                              X1=chi2.ppf(1 - 0.05 / 2, dof), X2=chi2.ppf(0.05 / 2, dof),
+                              P=np.tile(Ai.get_p(constrains=True), (3, 1)),
+                              C=np.zeros((3, A.shape[1])), v=np.zeros(L.shape), s=np.zeros(L.shape),
+                              So=np.ones(3), factor=np.ones(3), active=np.ones(3, dtype=bool)))
+
+    iteration = 0
+
+    while iteration <= 10:
+
+        pending = [pb for pb in problems if pb.active.any()]
+
+        if not pending:
+            break
+
+        C = solve_normal([normal(pb.A, pb.P) for pb in pending],
+                         [np.dot(pb.P * pb.L, pb.A) for pb in pending])
+
+        for pb, c in zip(pending, C):
+
+            v = pb.L - np.dot(c, pb.A.T)
+
+            # unit variance
+            So = np.sqrt(np.sum(v * pb.P * v, axis=1) / pb.dof)
+
+            x = np.power(So, 2) * pb.dof
+
+            # obtain the overall uncertainty predicted by lsq
+            factor = pb.factor * So
+
+            # calculate the normalized sigmas
+            s = np.abs(np.divide(v, factor[:, None]))
+
+            # only the components that did not pass the test in a previous iteration are updated
+            a = pb.active
+            pb.C[a] = c[a]
+            pb.v[a] = v[a]
+            pb.s[a] = s[a]
+            pb.So[a] = So[a]
+            pb.factor[a] = factor[a]
+
+            # components that did not pass the Chi2 test: reweigh by Mike's method of equal weight until 2 sigma
+            pb.active = a & ((x < pb.X2) | (x > pb.X1))
+
+            _, P = robust_weights(v, factor)
+            pb.P[pb.active] = P[pb.active]
+
+        iteration += 1
+
+    for pb in problems:
+        # make sure there are no values below eps. Otherwise matrix becomes singular
+        pb.P[pb.P < eps] = 1e-6
+
+    # some statistics
+    SS = solve_normal([normal(pb.A, pb.P) for pb in problems])
+
+    results = []
+    for pb, ss in zip(problems, SS):
+
+        sigma = pb.So[:, None] * np.sqrt(np.diagonal(ss, axis1=1, axis2=2))
+
+        # mark observations with sigma <= LIMIT (remove the constrains)
+        n = pb.Ai.shape[0]
+
+        results.append((pb.C, sigma, pb.s[:, :n] <= LIMIT, pb.v[:, :n], pb.factor, pb.P))
+
+    return results
+
+
 class ETM:
 
     def __init__(self, cnn, soln, no_model=False, FitEarthquakes=True, FitGenericJumps=True, FitPeriodic=True):
@@ -1401,20 +1582,17 @@ class ETM:
 
     def run_adjustment(self, cnn, l, plotit=False):
 
-        c = []
-        f = []
-        s = []
-        r = []
-        p = []
-        factor = []
-
         if self.A is not None:
             # try to load the last ETM solution from the database
 
-            etm_objects = cnn.query_float('SELECT * FROM etms WHERE "NetworkCode" = \'%s\' '
-                                          'AND "StationCode" = \'%s\' AND soln = \'%s\' AND stack = \'%s\''
-                                          % (self.NetworkCode, self.StationCode, self.soln.type,
-                                             self.soln.stack_name), as_dict=True)
+            # use the records loaded by EtmCache.prefetch (if any)
+            etm_objects = get_cache().parameters(self.NetworkCode, self.StationCode, self.soln.type,
+                                                 self.soln.stack_name)
+            if etm_objects is None:
+                etm_objects = cnn.query_float('SELECT * FROM etms WHERE "NetworkCode" = \'%s\' '
+                                              'AND "StationCode" = \'%s\' AND soln = \'%s\' AND stack = \'%s\''
+                                              % (self.NetworkCode, self.StationCode, self.soln.type,
+                                                 self.soln.stack_name), as_dict=True)
 
             db_hash_sum = sum([obj['hash'] for obj in etm_objects])
             ob_hash_sum = sum([o.p.hash for o in self.Jumps.table + [self.Periodic] + [self.Linear]]) + self.hash
@@ -1442,23 +1620,10 @@ class ETM:
                 # use the default parameters from the objects
                 t_ref = self.Linear.p.t_ref
 
-                for i in range(3):
-
-                    x, sigma, index, residuals, fact, w = self.adjust_lsq(self.A, l[i])
-
-                    c.append(x)
-                    s.append(sigma)
-                    f.append(index)
-                    r.append(residuals)
-                    factor.append(fact)
-                    p.append(w)
-
-                self.C = np.array(c)
-                self.S = np.array(s)
-                self.F = np.array(f)
-                self.R = np.array(r)
-                self.factor = np.array(factor)
-                self.P = np.array(p)
+                # add the new epochs to the last fit if the jump table did not change. Otherwise (or if the updated
+                # fit does not pass the chi**2 test) adjust the three components together from scratch
+                if not self.adjust_incremental(etm_objects, l):
+                    self.C, self.S, self.F, self.R, self.factor, self.P = adjust_lsq_batch([self.A], [l])[0]
 
                 # load_parameters to the objects
                 self.Linear.load_parameters(self.C, self.S, t_ref)
@@ -1471,6 +1636,129 @@ class ETM:
             if plotit:
                 self.plot()
 
+    def structure(self):
+        """
+        hashes of the functions of the design matrix (in column order) and reference epoch of the polynomial
+        """
+        return [o.p.hash for o in [self.Linear] + self.Jumps.table + [self.Periodic]], self.Linear.p.t_ref
+
+    def fit_normals(self):
+        """
+        normal equations, weights and parameters of the current fit, used by adjust_incremental to add new epochs. They
+        are computed when needed (not kept after each fit): the observations are recovered from the residuals
+        :return: Bunch with the normal equations or None if there is no fit
+        """
+        if self.A is None or not self.P.size:
+            return None
+
+        A = self.A(constrains=True)
+
+        if self.P.shape[1] != A.shape[0]:
+            return None
+
+        l = self.R + np.dot(self.C, self.A.T)
+        L = np.array([self.A.get_l(li, constrains=True) for li in l])
+
+        if self.param_origin == DATABASE:
+            # load_parameters computes the weights with the stored variance factors
+            scale = self.factor
+        else:
+            # the weights of the last iteration were computed with factor / So
+            v = L - np.dot(self.C, A.T)
+            So = np.sqrt(np.sum(v * self.P * v, axis=1) / (self.A.shape[0] - self.A.shape[1]))
+            scale = self.factor / So
+
+        return Bunch(structure=self.structure(), mjd=self.soln.mjd, l=l, P=self.P, C=self.C, scale=scale,
+                     N=normal(A, self.P), u=np.dot(self.P * L, A))
+
+    def adjust_incremental(self, etm_objects, l):
+        """
+        update the last fit of the station with the new epochs instead of redoing the robust fit. If this process fitted
+        the station before (ETM replaced in the EtmCache), the new epochs are added as a rank update to the normal
+        equations and outlier weights of that fit. Otherwise (e.g. the daily runs, each in a new process) the normal
+        equations are rebuilt once from the etms records: weights from the residuals of the stored parameters and
+        variance factors. Only possible if the jump table, the periodic terms and the polynomial did not change
+        :param etm_objects: etms records of the station
+        :param l: 3 x n NEU observations
+        :return: True if the updated fit passed the chi**2 test, False if a full robust fit is needed
+        """
+        eps = np.finfo(np.float).eps
+
+        A = self.A(constrains=True)
+        L = np.array([self.A.get_l(li, constrains=True) for li in l])
+        n = self.A.shape[0]
+
+        structure = self.structure()
+
+        last = get_cache().last_fit(self.NetworkCode, self.StationCode, self.soln.type, self.soln.stack_name)
+
+        if last is not None:
+            last = last.fit_normals()
+
+        if last is not None and last.structure == structure and last.P.shape[1] - last.mjd.size == A.shape[0] - n:
+            # epochs of the last fit (must be unchanged)
+            old = np.in1d(self.soln.mjd, last.mjd)
+
+            if np.sum(old) != last.mjd.size or not np.allclose(l[:, old], last.l, rtol=0, atol=1e-6):
+                return False
+
+            new = np.flatnonzero(~old)
+
+            # keep the weights of the last fit (and constrains) and weigh the new epochs with the last parameters
+            P = np.ones(L.shape)
+            P[:, np.flatnonzero(old)] = last.P[:, :last.mjd.size]
+            P[:, n:] = last.P[:, last.mjd.size:]
+
+            An = np.asarray(self.A)[new]
+            _, P[:, new] = robust_weights(l[:, new] - np.dot(last.C, An.T), last.scale)
+
+            # rank update of the normal equations
+            N = last.N + normal(An, P[:, new])
+            u = last.u + np.dot(P[:, new] * l[:, new], An)
+            scale = last.scale
+
+        else:
+            params = [obj for obj in etm_objects if obj['object'] != 'var_factor']
+            t_ref = [obj['t_ref'] for obj in params if obj['object'] == 'polynomial']
+
+            if sorted([obj['hash'] for obj in params]) != sorted(structure[0]) or len(t_ref) != 1 \
+                    or abs(t_ref[0] - structure[1]) > 1e-6:
+                return False
+
+            # the weights from the stored parameters and variance factors
+            self.load_parameters(etm_objects, l)
+            _, P = robust_weights(L - np.dot(self.C, A.T), self.factor)
+
+            N = normal(A, P)
+            u = np.dot(P * L, A)
+            scale = self.factor
+
+        C = solve_normal([N], [u])[0]
+
+        v = L - np.dot(C, A.T)
+
+        dof = n - A.shape[1]
+        So = np.sqrt(np.sum(v * P * v, axis=1) / dof)
+        x = np.power(So, 2) * dof
+
+        if np.any((x < chi2.ppf(0.05 / 2, dof)) | (x > chi2.ppf(1 - 0.05 / 2, dof))):
+            return False
+
+        factor = scale * So
+        s = np.abs(np.divide(v, factor[:, None]))
+
+        # make sure there are no values below eps. Otherwise matrix becomes singular
+        if np.any(P < eps):
+            P[P < eps] = 1e-6
+            N = normal(A, P)
+            u = np.dot(P * L, A)
+
+        sigma = So[:, None] * np.sqrt(np.diagonal(solve_normal([N])[0], axis1=1, axis2=2))
+
+        self.C, self.S, self.F, self.R, self.factor, self.P = C, sigma, s[:, :n] <= LIMIT, v[:, :n], factor, P
+
+        return True
+
     def process_covariance(self):
 
         cov = np.zeros((3, 1))
@@ -1513,21 +1801,24 @@ class ETM:
     def save_parameters(self, cnn):
         # only save the parameters when they've been estimated, not when loaded from database
         if self.param_origin == ESTIMATION:
-            # insert linear parameters
-            cnn.insert('etms', row=to_postgres(self.Linear.p.toDict()))
+            # linear parameters, jumps, periodic params and the variance factors
+            params = [to_postgres(self.Linear.p.toDict())] + \
+                     [to_postgres(jump.p.toDict()) for jump in self.Jumps.table] + \
+                     [to_postgres(self.Periodic.p.toDict())] + \
+                     [{'NetworkCode': self.NetworkCode, 'StationCode': self.StationCode, 'soln': self.soln.type,
+                       'object': 'var_factor', 'params': to_postgres(self.factor), 'hash': self.hash,
+                       'stack': self.soln.stack_name}]
 
-            # insert jumps
-            for jump in self.Jumps.table:
-                cnn.insert('etms', row=to_postgres(jump.p.toDict()))
+            columns = cnn.get_columns('etms')
 
-            # insert periodic params
-            cnn.insert('etms', row=to_postgres(self.Periodic.p.toDict()))
+            # each type of object has a different set of fields: copy each set separately
+            records = dict()
+            for param in params:
+                fields = tuple(sorted([field for field in param.keys() if field in columns]))
+                records.setdefault(fields, []).append(tuple([param[field] for field in fields]))
 
-            # save the variance factors
-            cnn.query('INSERT INTO etms ("NetworkCode", "StationCode", soln, object, params, hash, stack) VALUES '
-                      '(\'%s\', \'%s\', \'%s\', \'var_factor\', \'%s\', %i, \'%s\')'
-                      % (self.NetworkCode, self.StationCode, self.soln.type, to_postgres(self.factor),
-                         self.hash, self.soln.stack_name))
+            for fields, rows in records.iteritems():
+                cnn.copy_records('etms', fields, rows, ignore_duplicates=False)
 
     def plot(self, pngfile=None, t_win=None, residuals=False, plot_missing=True, ecef=False, plot_outliers=True):
 
@@ -1982,84 +2273,95 @@ class ETM:
         # jmp = 'post' returns the coordinate immediately after a jump
         # jmp = None returns either the coordinate before or after, depending on the time of the jump.
 
-        # find this epoch in the t vector
-        date = pyDate.Date(year=year, doy=doy)
-        window = None
+        xyz, sig, window, source = self.get_xyz_s_vec([year], [doy], jmp, sigma_h, sigma_v, force_model)
+
+        return xyz, sig, window[0], source[0]
+
+    def get_xyz_s_vec(self, year, doy, jmp=None, sigma_h=SIGMA_FLOOR_H, sigma_v=SIGMA_FLOOR_V, force_model=False):
+        """
+        same as get_xyz_s for many epochs at once
+        :param year: list or array of years
+        :param doy: list or array of days of year
+        :return: X Y Z (3 x n), sigmas (3 x n), list of jump windows (pyDate.Date or None) and list of sources
+        """
+        year = np.array(year, dtype=int)
+        doy = np.array(doy, dtype=int)
+
+        mjd = pyDate.yeardoy2mjd_vec(year, doy)
+        fyear = pyDate.yeardoy2fyear_vec(year, doy)
+
+        window = [None] * mjd.size
 
         for jump in self.Jumps.table:
-            if jump.date == date and jump.p.jump_type in (GENERIC_JUMP, CO_SEISMIC_JUMP_DECAY):
+            match = np.flatnonzero(mjd == jump.date.mjd)
+
+            if match.size and jump.p.jump_type in (GENERIC_JUMP, CO_SEISMIC_JUMP_DECAY):
                 if np.sqrt(np.sum(np.square(jump.p.params[:, 0]))) > 0.02:
-                    window = jump.date
-                    # if no pre or post specified, then determine using the time of the jump
-                    if jmp is None:
-                        if (jump.date.datetime().hour + jump.date.datetime().minute / 60.0) < 12:
-                            jmp = 'post'
-                        else:
-                            jmp = 'pre'
-                    # use the previous or next date to get the APR
-                    # if jmp == 'pre':
-                    #    date -= 1
-                    # else:
-                    #    date += 1
+                    for i in match:
+                        window[i] = jump.date
 
-        index = np.where(self.soln.mjd == date.mjd)
-        index = index[0]
+        # find the epochs in the (sorted) mjd vector
+        order = np.argsort(self.soln.mjd, kind='mergesort')
+        smjd = self.soln.mjd[order]
 
-        neu = np.zeros((3, 1))
+        pos = np.minimum(np.searchsorted(smjd, mjd), smjd.size - 1)
+        found = smjd[pos] == mjd
+        index = order[pos]
 
         L = self.L
         ref_pos = np.array([self.soln.auto_x, self.soln.auto_y, self.soln.auto_z])
 
-        if index.size and self.A is not None:
-            # found a valid epoch in the t vector
-            # now see if this epoch was filtered
-            if np.all(self.F[:, index]) and force_model is False:
-                # the coordinate is good
-                xyz = L[:, index]
-                sig = self.R[:, index]
-                source = self.soln.stack_name.upper() + ' with ETM solution: good'
+        xyz = np.zeros((3, mjd.size))
+        sig = np.zeros((3, mjd.size))
+        source = np.empty(mjd.size, dtype=object)
+        stack = self.soln.stack_name.upper()
 
+        if self.A is not None:
+            # epochs in the ETM: closest epoch of the continuous time vector
+            ts = self.soln.ts
+            if ts.size > 1:
+                k = np.clip(np.searchsorted(ts, fyear), 1, ts.size - 1)
+                idt = np.where(np.abs(ts[k - 1] - fyear) <= np.abs(ts[k] - fyear), k - 1, k)
             else:
-                # the coordinate is marked as bad
-                # get the requested epoch from the ETM
-                idt = np.argmin(np.abs(self.soln.ts - date.fyear))
+                idt = np.zeros(mjd.size, dtype=int)
 
-                for i in range(3):
-                    neu[i] = np.dot(self.As[idt, :], self.C[i])
+            neu = np.dot(self.C, self.As[idt, :].transpose())
+            model = self.rotate_2xyz(neu) + ref_pos
 
-                xyz = self.rotate_2xyz(neu) + ref_pos
-                # Use the deviation from the ETM multiplied by 2.5 to estimate the error
-                sig = 2.5 * self.R[:, index]
-                source = self.soln.stack_name.upper() + ' with ETM solution: filtered'
+            # solutions that passed the ETM filter
+            good = found & np.all(self.F[:, index], axis=0) & (force_model is False)
+            # solutions marked as bad (or the model was requested)
+            filtered = found & ~good
 
-        elif not index.size and self.A is not None:
+            xyz[:, good] = L[:, index[good]]
+            sig[:, good] = self.R[:, index[good]]
+            source[good] = stack + ' with ETM solution: good'
 
-            # the coordinate doesn't exist, get it from the ETM
-            idt = np.argmin(np.abs(self.soln.ts - date.fyear))
-            source = 'No ' + self.soln.stack_name.upper() + ' solution: ETM'
+            # get the requested epoch from the ETM and use the deviation from the ETM multiplied by 2.5 to estimate
+            # the error
+            xyz[:, filtered] = model[:, filtered]
+            sig[:, filtered] = 2.5 * self.R[:, index[filtered]]
+            source[filtered] = stack + ' with ETM solution: filtered'
 
-            for i in range(3):
-                neu[i] = np.dot(self.As[idt, :], self.C[i])
-
-            xyz = self.rotate_2xyz(neu) + ref_pos
-            # since there is no way to estimate the error,
+            # the coordinate doesn't exist, get it from the ETM. Since there is no way to estimate the error,
             # use the nominal sigma multiplied by 2.5
-            sig = 2.5 * self.factor[:, np.newaxis]
-
-        elif index.size and self.A is None:
+            xyz[:, ~found] = model[:, ~found]
+            sig[:, ~found] = 2.5 * self.factor[:, np.newaxis]
+            source[~found] = 'No ' + stack + ' solution: ETM'
 
+        else:
             # no ETM (too few points), but we have a solution for the requested day
-            xyz = L[:, index]
-            # set the uncertainties in NEU by hand
-            sig = np.array([[9.99], [9.99], [9.99]])
-            source = self.soln.stack_name.upper() + ' solution, no ETM'
+            xyz[:, found] = L[:, index[found]]
+            source[found] = stack + ' solution, no ETM'
 
-        else:
             # no ETM (too few points) and no solution for this day, get average
-            source = 'No ' + self.soln.stack_name.upper() + ' solution, no ETM: mean coordinate'
-            xyz = np.mean(L, axis=1)[:, np.newaxis]
+            xyz[:, ~found] = np.mean(L, axis=1)[:, np.newaxis]
+            source[~found] = 'No ' + stack + ' solution, no ETM: mean coordinate'
+
             # set the uncertainties in NEU by hand
-            sig = np.array([[9.99], [9.99], [9.99]])
+            sig[:] = 9.99
+
+        source = source.tolist()
 
         if self.A is not None:
             # get the velocity of the site
@@ -2069,7 +2371,7 @@ class ETM:
                 # fast moving station! bump up the sigma floor
                 sigma_h = 99.9
                 sigma_v = 99.9
-                source += '. fast moving station, bumping up sigmas'
+                source = [src + '. fast moving station, bumping up sigmas' for src in source]
 
         # apply floor sigmas
         sig = np.sqrt(np.square(sig) + np.square(np.array([[sigma_h], [sigma_h], [sigma_v]])))
@@ -2342,7 +2644,7 @@ class ETM:
         """
 
         filt = self.F[0] * self.F[1] * self.F[2]
-        dates = [pyDate.Date(mjd=mjd) for mjd in self.soln.mjd[~filt]]
+        dates = pyDate.DateArray(mjd=self.soln.mjd[~filt])
 
         return [(net, stn, date) for net, stn, date in zip(repeat(self.NetworkCode), repeat(self.StationCode), dates)]
 
@@ -2536,3 +2838,211 @@ class FileETM(ETM):
                                             self.soln.z - self.soln.auto_z]))
 
         self.run_adjustment(cnn, self.l, plotit)
+
+
+def station_filter(stations):
+    """
+    sql condition to select the records of a list of stations
+    :param stations: list of dictionaries with NetworkCode and StationCode
+    """
+    return '("NetworkCode", "StationCode") IN (VALUES %s)' \
+           % ', '.join(['(\'%s\', \'%s\')' % (stn['NetworkCode'], stn['StationCode']) for stn in stations])
+
+
+class EtmCache(object):
+    """
+    Per-process cache of fitted ETMs (PPP or GAMIT stacks). prefetch_parameters loads, with one query for the whole
+    station list, the etms records (used by run_adjustment instead of one query per station): this is all that the
+    tools that build the ETM of each station once per run (PlotETM, QueryETM, pyParallelGamit) need.
+    The fitted ETMs are only useful to a process that asks for the same station more than once (the fingerprints and
+    models live in memory, a new process always builds the ETM): prefetch also loads a fingerprint of everything that
+    goes into each ETM: solutions (count and sum of hashes for PPP, count, span and sum of coordinates for a stack),
+    excluded solutions, station coordinates, station info, etm_params and the earthquakes table. A fitted ETM is
+    reused (without querying the solutions or building the design matrix) while its fingerprint does not change. The
+    fitted ETMs are kept in a LRU list of ETM_CACHE_SIZE items
+    """
+    def __init__(self, size=ETM_CACHE_SIZE):
+
+        self.size = size
+        # key -> (fingerprint, etm)
+        self.models = OrderedDict()
+        # key -> fingerprint and etms records of the last prefetch
+        self.fingerprints = dict()
+        self.records = dict()
+        # key -> fitted ETM that is being replaced
+        self.fits = dict()
+
+    def prefetch_parameters(self, cnn, stations, soln='ppp', stack='ppp'):
+        """
+        load the etms records of a list of stations (used by run_adjustment)
+        :param stations: list of dictionaries with NetworkCode and StationCode
+        :param soln: ppp or gamit
+        :param stack: name of the stack (ppp for PPP solutions)
+        """
+        if not stations:
+            return
+
+        records = dict([((stn['NetworkCode'], stn['StationCode'], soln, stack), []) for stn in stations])
+
+        for record in cnn.query_float('SELECT * FROM etms WHERE soln = \'%s\' AND stack = \'%s\' AND %s'
+                                      % (soln, stack, station_filter(stations)), as_dict=True):
+            records[(record['NetworkCode'], record['StationCode'], soln, stack)].append(record)
+
+        self.records.update(records)
+
+    def prefetch(self, cnn, stations, soln='ppp', stack='ppp'):
+        """
+        load the etms records and the fingerprints of the ETMs of a list of stations
+        :param stations: list of dictionaries with NetworkCode and StationCode
+        :param soln: ppp or gamit
+        :param stack: name of the stack (ppp for PPP solutions)
+        """
+        if not stations:
+            return
+
+        where = station_filter(stations)
+        keys = [(stn['NetworkCode'], stn['StationCode'], soln, stack) for stn in stations]
+
+        # the inputs of each ETM
+        inputs = dict([(key[0:2], [VERSION]) for key in keys])
+
+        if soln == 'ppp':
+            queries = ['SELECT "NetworkCode", "StationCode", count(*), sum(hash) FROM ppp_soln WHERE %s '
+                       'GROUP BY "NetworkCode", "StationCode"' % where,
+                       'SELECT "NetworkCode", "StationCode", count(*) FROM ppp_soln_excl WHERE %s '
+                       'GROUP BY "NetworkCode", "StationCode"' % where]
+        else:
+            queries = ['SELECT "NetworkCode", "StationCode", count(*), min("Year" * 1000 + "DOY"), '
+                       'max("Year" * 1000 + "DOY"), sum("X" + "Y" + "Z") FROM stacks WHERE "name" = \'%s\' AND %s '
+                       'GROUP BY "NetworkCode", "StationCode"' % (stack, where)]
+
+        queries += ['SELECT "NetworkCode", "StationCode", auto_x, auto_y, auto_z, max_dist FROM stations WHERE %s'
+                    % where,
+                    'SELECT "NetworkCode", "StationCode", md5(string_agg(s::text, \',\' ORDER BY s."DateStart")) '
+                    'FROM stationinfo s WHERE %s GROUP BY "NetworkCode", "StationCode"' % where,
+                    'SELECT "NetworkCode", "StationCode", md5(string_agg(e::text, \',\' ORDER BY e::text)) '
+                    'FROM etm_params e WHERE %s GROUP BY "NetworkCode", "StationCode"' % where]
+
+        for query in queries:
+            for record in cnn.query(query).getresult():
+                inputs[record[0:2]].append(str(record[2:]))
+
+        # a new earthquake changes all the fingerprints
+        earthquakes = str(cnn.query('SELECT count(*), max(date) FROM earthquakes').getresult()[0])
+
+        for key in keys:
+            self.fingerprints[key] = crc32(' '.join(inputs[key[0:2]] + [earthquakes]))
+
+        self.prefetch_parameters(cnn, stations, soln, stack)
+
+    def parameters(self, NetworkCode, StationCode, soln, stack):
+        """
+        etms records loaded by prefetch (returned only once) or None if the station was not prefetched
+        """
+        return self.records.pop((NetworkCode, StationCode, soln, stack), None)
+
+    def last_fit(self, NetworkCode, StationCode, soln, stack):
+        """
+        fitted ETM that is being replaced by etm (returned only once) or None
+        """
+        return self.fits.pop((NetworkCode, StationCode, soln, stack), None)
+
+    def valid(self, NetworkCode, StationCode, soln='ppp', stack='ppp'):
+        """
+        True if the fitted ETM in memory has the same fingerprint as the last prefetch of the station
+        """
+        key = (NetworkCode, StationCode, soln, stack)
+
+        return key in self.models and key in self.fingerprints and self.models[key][0] == self.fingerprints[key]
+
+    def etm(self, cnn, NetworkCode, StationCode, soln='ppp', stack='ppp'):
+        """
+        return the fitted ETM of a station: from memory if the fingerprint did not change, otherwise the ETM is
+        created (PPPETM or GamitETM) and kept in memory. Call prefetch before to check many stations at once
+        """
+        key = (NetworkCode, StationCode, soln, stack)
+
+        if key not in self.fingerprints:
+            self.prefetch(cnn, [{'NetworkCode': NetworkCode, 'StationCode': StationCode}], soln, stack)
+
+        if self.valid(*key):
+            # move to the end of the LRU list
+            etm = self.models.pop(key)[1]
+        else:
+            if key in self.models:
+                # run_adjustment adds the new epochs to the last fit
+                self.fits[key] = self.models.pop(key)[1]
+
+            if soln == 'ppp':
+                etm = PPPETM(cnn, NetworkCode, StationCode)
+            else:
+                etm = GamitETM(cnn, NetworkCode, StationCode, stack_name=stack)
+
+        # etms records and last fit not used by run_adjustment (ETM reused or not enough solutions)
+        self.records.pop(key, None)
+        self.fits.pop(key, None)
+
+        self.models[key] = (self.fingerprints.pop(key), etm)
+
+        while len(self.models) > self.size:
+            self.models.popitem(last=False)
+
+        return etm
+
+    def clear(self):
+
+        self.models.clear()
+        self.fingerprints.clear()
+        self.records.clear()
+        self.fits.clear()
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    return the EtmCache of this process
+    """
+    global _cache
+
+    if _cache is None:
+        _cache = EtmCache()
+
+    return _cache
+
+
+def get_apriori(cnn, requests, sigma_h=SIGMA_FLOOR_H, sigma_v=SIGMA_FLOOR_V, force_model=False):
+    """
+    a priori coordinates of many station-days: the requests are grouped by station, the stored parameters of all the
+    stations are loaded at once and the PPP ETM of each station is built once and evaluated for all the dates of the
+    station with get_xyz_s_vec
+    :param requests: list of (NetworkCode, StationCode, year, doy)
+    :return: dictionary (NetworkCode, StationCode, year, doy) -> (xyz, sigmas, window, source), same as get_xyz_s.
+    If the ETM of a station could not be obtained, the value is the pyETMException
+    """
+    stations = OrderedDict()
+
+    for NetworkCode, StationCode, year, doy in requests:
+        stations.setdefault((NetworkCode, StationCode), []).append((int(year), int(doy)))
+
+    get_cache().prefetch_parameters(cnn, [{'NetworkCode': stn[0], 'StationCode': stn[1]} for stn in stations.keys()])
+
+    result = dict()
+
+    for (NetworkCode, StationCode), dates in stations.iteritems():
+        try:
+            etm = PPPETM(cnn, NetworkCode, StationCode)
+
+        except pyETMException as e:
+            for year, doy in dates:
+                result[(NetworkCode, StationCode, year, doy)] = e
+            continue
+
+        xyz, sig, window, source = etm.get_xyz_s_vec([d[0] for d in dates], [d[1] for d in dates],
+                                                     sigma_h=sigma_h, sigma_v=sigma_v, force_model=force_model)
+
+        for i, (year, doy) in enumerate(dates):
+            result[(NetworkCode, StationCode, year, doy)] = (xyz[:, i:i + 1], sig[:, i:i + 1], window[i], source[i])
+
+    return result
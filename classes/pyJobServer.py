@@ -9,11 +9,23 @@ This module handles the cluster nodes and checks all the necessary dependencies
 import time
 import dispy
 import dispy.httpd
+import multiprocessing
+import threading
+import concurrent.futures
 from tqdm import tqdm
 import traceback
 
 DELAY = 10
 
+# batched jobs (see JobServer.submit_batch): initial and maximum number of items per job and the run time (in seconds)
+# that the adaptive chunk size aims for
+BATCH_INITIAL_SIZE = 10
+BATCH_MAX_SIZE = 500
+BATCH_TARGET_TIME = 30.
+
+# modules already imported (by setup) in this process, used by the local workers (see run_local)
+_local_setup = set()
+
 
 def test_node(check_gamit_tables=None, software_sync=()):
     # test node: function that makes sure that all required packages and tools are present in the nodes
@@ -251,6 +263,43 @@ def setup(modules):
     return 0
 
 
+def run_batch(function, batch):
+    """
+    function executed in the nodes for batched jobs: calls function once for each tuple of arguments in batch
+    :param function: the function to execute or its name (dispy sends the function as a dependency)
+    :param batch: list of argument tuples
+    :return: list of (result, exception) pairs (one per tuple in batch) and the time spent running the batch
+    """
+    import time
+    import traceback
+
+    if isinstance(function, str):
+        function = globals()[function]
+
+    start = time.time()
+    results = []
+
+    for args in batch:
+        try:
+            results.append((function(*args), None))
+        except Exception:
+            results.append((None, traceback.format_exc()))
+
+    return results, time.time() - start
+
+
+def run_local(modules, function, batch):
+    """
+    function executed by the local workers (parallel_backend = local or batches with run_parallel == False): calls
+    setup(modules) the first time the worker sees this set of modules, as dispy does in the nodes, and runs the batch
+    """
+    if modules not in _local_setup:
+        setup(modules)
+        _local_setup.add(modules)
+
+    return run_batch(function, batch)
+
+
 class JobServer:
 
     def check_cluster(self, status, node, job):
@@ -282,7 +331,9 @@ class JobServer:
         self.nodes = []
         self.result = []
         self.jobs = []
-        self.run_parallel = Config.run_parallel if run_parallel else False
+        # run_parallel: execute using the dispy cluster. run_local: execute using a pool of processes in this computer
+        self.run_parallel = Config.run_parallel and Config.parallel_backend == 'dispy' if run_parallel else False
+        self.run_local = Config.run_parallel and Config.parallel_backend == 'local' if run_parallel else False
         self.verbose = False
         self.close = False
         # variable with ip address for multi-homed systems
@@ -295,10 +346,40 @@ class JobServer:
         self.function = None
         self.modules = []
 
-        print " ==== Starting JobServer(dispy) ===="
+        # dispy runs the callbacks in its own thread: jobs whose callback already returned (see dispy_callback)
+        self.job_callback = None
+        self.finished = set()
+        self.finished_lock = threading.Condition()
+
+        # batched jobs: pending arguments and current chunk size
+        self.batch = False
+        self.batch_args = []
+        self.batch_size = BATCH_INITIAL_SIZE
+
+        # local process pool (run_local or batches with run_parallel == False) and its pending jobs
+        self.cpus = int(Config.options['cpus']) if Config.options['cpus'] else multiprocessing.cpu_count()
+        self.executor = None
+        self.futures = dict()
+
+        if self.run_local:
+            print " ==== Starting JobServer(local, %i workers) ====" % self.cpus
+        else:
+            print " ==== Starting JobServer(dispy) ===="
 
         # check that the run_parallel option is activated
-        if self.run_parallel:
+        if self.run_local:
+            # all the local workers run in this computer: test it once (in a worker, as the jobs will run)
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.cpus)
+
+            r = self.executor.submit(test_node, check_gamit_tables).result()
+
+            if 'Test passed!' not in r:
+                print r
+                print ' >> Errors were encountered during initialization. Check messages.'
+                self.executor.shutdown()
+                exit()
+
+        elif self.run_parallel:
             if Config.options['node_list'] is None:
                 # no explicit list, find all
                 servers = ['*']
@@ -350,20 +431,41 @@ class JobServer:
                 print ' >> Errors were encountered during initialization. Check messages.'
                 exit()
 
-    def create_cluster(self, function, deps=(), callback=None, progress_bar=None, verbose=False, modules=()):
-
+    def create_cluster(self, function, deps=(), callback=None, progress_bar=None, verbose=False, modules=(),
+                       batch=False):
+        """
+        create the cluster to execute function
+        :param batch: if True, jobs are submitted with submit_batch: several calls to function are grouped in a single
+        job (when run_parallel == False, the batches run in the local process pool)
+        """
         self.jobs = []
         self.callback = callback
         self.function = function
         self.verbose = verbose
         self.close = True
+        self.modules = tuple(modules)
+
+        self.batch = batch
+        self.batch_args = []
+        self.batch_size = BATCH_INITIAL_SIZE
 
         if self.run_parallel:
 
+            if batch:
+                # the nodes run run_batch, which calls function (sent as a dependency) for each item
+                computation = run_batch
+                deps = list(deps) + [function]
+                self.job_callback = self.batch_callback
+            else:
+                computation = function
+                self.job_callback = callback
+
+            self.finished = set()
+
             # DDG: NodeAllocate is used to pass the arguments to setup during node initialization
-            self.cluster = dispy.JobCluster(function, [dispy.NodeAllocate(node.ip_addr, setup_args=(modules,))
-                                                       for node in self.nodes], list(deps),
-                                            callback, self.cluster_status, pulse_interval=60, setup=setup,
+            self.cluster = dispy.JobCluster(computation, [dispy.NodeAllocate(node.ip_addr, setup_args=(modules,))
+                                                          for node in self.nodes], list(deps),
+                                            self.dispy_callback, self.cluster_status, pulse_interval=60, setup=setup,
                                             loglevel=dispy.logger.CRITICAL, reentrant=True, ip_addr=self.ip_address)
 
             self.http_server = dispy.httpd.DispyHTTPServer(self.cluster, poll_sec=2)
@@ -371,6 +473,10 @@ class JobServer:
             # wait for all nodes to be created
             time.sleep(DELAY)
 
+        elif (self.run_local or batch) and self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.cpus)
+
+        self.futures = dict()
         self.progress_bar = progress_bar
 
     def submit(self, *args):
@@ -381,6 +487,8 @@ class JobServer:
         """
         if self.run_parallel:
             self.jobs.append(self.cluster.submit(*args))
+        elif self.run_local:
+            self.submit_local([args])
         else:
             # if no parallel was invoked, execute the procedure manually
             if self.callback is not None:
@@ -395,15 +503,149 @@ class JobServer:
             else:
                 self.function(*args)
 
-    def wait(self):
+    def submit_batch(self, *args):
+        """
+        same as submit, but the arguments are queued and sent in groups of batch_size items per job. The results are
+        passed, one item at the time, to the callback (and the progress bar) as if each item had been a separate job.
+        The cluster has to be created with batch=True
+        :param args:
+        :return:
+        """
+        self.batch_args.append(args)
+
+        if len(self.batch_args) >= self.batch_size:
+            self.flush_batch()
+
+    def map(self, args_list):
+        """
+        submit_batch all the argument tuples in args_list and wait for the results
+        :param args_list: list of argument tuples
+        :return: none
+        """
+        for args in args_list:
+            self.submit_batch(*args)
+
+        self.wait()
+
+    def flush_batch(self):
         """
-        wrapped function to wait for cluster execution
+        send the queued arguments as one job
         :return: none
         """
+        if not self.batch_args:
+            return
+
+        batch = self.batch_args
+        self.batch_args = []
+
+        if self.run_parallel:
+            self.jobs.append(self.cluster.submit(self.function.__name__, batch))
+        else:
+            self.submit_local(batch)
+
+    def submit_local(self, batch):
+        """
+        send a list of argument tuples to the local process pool
+        """
+        future = self.executor.submit(run_local, self.modules, self.function, batch)
+        # the results are passed to the callback by wait (in this thread)
+        self.futures[future] = batch
+
+    def local_callback(self, batch, future):
+        """
+        callback of the local process pool (called by wait for each finished job)
+        """
+        try:
+            results, elapsed = future.result()
+        except Exception:
+            # the worker died or the arguments could not be sent to it: report the error for each item
+            results, elapsed = [(None, traceback.format_exc())] * len(batch), None
+
+        self.process_batch(batch, results, elapsed)
+
+    def dispy_callback(self, job):
+        """
+        dispy callback: runs the callback of the cluster and records that the job was processed (see wait)
+        """
+        try:
+            if self.job_callback is not None:
+                self.job_callback(job)
+        finally:
+            if job.status in (dispy.DispyJob.Finished, dispy.DispyJob.Terminated, dispy.DispyJob.Cancelled):
+                with self.finished_lock:
+                    self.finished.add(id(job))
+                    self.finished_lock.notify_all()
+
+    def batch_callback(self, job):
+        """
+        dispy callback for batched jobs
+        """
+        if job.status == dispy.DispyJob.Finished:
+            results, elapsed = job.result
+            self.process_batch(job.args[1], results, elapsed, job.ip_addr)
+
+        elif job.status in (dispy.DispyJob.Terminated, dispy.DispyJob.Cancelled):
+            # the whole job failed: report the exception for each item
+            self.process_batch(job.args[1], [(None, job.exception)] * len(job.args[1]), None, job.ip_addr)
+
+    def process_batch(self, batch, results, elapsed, ip_addr=None):
+        """
+        pass the results of a batched job to the callback (one item at the time) and adjust the chunk size so that
+        jobs take about BATCH_TARGET_TIME seconds
+        """
+        for args, (result, exception) in zip(batch, results):
+            if self.callback is not None:
+                job = dispy.DispyJob(None, args, ())
+                job.result = result
+                job.exception = exception
+                job.ip_addr = ip_addr
+                self.callback(job)
+
+            if self.progress_bar is not None:
+                self.progress_bar.update()
+
+        if elapsed is not None:
+            if elapsed > 0:
+                size = BATCH_TARGET_TIME / (elapsed / len(batch))
+            else:
+                size = BATCH_MAX_SIZE
+
+            # average with the current size to avoid big jumps due to a single slow or fast job
+            self.batch_size = int(min(max((self.batch_size + size) / 2., 1), BATCH_MAX_SIZE))
+
+    def wait(self):
+        """
+        wrapped function to wait for cluster execution. The results of the local process pool are passed to the
+        callback (and progress bar) in this thread as the jobs finish. With dispy, wait also waits for the callbacks
+        of all the jobs: all of them were processed when wait returns
+        :return: False if the wait was interrupted (not all the jobs finished), True otherwise
+        """
+        if self.batch:
+            self.flush_batch()
+
+        if not self.run_parallel and self.executor is not None:
+            try:
+                for future in concurrent.futures.as_completed(self.futures.keys()):
+                    self.local_callback(self.futures.pop(future), future)
+            except KeyboardInterrupt:
+                for future in self.futures:
+                    future.cancel()
+                self.futures = dict()
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                return False
+
         if self.run_parallel:
             tqdm.write(' -- Waiting for jobs to finish...')
             try:
                 self.cluster.wait()
+                # the callbacks of the finished jobs might still be queued in the dispy thread: wait for them (jobs
+                # that could not be submitted or ended in any other status do not have a callback to wait for)
+                with self.finished_lock:
+                    while any(id(job) not in self.finished for job in self.jobs if job is not None and job.status in
+                              (dispy.DispyJob.Finished, dispy.DispyJob.Terminated, dispy.DispyJob.Cancelled)):
+                        # timeout to be able to receive the KeyboardInterrupt
+                        self.finished_lock.wait(1)
                 # let the process trigger cluster_status before letting the calling proc close the progress bar
                 time.sleep(DELAY)
             except KeyboardInterrupt:
@@ -411,12 +653,17 @@ class JobServer:
                     if job.status in (dispy.DispyJob.Running, dispy.DispyJob.Created):
                         self.cluster.cancel(job)
                 self.cluster.shutdown()
+                return False
+
+        return True
 
     def close_cluster(self):
         if self.run_parallel and self.close:
             tqdm.write('')
             self.http_server.shutdown()
             self.cleanup()
+        elif self.executor is not None:
+            self.cleanup()
 
     def cluster_status(self, status, node, job):
 
@@ -450,10 +697,16 @@ class JobServer:
                 tqdm.write(' -- Job %04i has been cancelled with the following exception: ' % job.id)
                 tqdm.write(str(job.exception))
 
-            if status in (dispy.DispyJob.Finished, dispy.DispyJob.Terminated) and self.progress_bar is not None:
+            # batched jobs update the progress bar once per item (see process_batch)
+            if status in (dispy.DispyJob.Finished, dispy.DispyJob.Terminated) and self.progress_bar is not None \
+                    and not self.batch:
                 self.progress_bar.update()
 
     def cleanup(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
         if self.run_parallel and self.close:
             self.cluster.print_status()
             self.cluster.close()
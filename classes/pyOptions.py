@@ -12,6 +12,25 @@ from Utils import process_date
 from pyDate import Date
 
 
+# per-process cache of parsed config files (see get_options)
+_options = dict()
+
+
+def get_options(configfile='gnss_data.cfg'):
+    """
+    Returns the ReadOptions object of configfile, parsing it only once per process (or again if the file changed).
+    Used by the jobs that run in the nodes, which would otherwise parse gnss_data.cfg on every call
+    :param configfile: path to the config file
+    :return: a ReadOptions object
+    """
+    key = (configfile, os.path.getmtime(configfile))
+
+    if key not in _options:
+        _options[key] = ReadOptions(configfile)
+
+    return _options[key]
+
+
 class ReadOptions:
     def __init__(self, configfile):
 
@@ -19,6 +38,8 @@ class ReadOptions:
                         'repository': None,
                         'parallel': False,
                         'cups': None,
+                        'cpus': None,
+                        'parallel_backend': 'dispy',
                         'node_list': None,
                         'ip_address': None,
                         'brdc': None,
@@ -39,7 +60,11 @@ class ReadOptions:
                         'atx': None,
                         'height_codes': None,
                         'ppp_exe': None,
-                        'ppp_remote_local': ()}
+                        'ppp_remote_local': (),
+                        'product_cache': None,
+                        'product_cache_size': None,
+                        'scan_index': None,
+                        'rinex_summary': 'rinsum'}
 
         config = ConfigParser.ConfigParser()
         config.readfp(open(configfile))
@@ -93,4 +118,16 @@ class ReadOptions:
         else:
             self.run_parallel = False
 
+        # dispy: run the jobs in the dispy cluster. local: run the jobs in a pool of processes in this computer
+        self.parallel_backend = self.options['parallel_backend'].strip().lower()
+
+        if self.parallel_backend not in ('dispy', 'local'):
+            raise ValueError('Invalid parallel_backend %s: use dispy or local' % self.parallel_backend)
+
+        # rinsum: summarize the RINEX files with RinSum. native: use pyRinex.rinex_summary
+        self.rinex_summary = self.options['rinex_summary'].strip().lower()
+
+        if self.rinex_summary not in ('rinsum', 'native'):
+            raise ValueError('Invalid rinex_summary %s: use rinsum or native' % self.rinex_summary)
+
         return
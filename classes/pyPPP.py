@@ -23,8 +23,12 @@ import os
 import uuid
 import numpy
 import pyEvents
+import pyStationIndex
 import re
 
+# number of stations returned by verify_spatial_coherence when there is no match
+CLOSEST_STATIONS = 10
+
 
 def find_between(s, first, last):
     try:
@@ -86,48 +90,19 @@ class PPPSpatialCheck:
         # 1) if etm data is available, then use it to bring the coordinate to self.epoch
         # 2) if no etm parameters are available, default to the coordinate reported in the stations table
 
-        if not search_in_new:
-            where_clause = 'WHERE "NetworkCode" not like \'?%%\''
-        else:
-            where_clause = ''
-
-        # start by reducing the number of stations filtering everything beyond 100 km from the point of interest
-        # rs = cnn.query("""
-        #     SELECT * FROM
-        #     (SELECT *, 2*asin(sqrt(sin((radians(%.8f)-radians(lat))/2)^2 + cos(radians(lat)) * cos(radians(%.8f)) *
-        #     sin((radians(%.8f)-radians(lon))/2)^2))*6371000 AS distance
-        #     FROM stations %s) as DD
-        #     WHERE distance <= %f
-        #     """ % (self.lat[0], self.lat[0], self.lon[0], where_clause, 1e3))  # DO NOT RETURN RESULTS
-        #     WITH NetworkCode = '?%'
-
-        rs = cnn.query("""
-            SELECT st1."NetworkCode", st1."StationCode", st1."StationName", st1."DateStart", st1."DateEnd",
-             st1."auto_x", st1."auto_y", st1."auto_z", st1."Harpos_coeff_otl", st1."lat", st1."lon", st1."height",
-             st1."max_dist", st1."dome", st1.distance FROM
-            (SELECT *, 2*asin(sqrt(sin((radians(%.8f)-radians(lat))/2)^2 + cos(radians(lat)) * 
-            cos(radians(%.8f)) * sin((radians(%.8f)-radians(lon))/2)^2))*6371000 AS distance
-            FROM stations %s) as st1 left join stations as st2 ON 
-                st1."StationCode" = st2."StationCode" and
-                st1."NetworkCode" = st2."NetworkCode" and
-                st1.distance < coalesce(st2.max_dist, 20)
-                WHERE st2."NetworkCode" is not NULL
-            """ % (self.lat[0], self.lat[0], self.lon[0], where_clause))  # DO NOT RETURN RESULTS NetworkCode = '?%'
-
-        stn_match = rs.dictresult()
+        index = pyStationIndex.get_index(cnn)
+
+        # candidates: stations closer than their max_dist (20 m if not set) to the point of interest
+        # DO NOT RETURN RESULTS WITH NetworkCode = '?%' unless search_in_new
+        stn_match = [stn for stn in index.within(self.lat[0], self.lon[0], index.max_dist, search_in_new)
+                     if stn['distance'] < (float(stn['max_dist']) if stn['max_dist'] is not None
+                                           else pyStationIndex.DEFAULT_MAX_DIST)]
 
         # using the list of coordinates, check if StationCode exists in the list
         if len(stn_match) == 0:
             # no match, find closest station
-            # get the closest station and distance in km to help the caller function
-            rs = cnn.query("""
-                SELECT * FROM
-                    (SELECT *, 2*asin(sqrt(sin((radians(%.8f)-radians(lat))/2)^2 + cos(radians(lat)) * 
-                    cos(radians(%.8f)) * sin((radians(%.8f)-radians(lon))/2)^2))*6371000 AS distance
-                        FROM stations %s) as DD ORDER BY distance
-                """ % (self.lat[0], self.lat[0], self.lon[0], where_clause))
-
-            stn = rs.dictresult()
+            # get the closest stations and distance in m to help the caller function
+            stn = index.nearest(self.lat[0], self.lon[0], CLOSEST_STATIONS, search_in_new)
 
             return False, [], stn
 
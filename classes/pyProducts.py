@@ -4,12 +4,61 @@ Date: 2/23/17 10:12 AM
 Author: Demian D. Gomez
 """
 import os
+import errno
+import fcntl
+import hashlib
+import json
+import tempfile
+from zlib import crc32
 from shutil import copyfile
 import pyRunWithRetry
 import pyEvents
 import pyDate
+import pyOptions
 from datetime import datetime
 
+# default location and size (in MB) of the product cache of each node (see get_cache)
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'pgamit_products')
+CACHE_SIZE = 2048
+
+# number of lock files of the entries of a cache (each entry is locked with one of them, see ProductCache.entry_lock)
+LOCK_STRIPES = 256
+
+# caches of this process (see get_cache): None if not initialized yet, False if disabled
+_caches = dict()
+
+
+def get_cache(configfile='gnss_data.cfg', name=None):
+    """
+    return the product cache of this process. The location and size are taken from the product_cache and
+    product_cache_size (MB) options of the archive section of configfile (if present in the working directory). Setting
+    product_cache = none disables the cache
+    :param name: subdirectory of the product cache for other files prepared in the node (e.g. rinex), each with its
+    own size limit
+    :return: ProductCache object or None if the cache is disabled
+    """
+    if _caches.get(name) is None:
+        path = CACHE_DIR
+        size = CACHE_SIZE
+
+        if os.path.isfile(configfile):
+            options = pyOptions.get_options(configfile).options
+            if options.get('product_cache'):
+                path = options['product_cache']
+            if options.get('product_cache_size'):
+                size = float(options['product_cache_size'])
+
+        if path.strip().lower() == 'none':
+            _caches[name] = False
+        else:
+            try:
+                _caches[name] = ProductCache(os.path.join(path, name) if name else path, size)
+            except (OSError, IOError):
+                # cache directory cannot be created: work without the cache
+                _caches[name] = False
+
+    return _caches[name] if _caches[name] else None
+
 
 class pyProductsException(Exception):
     def __init__(self, value):
@@ -24,6 +73,205 @@ class pyProductsExceptionUnreasonableDate(pyProductsException):
     pass
 
 
+class ProductCache(object):
+    """
+    Cache of decompressed orbital products shared by all the processes of a node (also used for other files prepared in
+    the node, see get and get_cache). Each entry is identified by the path, size and modification time of the file in
+    the archive, so a product that changes in the archive produces a new entry. Entries are created under a file lock
+    (only one process fetches and decompresses a product) and copied into the directories of the jobs, which are free
+    to modify or delete their copies (GAMIT edits some of its input files in place). The entries are evicted in least
+    recently used order when the size of the cache exceeds max_size. The entries are locked with a fixed set of
+    LOCK_STRIPES lock files (never removed: a process might be waiting on or holding one of them). The hit and miss counters (and the bytes read
+    from the archive and saved) are kept in the stats file of the cache directory
+    """
+    def __init__(self, path, max_size=CACHE_SIZE):
+        """
+        :param path: cache directory
+        :param max_size: size of the cache in MB
+        """
+        self.path = path
+        self.max_size = int(max_size * 1024 * 1024)
+
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def lock(self, name):
+        """
+        acquire an exclusive lock (released when the returned file is closed)
+        """
+        f = open(os.path.join(self.path, name + '.lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def entry_lock(self, entry, blocking=True):
+        """
+        acquire the lock of an entry (shared with the other entries of the same stripe)
+        :return: lock file or None if blocking is False and the lock is held by another process
+        """
+        f = open(os.path.join(self.path, 'lock.%02x' % (crc32(entry) % LOCK_STRIPES)), 'a')
+
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+
+        return f
+
+    def entry(self, source, filename):
+        """
+        name of the cache entry of the archive file source (decompressed as filename)
+        """
+        st = os.stat(source)
+        key = hashlib.sha1('%s %i %i' % (os.path.abspath(source), st.st_size, int(st.st_mtime))).hexdigest()
+        return key[0:16] + '_' + filename
+
+    def fetch(self, source, ext, filename, destination):
+        """
+        put the decompressed archive file source in destination, fetching it from the archive only if it is not in the
+        cache
+        :param source: archive file (compressed with ext, or not compressed if ext is None)
+        :param ext: compression extension of source (.Z, .gz, .zip) or None
+        :param filename: name of the decompressed file
+        :param destination: full path of the file to create
+        """
+        def create(tmp):
+            try:
+                if ext is not None:
+                    copyfile(source, tmp + ext)
+                    cmd = pyRunWithRetry.RunCommand('gunzip -f ' + tmp + ext, 15)
+                    cmd.run_shell()
+                else:
+                    copyfile(source, tmp)
+
+                if not os.path.isfile(tmp):
+                    raise pyProductsException('Could not decompress ' + source)
+            finally:
+                if ext is not None and os.path.isfile(tmp + ext):
+                    os.remove(tmp + ext)
+
+        self.get(self.entry(source, filename), destination, create, os.path.getsize(source))
+
+    def get(self, entry, destination, create, size=0):
+        """
+        put a cache entry in destination, creating it first if it is not in the cache
+        :param entry: name of the entry
+        :param destination: full path of the file to create
+        :param create: function that receives the path of a temporary file and writes the contents of the entry to it
+        :param size: bytes read from the archive to create the entry (for the stats)
+        :return: True if the entry was in the cache
+        """
+        entry_path = os.path.join(self.path, entry)
+
+        with self.entry_lock(entry):
+            if os.path.isfile(entry_path):
+                hit = True
+                # last use of the entry (for the LRU eviction)
+                os.utime(entry_path, None)
+            else:
+                hit = False
+                tmp = os.path.join(self.path, 'tmp.%i.%s' % (os.getpid(), entry))
+
+                try:
+                    create(tmp)
+
+                    # the entries are shared by many jobs: nobody should modify them
+                    os.chmod(tmp, 0o444)
+                    os.rename(tmp, entry_path)
+                finally:
+                    if os.path.isfile(tmp):
+                        os.remove(tmp)
+
+            if os.path.lexists(destination):
+                os.remove(destination)
+
+            # a copy (not a link to the read-only entry): the job might modify its file
+            copyfile(entry_path, destination)
+
+        self.update_stats(hit, size)
+
+        if not hit:
+            self.evict(keep=entry)
+
+        return hit
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used entries until the cache is smaller than max_size. Entries being created or
+        copied by another process (locked) are skipped
+        :param keep: entry that should not be removed
+        """
+        with self.lock('cache'):
+            entries = []
+            for name in os.listdir(self.path):
+                f = os.path.join(self.path, name)
+                if name.endswith('.lock') or name.startswith(('lock.', 'tmp.')) or name == 'stats' or \
+                        not os.path.isfile(f):
+                    continue
+                st = os.stat(f)
+                entries.append((st.st_mtime, st.st_size, name))
+
+            total = sum([e[1] for e in entries])
+
+            evicted = 0
+            for _, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+
+                if name == keep:
+                    continue
+
+                lock = self.entry_lock(name, blocking=False)
+
+                if lock is None:
+                    # in use
+                    continue
+
+                with lock:
+                    os.remove(os.path.join(self.path, name))
+
+                total -= size
+                evicted += 1
+
+        if evicted:
+            self.update_stats(evicted=evicted)
+
+    def update_stats(self, hit=None, size=0, evicted=0):
+
+        with self.lock('cache'):
+            stats = self.stats()
+
+            if hit is True:
+                stats['hits'] += 1
+                stats['bytes_saved'] += size
+            elif hit is False:
+                stats['misses'] += 1
+                stats['bytes_fetched'] += size
+
+            stats['evictions'] += evicted
+
+            with open(os.path.join(self.path, 'stats'), 'w') as f:
+                json.dump(stats, f)
+
+    def stats(self):
+        """
+        :return: dictionary with the counters of the cache (hits, misses, bytes fetched from and saved to the archive
+        and evictions)
+        """
+        stats = {'hits': 0, 'misses': 0, 'bytes_fetched': 0, 'bytes_saved': 0, 'evictions': 0}
+
+        try:
+            with open(os.path.join(self.path, 'stats'), 'r') as f:
+                stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+
+        return stats
+
+
 class OrbitalProduct(object):
 
     def __init__(self, archive, date, filename, copyto):
@@ -46,29 +294,31 @@ class OrbitalProduct(object):
         # try both zipped and unzipped n files
         archive_file_path = os.path.join(archive, self.filename)
 
+        ext = None
         if os.path.isfile(archive_file_path):
-            try:
-                copyfile(archive_file_path, os.path.join(copyto, self.filename))
-                self.file_path = os.path.join(copyto, self.filename)
-            except Exception:
-                raise
+            source = archive_file_path
         else:
-            ext = None
-            if os.path.isfile(archive_file_path + '.Z'):
-                ext = '.Z'
-            elif os.path.isfile(archive_file_path + '.gz'):
-                ext = '.gz'
-            elif os.path.isfile(archive_file_path + '.zip'):
-                ext = '.zip'
-
-            if ext is not None:
-                copyfile(archive_file_path + ext, os.path.join(copyto, self.filename + ext))
-                self.file_path = os.path.join(copyto, self.filename)
-
-                cmd = pyRunWithRetry.RunCommand('gunzip -f ' + self.file_path + ext, 15)
-                try:
-                    cmd.run_shell()
-                except Exception:
-                    raise
-            else:
-                raise pyProductsException('Could not find the archive file for ' + self.filename)
+            source = None
+            for ext in ('.Z', '.gz', '.zip'):
+                if os.path.isfile(archive_file_path + ext):
+                    source = archive_file_path + ext
+                    break
+
+        if source is None:
+            raise pyProductsException('Could not find the archive file for ' + self.filename)
+
+        self.file_path = os.path.join(copyto, self.filename)
+
+        cache = get_cache()
+
+        if cache is not None:
+            cache.fetch(source, ext, self.filename, self.file_path)
+
+        elif ext is None:
+            copyfile(source, self.file_path)
+
+        else:
+            copyfile(source, self.file_path + ext)
+
+            cmd = pyRunWithRetry.RunCommand('gunzip -f ' + self.file_path + ext, 15)
+            cmd.run_shell()
@@ -17,15 +17,31 @@ import pyStationInfo
 import datetime
 import Utils
 import uuid
+import pyOptions
 import re
 import struct
 import unicodedata
+import numpy as np
+from pyBunch import Bunch
 
 TYPE_CRINEZ = 0
 TYPE_RINEX = 1
 TYPE_RINEZ = 2
 TYPE_CRINEX = 3
 
+# summarize the RINEX files with RinSum (True) or with rinex_summary (False) when there is no gnss_data.cfg in the
+# working directory. Otherwise, the rinex_summary option of the archive section is used (see use_rinsum)
+USE_RINSUM = True
+
+# fields of the RINEX summary (see rinex_summary and parse_rinsum)
+SUMMARY_FIELDS = ('position', 'antenna_delta', 'receiver', 'marker_number', 'antenna', 'interval', 'epochs',
+                  'first_epoch', 'last_epoch', 'size', 'obs_types', 'observables', 'errors')
+
+# names used by RinSum to report the RINEX 3 GPS observables in RINEX 2 (first match for each observation code)
+RINEX3_TO_2 = (('C1C', 'C1'), ('C1', 'P1'), ('C2C', 'C2'), ('C2L', 'C2'), ('C2S', 'C2'), ('C2X', 'C2'),
+               ('C2', 'P2'), ('C5', 'C5'), ('L1', 'L1'), ('L2', 'L2'), ('L5', 'L5'), ('D1', 'D1'), ('D2', 'D2'),
+               ('D5', 'D5'), ('S1', 'S1'), ('S2', 'S2'), ('S5', 'S5'))
+
 
 def check_year(year):
     # to check for wrong dates in RinSum
@@ -42,6 +58,247 @@ def check_year(year):
     return year
 
 
+def parse_rinsum(output):
+    """
+    parse the output of RinSum
+    :param output: text returned by RinSum --notable
+    :return: Bunch with the summary fields (see rinex_summary)
+    """
+    summary = Bunch.fromkeys(SUMMARY_FIELDS)
+
+    try:
+        summary.position = tuple([float(x) for x in
+                                  re.findall(r'Position\s+\(XYZ,m\)\s:\s\(\s*(\-?\d+\.\d+)\,\s*(-?\d+\.\d+)\,'
+                                             r'\s*(-?\d+\.\d+)', output, re.MULTILINE)[0]])
+    except Exception:
+        pass
+
+    try:
+        summary.antenna_delta = tuple([float(x) for x in
+                                       re.findall(r'Antenna\sDelta\s+\(HEN,m\)\s:\s\(\s*(\-?\d+\.\d+)\,'
+                                                  r'\s*(-?\d+\.\d+)\,\s*(-?\d+\.\d+)', output, re.MULTILINE)[0]])
+    except Exception:
+        pass
+
+    try:
+        summary.receiver = tuple([x.strip() for x in re.findall(r'Rec#:([^,]*),\s*Type:([^,]*),\s*Vers:(.*)',
+                                                                output, re.MULTILINE)[0]])
+    except Exception:
+        pass
+
+    try:
+        summary.marker_number = re.findall(r'^Marker number\s*:\s*(.*)', output, re.MULTILINE)[0]
+    except Exception:
+        pass
+
+    try:
+        summary.antenna = tuple([x.strip() for x in re.findall(r'Antenna\s*#\s*:([^,]*),\s*Type\s*:\s*(.*)',
+                                                               output, re.MULTILINE)[0]])
+    except Exception:
+        pass
+
+    try:
+        summary.interval = float(re.findall(r'^Computed interval\s*(\d+\.\d+)', output, re.MULTILINE)[0])
+    except Exception:
+        pass
+
+    try:
+        summary.epochs = int(re.findall(r'^There were\s*(\d+)\s*epochs', output, re.MULTILINE)[0])
+    except Exception:
+        pass
+
+    try:
+        yy, mm, dd, hh, MM, ss = [int(x) for x in re.findall(r'^Computed first epoch:\s*(\d+)\/(\d+)\/(\d+)'
+                                                             r'\s(\d+):(\d+):(\d+)', output, re.MULTILINE)[0]]
+        summary.first_epoch = datetime.datetime(check_year(yy), mm, dd, hh, MM, ss)
+
+        yy, mm, dd, hh, MM, ss = [int(x) for x in re.findall(r'^Computed last\s*epoch:\s*(\d+)\/(\d+)'
+                                                             r'\/(\d+)\s(\d+):(\d+):(\d+)', output, re.MULTILINE)[0]]
+        summary.last_epoch = datetime.datetime(check_year(yy), mm, dd, hh, MM, ss)
+    except Exception:
+        summary.first_epoch = None
+        summary.last_epoch = None
+
+    try:
+        summary.size = int(re.findall(r'^Computed file size:\s*(\d+)', output, re.MULTILINE)[0])
+    except Exception:
+        pass
+
+    try:
+        summary.obs_types = int(re.findall(r'GPS Observation types\s*\((\d+)\)', output, re.MULTILINE)[0])
+    except Exception:
+        pass
+
+    try:
+        summary.observables = re.findall(r'System GPS Obs types.*\[v2: (.*)\]', output, re.MULTILINE)[0].strip().split()
+    except Exception:
+        pass
+
+    summary.errors = []
+
+    for regex, text in ((r'(.*Warning : Failed to read header: text 0:Incomplete or invalid header.*)', 'Warning in '),
+                        (r'(.*unexpected exception.*)', 'unexpected exception in '),
+                        (r'(.*Exception.*)', 'Exception in '),
+                        (r'(.*no data found. Are time limits wrong.*)', 'RinSum: no data found in ')):
+        warn = re.findall(regex, output, re.MULTILINE)
+        if warn:
+            summary.errors.append(text + 'ReadRinex.parse_output: ' + warn[0])
+
+    return summary
+
+
+def rinex_summary(filename):
+    """
+    summarize a RINEX 2 or 3 observation file reading it once (same fields that ReadRinex uses from RinSum). The
+    header records are taken from the header, the first and last epochs and the number of epochs from the epoch lines
+    (OK and power failure flags) and the interval is the most frequent difference between consecutive epochs
+    :param filename: path to the uncompressed RINEX file
+    :return: Bunch with the summary fields (SUMMARY_FIELDS). Fields that could not be determined are None
+    """
+    summary = Bunch.fromkeys(SUMMARY_FIELDS)
+    summary.errors = []
+
+    version = None
+    obs_types = []
+    gps_types = []
+    system = None
+    epochs = []
+
+    with open(filename, 'r') as fileio:
+
+        # header
+        for line in fileio:
+            label = line[60:].strip()
+
+            try:
+                if label == 'RINEX VERSION / TYPE':
+                    version = float(line[0:9])
+
+                elif label == 'MARKER NUMBER':
+                    summary.marker_number = line[0:20].strip()
+
+                elif label == 'REC # / TYPE / VERS':
+                    summary.receiver = (line[0:20].strip(), line[20:40].strip(), line[40:60].strip())
+
+                elif label == 'ANT # / TYPE':
+                    summary.antenna = (line[0:20].strip(), line[20:40].strip())
+
+                elif label == 'APPROX POSITION XYZ':
+                    summary.position = (float(line[0:14]), float(line[14:28]), float(line[28:42]))
+
+                elif label == 'ANTENNA: DELTA H/E/N':
+                    summary.antenna_delta = (float(line[0:14]), float(line[14:28]), float(line[28:42]))
+
+                elif label == '# / TYPES OF OBSERV':
+                    obs_types += line[6:60].split()
+
+                elif label == 'SYS / # / OBS TYPES':
+                    if line[0] != ' ':
+                        system = line[0]
+                    if system == 'G':
+                        gps_types += line[7:60].split()
+
+            except ValueError:
+                # invalid record, leave the field undetermined
+                pass
+
+            if label == 'END OF HEADER':
+                break
+        else:
+            summary.errors.append('Invalid header: could not find END OF HEADER tag in ' + filename)
+            return summary
+
+        if version is None:
+            summary.errors.append('Invalid header: could not find RINEX VERSION / TYPE in ' + filename)
+            return summary
+
+        if version < 3:
+            observables = obs_types
+            # observation records per satellite
+            lines = (max(len(obs_types), 1) - 1) // 5 + 1
+            skip = 0
+
+            for line in fileio:
+                if skip:
+                    skip -= 1
+                    continue
+
+                try:
+                    flag = int(line[28])
+                    nsat = int(line[29:32])
+                except (ValueError, IndexError):
+                    # not an epoch line
+                    continue
+
+                if 2 <= flag <= 5:
+                    # event: skip the header records that follow
+                    skip = nsat
+                    continue
+
+                # continuation lines of the satellite list and the observation records
+                skip = (nsat - 1) // 12 + nsat * lines if nsat > 0 else 0
+
+                if flag <= 1:
+                    try:
+                        epochs.append((check_year(int(line[1:3])), int(line[4:6]), int(line[7:9]), int(line[10:12]),
+                                       int(line[13:15]), float(line[15:26])))
+                    except ValueError:
+                        pass
+        else:
+            observables = []
+            for obs in gps_types:
+                for v3, v2 in RINEX3_TO_2:
+                    if obs.startswith(v3):
+                        if v2 not in observables:
+                            observables.append(v2)
+                        break
+
+            for line in fileio:
+                if line[0] == '>':
+                    try:
+                        if int(line[31]) <= 1:
+                            epochs.append((int(line[2:6]), int(line[7:9]), int(line[10:12]), int(line[13:15]),
+                                           int(line[16:18]), float(line[18:29])))
+                    except (ValueError, IndexError):
+                        pass
+
+    summary.size = os.path.getsize(filename)
+    summary.obs_types = len(observables)
+    summary.observables = observables
+    summary.epochs = len(epochs)
+
+    if epochs:
+        try:
+            # epochs in seconds since the first epoch
+            dates = [datetime.datetime(*epoch[0:5]) for epoch in epochs]
+            t = np.array([(date - dates[0]).total_seconds() + epoch[5] for date, epoch in zip(dates, epochs)])
+        except ValueError as e:
+            summary.errors.append('Invalid epoch in %s: %s' % (filename, str(e)))
+            return summary
+
+        summary.first_epoch = dates[0] + datetime.timedelta(seconds=int(epochs[0][5]))
+        summary.last_epoch = dates[-1] + datetime.timedelta(seconds=int(epochs[-1][5]))
+
+        # most frequent interval
+        dt = np.round(np.diff(t), 3)
+        dt = dt[dt > 0]
+
+        if dt.size:
+            intervals, count = np.unique(dt, return_counts=True)
+            summary.interval = float(intervals[np.argmax(count)])
+        else:
+            summary.interval = 0.
+
+    return summary
+
+
+def format_summary(summary):
+    """
+    text version of a RINEX summary (for the exception and log messages)
+    """
+    return '\n'.join(['%-14s: %s' % (field, str(summary[field])) for field in SUMMARY_FIELDS])
+
+
 def create_unzip_script(run_file_path):
     # temporary script to uncompress o.Z files
     # requested by RS issue #13
@@ -742,8 +999,8 @@ class ReadRinex(RinexRecord):
         if self.rinex_version >= 3:
             self.ConvertRinex3to2()
 
-        # process the output
-        self.parse_output(self.RunRinSum())
+        # get the first and last epochs, interval, etc
+        self.get_summary()
 
         # DDG: new interval checking after running RinSum
         # check the sampling interval
@@ -859,42 +1116,43 @@ class ReadRinex(RinexRecord):
         return
 
     def parse_output(self, output):
+        """
+        load the file information from the output of RinSum
+        """
+        self.load_summary(parse_rinsum(output), 'The output from RinSum was:\n' + output)
 
+    def load_summary(self, summary, details=''):
+        """
+        load the file information from a summary (see rinex_summary and parse_rinsum)
+        :param summary: Bunch with the summary fields
+        :param details: text appended to the exception messages
+        """
         try:
-            self.x, self.y, self.z = [float(x) for x in
-                                      re.findall(r'Position\s+\(XYZ,m\)\s:\s\(\s*(\-?\d+\.\d+)\,\s*(-?\d+\.\d+)\,'
-                                                 r'\s*(-?\d+\.\d+)', output, re.MULTILINE)[0]]
+            self.x, self.y, self.z = summary.position
             self.lat, self.lon, self.h = ecef2lla([self.x, self.y, self.z])
         except Exception:
             self.x, self.y, self.z = (None, None, None)
 
-        try:
-            self.antOffset, self.antOffsetN, self.antOffsetE = [float(x) for x in
-                                                                re.findall(r'Antenna\sDelta\s+\(HEN,m\)\s:\s'
-                                                                           r'\(\s*(\-?\d+\.\d+)\,\s*(-?\d+\.\d+)'
-                                                                           r'\,\s*(-?\d+\.\d+)', output,
-                                                                           re.MULTILINE)[0]]
-        except Exception:
+        if summary.antenna_delta is not None:
+            self.antOffset, self.antOffsetN, self.antOffsetE = summary.antenna_delta
+        else:
             self.antOffset, self.antOffsetN, self.antOffsetE = (0, 0, 0)
             self.log_event('Problem parsing ANTENNA OFFSETS, setting to 0')
 
-        try:
-            self.recNo, self.recType, self.recVers = [x.strip() for x in
-                                                      re.findall(r'Rec#:([^,]*),\s*Type:([^,]*),\s*Vers:(.*)',
-                                                                 output, re.MULTILINE)[0]]
-        except Exception:
+        if summary.receiver is not None:
+            self.recNo, self.recType, self.recVers = summary.receiver
+        else:
             self.recNo, self.recType, self.recVers = ('', '', '')
             self.log_event('Problem parsing REC # / TYPE / VERS, setting to EMPTY')
 
-        try:
-            self.marker_number = re.findall(r'^Marker number\s*:\s*(.*)', output, re.MULTILINE)[0]
-        except Exception:
+        if summary.marker_number is not None:
+            self.marker_number = summary.marker_number
+        else:
             self.marker_number = 'NOT FOUND'
             self.log_event('No MARKER NUMBER found, setting to NOT FOUND')
 
-        try:
-            self.antNo, AntDome = [x.strip() for x in re.findall(r'Antenna\s*#\s*:([^,]*),\s*Type\s*:\s*(.*)',
-                                                                 output, re.MULTILINE)[0]]
+        if summary.antenna is not None:
+            self.antNo, AntDome = summary.antenna
 
             if ' ' in AntDome:
                 self.antType = AntDome.split()[0]
@@ -903,20 +1161,19 @@ class ReadRinex(RinexRecord):
                 self.antType = AntDome
                 self.antDome = 'NONE'
                 self.log_event('No dome found, set to NONE')
-
-        except Exception:
+        else:
             self.antNo, self.antType, self.antDome = ('UNKNOWN', 'UNKNOWN', 'NONE')
             self.log_event('Problem parsing ANT # / TYPE, setting to UNKNOWN NONE')
 
-        try:
-            self.interval = float(re.findall(r'^Computed interval\s*(\d+\.\d+)', output, re.MULTILINE)[0])
-        except Exception:
+        if summary.interval is not None:
+            self.interval = summary.interval
+        else:
             self.interval = 0
             self.log_event('Problem interval, setting to 0')
 
-        try:
-            self.epochs = float(re.findall(r'^There were\s*(\d+)\s*epochs', output, re.MULTILINE)[0])
-        except Exception:
+        if summary.epochs is not None:
+            self.epochs = float(summary.epochs)
+        else:
             self.epochs = 0
             self.log_event('Problem parsing epochs, setting to 0')
 
@@ -927,75 +1184,49 @@ class ReadRinex(RinexRecord):
                                                   'Reported epochs in file were %s' % (self.epochs))
             else:
                 raise pyRinexExceptionSingleEpoch('RINEX interval equal to zero. Single epoch or bad RINEX file. '
-                                                  'No epoch information to report. The output from RinSum was:\n' +
-                                                  output)
+                                                  'No epoch information to report. ' + details)
 
         elif self.interval > 120:
-            raise pyRinexExceptionBadFile('RINEX sampling interval > 120s. The output from RinSum was:\n' + output)
+            raise pyRinexExceptionBadFile('RINEX sampling interval > 120s. ' + details)
 
         elif self.epochs * self.interval < 3600:
-            raise pyRinexExceptionBadFile('RINEX file with < 1 hr of observation time. '
-                                          'The output from RinSum was:\n' + output)
+            raise pyRinexExceptionBadFile('RINEX file with < 1 hr of observation time. ' + details)
 
-        try:
-            yy, mm, dd, hh, MM, ss = [int(x) for x in re.findall(r'^Computed first epoch:\s*(\d+)\/(\d+)\/(\d+)'
-                                                                 r'\s(\d+):(\d+):(\d+)', output, re.MULTILINE)[0]]
-            yy = check_year(yy)
-            self.datetime_firstObs = datetime.datetime(yy, mm, dd, hh, MM, ss)
-            self.firstObs = self.datetime_firstObs.strftime('%Y/%m/%d %H:%M:%S')
-
-            yy, mm, dd, hh, MM, ss = [int(x) for x in re.findall(r'^Computed last\s*epoch:\s*(\d+)\/(\d+)'
-                                                                 r'\/(\d+)\s(\d+):(\d+):(\d+)', output,
-                                                                 re.MULTILINE)[0]]
-            yy = check_year(yy)
-            self.datetime_lastObs = datetime.datetime(yy, mm, dd, hh, MM, ss)
-            self.lastObs = self.datetime_lastObs.strftime('%Y/%m/%d %H:%M:%S')
-
-            if self.datetime_lastObs <= self.datetime_firstObs:
-                # bad rinex! first obs > last obs
-                raise pyRinexExceptionBadFile('Last observation (' + self.lastObs + ') <= first observation (' +
-                                              self.firstObs + ')')
+        if summary.first_epoch is None or summary.last_epoch is None:
+            raise pyRinexException(self.rinex_path + ': error in ReadRinex.load_summary: the first/last obs '
+                                                     'is invalid. ' + details)
 
-        except Exception:
-            raise pyRinexException(self.rinex_path + ': error in ReadRinex.parse_output: the output for first/last obs '
-                                                     'is invalid. The output from RinSum was:\n' + output)
+        self.datetime_firstObs = summary.first_epoch
+        self.firstObs = self.datetime_firstObs.strftime('%Y/%m/%d %H:%M:%S')
 
-        try:
-            self.size = int(re.findall(r'^Computed file size:\s*(\d+)', output, re.MULTILINE)[0])
-        except Exception:
+        self.datetime_lastObs = summary.last_epoch
+        self.lastObs = self.datetime_lastObs.strftime('%Y/%m/%d %H:%M:%S')
+
+        if self.datetime_lastObs <= self.datetime_firstObs:
+            # bad rinex! first obs > last obs
+            raise pyRinexException(self.rinex_path + ': error in ReadRinex.load_summary: Last observation (' +
+                                   self.lastObs + ') <= first observation (' + self.firstObs + '). ' + details)
+
+        if summary.size is not None:
+            self.size = summary.size
+        else:
             self.size = 0
             self.log_event('Problem parsing size, setting to 0')
 
-        try:
-            self.obs_types = int(re.findall(r'GPS Observation types\s*\((\d+)\)', output, re.MULTILINE)[0])
-        except Exception:
+        if summary.obs_types is not None:
+            self.obs_types = summary.obs_types
+        else:
             self.obs_types = 0
             self.log_event('Problem parsing observation types, setting to 0')
 
-        try:
-            observables = re.findall(r'System GPS Obs types.*\[v2: (.*)\]', output, re.MULTILINE)[0]
-            self.observables = observables.strip().split()
-        except Exception as e:
+        if summary.observables is not None:
+            self.observables = summary.observables
+        else:
             self.observables = ()
-            self.log_event('Problem parsing observables (%s), setting to ()' % str(e))
+            self.log_event('Problem parsing observables, setting to ()')
 
-        warn = re.findall('(.*Warning : Failed to read header: text 0:Incomplete or invalid header.*)', output,
-                          re.MULTILINE)
-        if warn:
-            raise pyRinexException("Warning in ReadRinex.parse_output: " + warn[0])
-
-        warn = re.findall('(.*unexpected exception.*)', output, re.MULTILINE)
-        if warn:
-            raise pyRinexException("unexpected exception in ReadRinex.parse_output: " + warn[0])
-
-        warn = re.findall('(.*Exception.*)', output, re.MULTILINE)
-        if warn:
-            raise pyRinexException("Exception in ReadRinex.parse_output: " + warn[0])
-
-        warn = re.findall('(.*no data found. Are time limits wrong.*)', output, re.MULTILINE)
-        if warn:
-            raise pyRinexException('RinSum: no data found. Are time limits wrong for file ' + self.rinex +
-                                   ' details:' + warn[0])
+        if summary.errors:
+            raise pyRinexException(summary.errors[0])
 
         # remove non-utf8 chars
         self.recNo   = self.recNo.decode('utf-8', 'ignore').encode('utf-8')
@@ -1005,6 +1236,20 @@ class ReadRinex(RinexRecord):
         self.antType = self.antType.decode('utf-8', 'ignore').encode('utf-8')
         self.antDome = self.antDome.decode('utf-8', 'ignore').encode('utf-8')
 
+    def get_summary(self):
+        """
+        summarize the RINEX file with RinSum or with rinex_summary (see use_rinsum)
+        """
+        if use_rinsum():
+            self.parse_output(self.RunRinSum())
+        else:
+            try:
+                summary = rinex_summary(self.rinex_path)
+            except IOError as e:
+                raise pyRinexException(str(e))
+
+            self.load_summary(summary, 'Summary of the file:\n' + format_summary(summary))
+
     def get_firstobs(self):
 
         if self.rinex_version < 3:
@@ -1246,7 +1491,7 @@ class ReadRinex(RinexRecord):
             # if working on local copy, reload the rinex information
             if copyto == self.rinex_path:
                 # reload information from this file
-                self.parse_output(self.RunRinSum())
+                self.get_summary()
         else:
             raise pyRinexException(err)
 
@@ -1637,9 +1882,68 @@ class ReadRinex(RinexRecord):
         return 'pyRinex.ReadRinex(' + self.NetworkCode + ', ' + self.StationCode + ', ' + str(self.date.year) + ', ' + str(self.date.doy) + ')'
 
 
+def use_rinsum(configfile='gnss_data.cfg'):
+    """
+    True if the RINEX files should be summarized with RinSum: rinex_summary = rinsum (default) in the archive section
+    of configfile. Set rinex_summary = native to use rinex_summary, after validating it against RinSum with
+    compare_summary (python pyRinex.py files) on a sample of the archive
+    """
+    if os.path.isfile(configfile):
+        return pyOptions.get_options(configfile).rinex_summary == 'rinsum'
+
+    return USE_RINSUM
+
+
+def compare_summary(filename):
+    """
+    compare the summary of a RINEX file computed by rinex_summary and by RinSum
+    :param filename: path to the uncompressed RINEX file
+    :return: list of (field, rinex_summary value, RinSum value) for the fields that are different
+    """
+    cmd = pyRunWithRetry.RunCommand('RinSum --notable ' + filename, 45)
+    output, _ = cmd.run_shell()
+
+    native = rinex_summary(filename)
+    rinsum = parse_rinsum(output)
+
+    differences = []
+    for field in SUMMARY_FIELDS:
+        if field == 'errors':
+            # compare only if there were errors
+            if bool(native.errors) != bool(rinsum.errors):
+                differences.append((field, native.errors, rinsum.errors))
+
+        elif field == 'observables':
+            if list(native.observables or []) != list(rinsum.observables or []):
+                differences.append((field, native.observables, rinsum.observables))
+
+        elif native[field] != rinsum[field]:
+            differences.append((field, native[field], rinsum[field]))
+
+    return differences
+
+
 def main():
-    # for testing purposes
-    rnx = ReadRinex('RNX','chac','chac0010.17o')
+    # validate rinex_summary against RinSum on a list of uncompressed RINEX files
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the output of rinex_summary and RinSum')
+
+    parser.add_argument('files', type=str, nargs='+', help='Uncompressed RINEX files to compare')
+
+    args = parser.parse_args()
+
+    different = 0
+    for filename in args.files:
+        differences = compare_summary(filename)
+
+        if differences:
+            different += 1
+            print filename
+            for field, native, rinsum in differences:
+                print '    %-14s rinex_summary: %s RinSum: %s' % (field, str(native), str(rinsum))
+
+    print '%i of %i files with differences' % (different, len(args.files))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+"""
+Project: Parallel.Archive
+
+Persistent index of the files found in the archive by the last scan (ScanArchive -rinex). The index is a SQLite file
+that stores the path, size, modification time and inode of every file, and the modification time and subdirectories
+of every directory. A rescan only lists the directories whose modification time changed (new, removed or renamed files)
+and only reports the files that are new or were modified. Files modified in place do not change the modification time
+of their directory: use a full scan (lists every directory and reports every file) to find them. Files reported by a
+scan but not processed by the caller (e.g. not in the station list) can be deferred to be reported again by the next
+scan.
+"""
+
+import os
+import sqlite3
+import scandir
+
+# default location of the index (working directory)
+INDEX_FILE = 'scan_index.sqlite'
+
+
+class ScanIndex(object):
+
+    def __init__(self, path=INDEX_FILE):
+
+        self.path = path
+
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, '
+                        'mtime REAL, inode INTEGER, pending INTEGER DEFAULT 0)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+        self.db.commit()
+
+    def walk(self, root, file_filter=None, full=False):
+        """
+        walk the directory tree of root and yield the files that are not in the index, that changed (size,
+        modification time or inode) since the last scan or that were deferred by the last scan. Each file is yielded
+        once. The index is updated as the files are yielded, but the changes are only saved by commit
+        :param root: directory to scan
+        :param file_filter: function that receives a file name and returns True if the file should be indexed
+        :param full: list all the directories and report all the files, even the ones that did not change since the
+                     last scan
+        :return: generator of (path, size, mtime)
+        """
+        prefix = root.rstrip('/') + '/'
+
+        # deferred files already yielded (not yielded again when listing their directory)
+        reported = set()
+
+        for f, size, mtime in self.db.execute('SELECT path, size, mtime FROM files WHERE pending = 1 AND '
+                                              'substr(path, 1, ?) = ?', (len(prefix), prefix)).fetchall():
+            if os.path.isfile(f):
+                self.db.execute('UPDATE files SET pending = 0 WHERE path = ?', (f,))
+                reported.add(f)
+                yield f, size, mtime
+            else:
+                self.db.execute('DELETE FROM files WHERE path = ?', (f,))
+
+        stack = [root]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # removed while scanning
+                self.forget(path)
+                continue
+
+            known = self.db.execute('SELECT mtime, subdirs FROM dirs WHERE path = ?', (path,)).fetchone()
+
+            if known is not None and known[0] == mtime and not full:
+                # same entries as in the last scan: only descend into the subdirectories
+                stack += [os.path.join(path, d) for d in known[1].split('\n') if d]
+                continue
+
+            subdirs = []
+            files = dict()
+
+            for entry in scandir.scandir(path):
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+
+                elif (file_filter is None or file_filter(entry.name)) and entry.is_file():
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    files[entry.path] = (st.st_size, st.st_mtime, st.st_ino)
+
+            indexed = dict((f[0], tuple(f[1:])) for f in
+                           self.db.execute('SELECT path, size, mtime, inode FROM files WHERE dir = ?', (path,)))
+
+            # files that are no longer in the directory
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(f,) for f in indexed if f not in files])
+
+            # subdirectories that are no longer in the directory
+            if known is not None:
+                for d in set(known[1].split('\n')) - set(subdirs):
+                    if d:
+                        self.forget(os.path.join(path, d))
+
+            self.db.execute('INSERT OR REPLACE INTO dirs (path, mtime, subdirs) VALUES (?, ?, ?)',
+                            (path, mtime, '\n'.join(subdirs)))
+
+            stack += [os.path.join(path, d) for d in subdirs]
+
+            for f, stat in sorted(files.items()):
+                if full or indexed.get(f) != stat:
+                    self.db.execute('INSERT OR REPLACE INTO files (path, dir, size, mtime, inode) '
+                                    'VALUES (?, ?, ?, ?, ?)', (f, path) + stat)
+
+                    if f not in reported:
+                        yield f, stat[0], stat[1]
+
+    def forget(self, path):
+        """
+        remove a directory (and everything below it) from the index
+        """
+        prefix = path.rstrip('/') + '/'
+
+        self.db.execute('DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?', (path, len(prefix), prefix))
+        self.db.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(prefix), prefix))
+
+    def defer(self, files):
+        """
+        mark files reported by walk as not processed (the next scan reports them again)
+        """
+        self.db.executemany('UPDATE files SET pending = 1 WHERE path = ?', [(f,) for f in files])
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
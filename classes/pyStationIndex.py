@@ -0,0 +1,170 @@
+"""
+Project: Parallel.Archive
+
+In-memory spatial index of the stations table. The stations are stored in a KD-tree of ECEF unit vectors so that the
+spatial coherence checks (closest stations, stations within a given distance) do not need to compute the distance to
+every station in the database. Distances are computed with the same haversine formula (and earth radius) used by the
+SQL queries that this module replaces.
+
+The index is built once per process (see get_index) and has to be refreshed after inserting or moving stations
+(see refresh).
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# earth radius used by the haversine distance (meters)
+EARTH_RADIUS = 6371000.
+
+# default distance used to match a station that does not have max_dist (meters)
+DEFAULT_MAX_DIST = 20.
+
+FIELDS = ('NetworkCode', 'StationCode', 'StationName', 'DateStart', 'DateEnd', 'auto_x', 'auto_y', 'auto_z',
+          'Harpos_coeff_otl', 'lat', 'lon', 'height', 'max_dist', 'dome')
+
+# index of this process
+_index = None
+
+
+def get_index(cnn):
+    """
+    return the station index of this process, building it on first use
+    :param cnn: connection to the database
+    :return: StationIndex object
+    """
+    global _index
+
+    if _index is None:
+        _index = StationIndex(cnn)
+
+    return _index
+
+
+def refresh(cnn):
+    """
+    reload the station index of this process (if it was already built). Call after inserting or moving stations
+    :param cnn: connection to the database
+    """
+    if _index is not None:
+        _index.load(cnn)
+
+
+def unit_vector(lat, lon):
+
+    lat = np.radians(np.atleast_1d(np.array(lat, dtype=float)))
+    lon = np.radians(np.atleast_1d(np.array(lon, dtype=float)))
+
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+class StationIndex(object):
+
+    def __init__(self, cnn):
+
+        self.stations = []
+        self.tree = None
+        self.lat = np.array([])
+        self.lon = np.array([])
+        self.temporary = np.array([], dtype=bool)
+        self.max_dist = DEFAULT_MAX_DIST
+
+        self.load(cnn)
+
+    def load(self, cnn):
+        """
+        load the stations with coordinates from the database and build the tree
+        """
+        rs = cnn.query('SELECT %s FROM stations WHERE "lat" IS NOT NULL AND "lon" IS NOT NULL'
+                       % ', '.join(['"%s"' % field for field in FIELDS]))
+
+        self.stations = rs.dictresult()
+
+        self.lat = np.array([float(stn['lat']) for stn in self.stations])
+        self.lon = np.array([float(stn['lon']) for stn in self.stations])
+        # stations in temporary networks (NetworkCode = ???, ??1, etc)
+        self.temporary = np.array([stn['NetworkCode'].startswith('?') for stn in self.stations], dtype=bool)
+
+        max_dist = [float(stn['max_dist']) for stn in self.stations if stn['max_dist'] is not None]
+        self.max_dist = max(max_dist + [DEFAULT_MAX_DIST])
+
+        if self.stations:
+            self.tree = cKDTree(unit_vector(self.lat, self.lon))
+        else:
+            self.tree = None
+
+    def distance(self, lat, lon, index):
+        """
+        haversine distance (in meters) between a point and the stations in index
+        """
+        lat1 = np.radians(lat)
+        lat2 = np.radians(self.lat[index])
+        dlon = np.radians(lon) - np.radians(self.lon[index])
+
+        return 2 * np.arcsin(np.sqrt(np.square(np.sin((lat1 - lat2) / 2)) +
+                                     np.cos(lat2) * np.cos(lat1) * np.square(np.sin(dlon / 2)))) * EARTH_RADIUS
+
+    def records(self, lat, lon, index):
+        """
+        return the station records in index, sorted by distance to the point, with the added key distance
+        """
+        index = np.array(index, dtype=int)
+
+        if not index.size:
+            return []
+
+        dist = self.distance(lat, lon, index)
+        order = np.argsort(dist, kind='mergesort')
+
+        result = []
+        for i, d in zip(index[order].tolist(), dist[order].tolist()):
+            stn = dict(self.stations[i])
+            stn['distance'] = d
+            result.append(stn)
+
+        return result
+
+    def nearest(self, lat, lon, k=1, search_in_new=False):
+        """
+        find the k closest stations to a point
+        :param lat: latitude of the point (degrees)
+        :param lon: longitude of the point (degrees)
+        :param k: number of stations to return
+        :param search_in_new: include stations in temporary networks
+        :return: list of station records (dictionaries with the fields of FIELDS and distance) sorted by distance
+        """
+        if self.tree is None:
+            return []
+
+        # ask for enough stations to be able to discard the ones in temporary networks
+        n = k if search_in_new else k + int(np.sum(self.temporary))
+        n = min(n, len(self.stations))
+
+        _, index = self.tree.query(unit_vector(lat, lon)[0], n)
+        index = np.atleast_1d(index)
+
+        if not search_in_new:
+            index = index[~self.temporary[index]]
+
+        return self.records(lat, lon, index)[:k]
+
+    def within(self, lat, lon, radius, search_in_new=False):
+        """
+        find the stations within a given distance of a point
+        :param lat: latitude of the point (degrees)
+        :param lon: longitude of the point (degrees)
+        :param radius: distance (meters)
+        :param search_in_new: include stations in temporary networks
+        :return: list of station records (dictionaries with the fields of FIELDS and distance) sorted by distance
+        """
+        if self.tree is None:
+            return []
+
+        # chord between unit vectors for the requested distance (with some room for round off errors)
+        chord = 2 * np.sin(min(radius / EARTH_RADIUS, np.pi) / 2) * (1 + 1e-9) + 1e-12
+
+        index = np.array(self.tree.query_ball_point(unit_vector(lat, lon)[0], chord), dtype=int)
+
+        if not search_in_new:
+            index = index[~self.temporary[index]]
+
+        return [stn for stn in self.records(lat, lon, index) if stn['distance'] <= radius]
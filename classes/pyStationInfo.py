@@ -6,6 +6,8 @@ Author: Demian D. Gomez
 
 import struct
 import datetime
+import bisect
+import copy
 import pyDate
 import zlib
 import pyBunch
@@ -36,6 +38,76 @@ class pyStationInfoHeightCodeNotFound(pyStationInfoException):
     pass
 
 
+# station info cache of this process (see get_cache)
+_cache = None
+
+
+def get_cache():
+    """
+    return the station info cache of this process
+    :return: StationInfoCache object
+    """
+    global _cache
+
+    if _cache is None:
+        _cache = StationInfoCache()
+
+    return _cache
+
+
+class StationInfoCache(object):
+    """
+    Per-process cache of the stationinfo records (loaded once per station, sorted by DateStart) and of the gamit_htc
+    height code table (loaded once). StationInfo objects receive copies of the cached records, so to_dharp and the
+    editing functions never modify the cache. The records of a station are invalidated by InsertStationInfo,
+    UpdateStationInfo and DeleteStationInfo; changes made by other processes are not seen until clear is called
+    """
+    def __init__(self):
+        self.stations = dict()
+        self.htc = None
+
+    def records(self, cnn, NetworkCode, StationCode):
+        """
+        return copies of the station info records of a station (loading them from the database on first use)
+        :return: list of StationInfoRecord sorted by DateStart
+        """
+        key = (NetworkCode, StationCode)
+
+        if key not in self.stations:
+            stninfo = cnn.query('SELECT * FROM stationinfo WHERE "NetworkCode" = \'' + NetworkCode +
+                                '\' AND "StationCode" = \'' + StationCode + '\' ORDER BY "DateStart"')
+
+            self.stations[key] = [StationInfoRecord(NetworkCode, StationCode, record)
+                                  for record in stninfo.dictresult()]
+
+        return [copy.copy(record) for record in self.stations[key]]
+
+    def height_code(self, cnn, AntennaCode, HeightCode):
+        """
+        return the gamit_htc record of an antenna and height code (loading the table on first use)
+        :return: dictionary with h_offset and v_offset or None if not in the table
+        """
+        if self.htc is None:
+            self.htc = dict()
+            for htc in cnn.query_float('SELECT * FROM gamit_htc', as_dict=True):
+                self.htc[(htc['AntennaCode'], htc['HeightCode'])] = htc
+
+        return self.htc.get((AntennaCode, HeightCode))
+
+    def invalidate(self, NetworkCode, StationCode):
+        """
+        remove the records of a station from the cache (they will be reloaded on the next request)
+        """
+        self.stations.pop((NetworkCode, StationCode), None)
+
+    def clear(self):
+        """
+        remove all the records and the height code table from the cache
+        """
+        self.stations = dict()
+        self.htc = None
+
+
 class StationInfoRecord(pyBunch.Bunch):
     def __init__(self, NetworkCode=None, StationCode=None, record=None):
 
@@ -168,6 +240,8 @@ class StationInfo(object):
         self.allow_empty = allow_empty
         self.date = None
         self.records = []
+        # DateEnd of the records (to search the records by date, empty if the records overlap)
+        self.ends = []
         self.currentrecord = StationInfoRecord(NetworkCode, StationCode)
 
         self.header = '*SITE  Station Name      Session Start      Session Stop       Ant Ht   HtCod  Ant N    ' \
@@ -184,45 +258,74 @@ class StationInfo(object):
                 if date is not None:
                     self.date = date
 
-                    pDate = date.datetime()
-
-                    for record in self.records:
+                    record = self.find_record(date, h_tolerance)
 
-                        DateStart = record['DateStart'].datetime()
-                        DateEnd = record['DateEnd'].datetime()
-
-                        # make the gap-tolerant comparison
-                        if DateStart - datetime.timedelta(hours=h_tolerance) <= pDate <= \
-                                DateEnd + datetime.timedelta(hours=h_tolerance):
-                            # found the record that corresponds to this date
-                            self.currentrecord = record
-                            break
-
-                    if self.currentrecord.DateStart is None:
+                    if record is None:
                         raise pyStationInfoException('Could not find a matching station.info record for ' +
                                                      NetworkCode + '.' + StationCode + ' ' +
                                                      date.yyyymmdd() + ' (' + date.yyyyddd() + ')')
 
+                    self.currentrecord = record
+
+    def find_record(self, date, h_tolerance=0):
+        """
+        find the record that corresponds to date (from the already loaded records)
+        :param date: pyDate.Date object
+        :param h_tolerance: gap tolerance in hours
+        :return: the StationInfoRecord or None if no record covers date
+        """
+        pDate = date.datetime()
+        tolerance = datetime.timedelta(hours=h_tolerance)
+
+        indexed = len(self.ends) and len(self.ends) == len(self.records)
+
+        if indexed:
+            # the first candidate is the first record that ends after pDate
+            start = bisect.bisect_left(self.ends, pDate - tolerance)
+        else:
+            start = 0
+
+        for record in self.records[start:]:
+
+            DateStart = record['DateStart'].datetime()
+            DateEnd = record['DateEnd'].datetime()
+
+            # make the gap-tolerant comparison
+            if DateStart - tolerance <= pDate <= DateEnd + tolerance:
+                # found the record that corresponds to this date
+                return record
+
+            if indexed and DateStart - tolerance > pDate:
+                # no other record can contain pDate
+                break
+
+        return None
+
     def load_stationinfo_records(self):
         # function to load the station info records in the database
         # returns true if records found
         # returns false if none found, unless allow_empty = False in which case it raises an error.
-        stninfo = self.cnn.query('SELECT * FROM stationinfo WHERE "NetworkCode" = \'' + self.NetworkCode +
-                                 '\' AND "StationCode" = \'' + self.StationCode + '\' ORDER BY "DateStart"')
+        records = get_cache().records(self.cnn, self.NetworkCode, self.StationCode)
 
-        if stninfo.ntuples() == 0:
+        if not records:
             if not self.allow_empty:
                 # allow no station info if explicitly requested by the user.
                 # Purpose: insert a station info for a new station!
                 raise pyStationInfoException('Could not find ANY valid station info entry for ' +
                                              self.NetworkCode + '.' + self.StationCode)
+            self.records = []
+            self.ends = []
             self.record_count = 0
             return False
         else:
-            for record in stninfo.dictresult():
-                self.records.append(StationInfoRecord(self.NetworkCode, self.StationCode, record))
+            self.records = records
+            self.ends = [record['DateEnd'].datetime() for record in records]
 
-            self.record_count = stninfo.ntuples()
+            if self.ends != sorted(self.ends):
+                # overlapping records: find_record has to search all of them
+                self.ends = []
+
+            self.record_count = len(records)
             return True
 
     def parse_station_info(self, stninfo_file_list):
@@ -260,13 +363,12 @@ class StationInfo(object):
         if record.HeightCode == 'DHARP':
             return record
         else:
-            htc = self.cnn.query_float('SELECT * FROM gamit_htc WHERE "AntennaCode" = \'%s\' AND "HeightCode" = \'%s\''
-                                       % (record.AntennaCode, record.HeightCode), as_dict=True)
+            htc = get_cache().height_code(self.cnn, record.AntennaCode, record.HeightCode)
 
-            if len(htc):
+            if htc is not None:
 
                 record.AntennaHeight = np.sqrt(np.square(float(record.AntennaHeight)) -
-                                               np.square(float(htc[0]['h_offset']))) - float(htc[0]['v_offset'])
+                                               np.square(float(htc['h_offset']))) - float(htc['v_offset'])
                 if record.Comments is not None:
                     record.Comments = record.Comments + '\nChanged from %s to DHARP by pyStationInfo.\n' \
                                       % record.HeightCode
@@ -345,6 +447,8 @@ class StationInfo(object):
         self.cnn.insert_event(event)
 
         self.cnn.delete('stationinfo', record.database())
+
+        get_cache().invalidate(self.NetworkCode, self.StationCode)
         self.load_stationinfo_records()
 
     def UpdateStationInfo(self, record, new_record):
@@ -387,6 +491,7 @@ class StationInfo(object):
             self.cnn.update('stationinfo', new_record.database(), NetworkCode=self.NetworkCode,
                             StationCode=self.StationCode, DateStart=new_record['DateStart'].datetime())
 
+            get_cache().invalidate(self.NetworkCode, self.StationCode)
             self.load_stationinfo_records()
 
     def InsertStationInfo(self, record):
@@ -489,6 +594,7 @@ class StationInfo(object):
                     self.cnn.insert_event(event)
 
                 # reload the records
+                get_cache().invalidate(self.NetworkCode, self.StationCode)
                 self.load_stationinfo_records()
             else:
                 raise pyStationInfoException('Record %s -> %s already exists in station.info' %
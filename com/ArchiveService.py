@@ -26,6 +26,7 @@ import dbConnection
 import pyStationInfo
 import pyArchiveStruct
 import pyPPP
+import pyStationIndex
 import pyBrdc
 import sys
 import os
@@ -49,16 +50,12 @@ cnn = None
 
 def insert_station_w_lock(cnn, StationCode, filename, lat, lon, h, x, y, z, otl):
 
-    rs = cnn.query("""
-SELECT * FROM
-    (SELECT *, 2*asin(sqrt(sin((radians(%.8f)-radians(lat))/2)^2 + 
-    cos(radians(lat)) * cos(radians(%.8f)) * sin((radians(%.8f)-radians(lon))/2)^2))*6371000 AS distance
-        FROM stations WHERE "NetworkCode" like \'?%%\' AND "StationCode" = \'%s\') as DD
-    WHERE distance <= 100
-                    """ % (lat, lat, lon, StationCode))
+    # stations in temporary networks with the same station code within 100 m
+    match = [stn for stn in pyStationIndex.get_index(cnn).within(lat, lon, 100, search_in_new=True)
+             if stn['NetworkCode'].startswith('?') and stn['StationCode'] == StationCode]
 
-    if not rs.ntuples() == 0:
-        NetworkCode = rs.dictresult()[0]['NetworkCode']
+    if match:
+        NetworkCode = match[0]['NetworkCode']
         # if it's a record that was found, update the locks with the station code
         cnn.update('locks', {'filename': filename}, NetworkCode=NetworkCode, StationCode=StationCode)
     else:
@@ -106,6 +103,9 @@ SELECT * FROM
         cnn.update('locks', {'filename': filename}, NetworkCode=NetworkCode, StationCode=StationCode)
         cnn.commit_transac()
 
+        # the new station has to be visible to the next spatial searches
+        pyStationIndex.refresh(cnn)
+
 
 def callback_handle(job):
 
@@ -113,43 +113,44 @@ def callback_handle(job):
     global repository_data_in
 
     if job.result is not None:
-        out_message = job.result[0]
-        new_station = job.result[1]
-
-        if out_message:
-            tqdm.write(' -- There were unhandled errors during this batch. '
-                       'Please check errors_pyArchiveService.log for details')
-
-            # function to print any error that are encountered during parallel execution
-            f = open('errors_pyArchiveService.log', 'a')
-            f.write('ON ' + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ' an unhandled error occurred:\n')
-            f.write(out_message + '\n')
-            f.write('END OF ERROR =================== \n\n')
-            f.close()
-
-        if new_station:
-            tqdm.write(' -- New stations were found in the repository. Please assign a network to each new station '
-                       'and remove the locks from the files before running again ArchiveService')
-
-            # check the distance w.r.t the current new stations
-
-            StationCode = new_station[0]
-            x = new_station[1][0]
-            y = new_station[1][1]
-            z = new_station[1][2]
-            otl = new_station[2]
-            lat = new_station[3][0]
-            lon = new_station[3][1]
-            h = new_station[3][2]
-
-            filename = os.path.relpath(new_station[4], repository_data_in)
-
-            # logic behind this sql sentence:
-            # we are searching for a station within 100 meters that has been recently added, so NetworkCode = ???
-            # we also force the StationName to be equal to that of the incoming RINEX to avoid having problems with
-            # stations that are within 100 m (misidentifying IGM1 for IGM0, for example).
-            # This logic assumes that stations within 100 m do not have the same name!
-            insert_station_w_lock(cnn, StationCode, filename, lat, lon, h, x, y, z, otl)
+        # one result for each file processed by process_crinex_station
+        for out_message, new_station in job.result:
+
+            if out_message:
+                tqdm.write(' -- There were unhandled errors during this batch. '
+                           'Please check errors_pyArchiveService.log for details')
+
+                # function to print any error that are encountered during parallel execution
+                f = open('errors_pyArchiveService.log', 'a')
+                f.write('ON ' + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') +
+                        ' an unhandled error occurred:\n')
+                f.write(out_message + '\n')
+                f.write('END OF ERROR =================== \n\n')
+                f.close()
+
+            if new_station:
+                tqdm.write(' -- New stations were found in the repository. Please assign a network to each new '
+                           'station and remove the locks from the files before running again ArchiveService')
+
+                # check the distance w.r.t the current new stations
+
+                StationCode = new_station[0]
+                x = new_station[1][0]
+                y = new_station[1][1]
+                z = new_station[1][2]
+                otl = new_station[2]
+                lat = new_station[3][0]
+                lon = new_station[3][1]
+                h = new_station[3][2]
+
+                filename = os.path.relpath(new_station[4], repository_data_in)
+
+                # logic behind this sql sentence:
+                # we are searching for a station within 100 meters that has been recently added, so NetworkCode = ???
+                # we also force the StationName to be equal to that of the incoming RINEX to avoid having problems
+                # with stations that are within 100 m (misidentifying IGM1 for IGM0, for example).
+                # This logic assumes that stations within 100 m do not have the same name!
+                insert_station_w_lock(cnn, StationCode, filename, lat, lon, h, x, y, z, otl)
 
     elif job.exception:
         tqdm.write(' -- There were unhandled errors during this batch. '
@@ -290,8 +291,8 @@ def process_crinex_file(crinez, filename, data_rejected, data_retry):
     reject_folder = os.path.join(data_rejected, str(uuid.uuid4()))
 
     try:
-        cnn = dbConnection.Cnn("gnss_data.cfg")
-        Config = pyOptions.ReadOptions("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
+        Config = pyOptions.get_options("gnss_data.cfg")
         archive = pyArchiveStruct.RinexStruct(cnn)
         # apply local configuration (path to repo) in the executing node
         crinez = os.path.join(Config.repository_data_in, crinez)
@@ -624,6 +625,37 @@ def process_crinex_file(crinez, filename, data_rejected, data_retry):
     return None, None
 
 
+def process_crinex_station(crinez_files, data_rejected, data_retry):
+    """
+    process all the files of a station in the repository (one job per station): the files of a station are processed
+    sequentially, which avoids parallel inserts of the same station in the db
+    :param crinez_files: list of (crinez, filename) with the path (relative to data_in) and name of each file
+    :return: list with the result of process_crinex_file for each file
+    """
+    return [process_crinex_file(crinez, filename, data_rejected, data_retry) for crinez, filename in crinez_files]
+
+
+def group_crinex_files(rpaths, files, locks, stations):
+    """
+    remove the locked files from the files found in the repository and group the rest by station code
+    :param rpaths: paths of the files relative to data_in
+    :param files: names of the files
+    :param locks: set of the filenames in the locks table (relative to data_in)
+    :param stations: set of the station codes in the stations table
+    :return: list of (StationCode, [(path, file), ...]) with the stations that exist in the db first
+    """
+    groups = dict()
+
+    for rpath, sfile in zip(rpaths, files):
+        if rpath not in locks:
+            groups.setdefault(sfile[0:4].lower(), []).append((rpath, sfile))
+
+    for crinez_files in groups.values():
+        crinez_files.sort()
+
+    return sorted(groups.items(), key=lambda group: (group[0] not in stations, group[0]))
+
+
 def remove_empty_folders(folder):
 
     for dirpath, _, files in os.walk(folder, topdown=False):  # Listing the files
@@ -773,43 +805,37 @@ def main():
     # take a break to allow the FS to finish the task
     time.sleep(5)
 
-    files_path = []
-    files_list = []
-
     pbar = tqdm(desc='%-30s' % ' >> Repository crinez scan', ncols=160)
 
     rpaths, _, files = archive.scan_archive_struct(data_in, pbar)
 
     pbar.close()
 
-    pbar = tqdm(desc='%-30s' % ' -- Checking the locks table', total=len(files), ncols=130, unit='crz')
+    # the station codes in the db (files of new stations are sent last)
+    stations = set([record[0] for record in cnn.query('SELECT "StationCode" FROM stations').getresult()])
 
-    for file, path in zip(files, rpaths):
-        pbar.set_postfix(crinez=file)
-        pbar.update()
-        if path not in [lock['filename'] for lock in locks]:
-            files_path.append(path)
-            files_list.append(file)
-
-    pbar.close()
+    groups = group_crinex_files(rpaths, files, set([lock['filename'] for lock in locks]), stations)
 
     tqdm.write(" -- Found %i files in the lock list..." % (len(locks)))
-    tqdm.write(" -- Found %i files (matching format [stnm][doy][s].[yy]d.Z) to process..." % (len(files_list)))
+    tqdm.write(" -- Found %i files (matching format [stnm][doy][s].[yy]d.Z) to process from %i stations "
+               "(%i not in the database)..." % (sum([len(group[1]) for group in groups]), len(groups),
+                                                len([group for group in groups if group[0] not in stations])))
 
-    pbar = tqdm(desc='%-30s' % ' >> Processing repository', total=len(files_path), ncols=160, unit='crz')
+    pbar = tqdm(desc='%-30s' % ' >> Processing repository', total=len(groups), ncols=160, unit='stn')
 
     # dependency functions
-    depfuncs = (check_rinex_timespan_int, write_error, error_handle, insert_data, verify_rinex_multiday)
+    depfuncs = (check_rinex_timespan_int, write_error, error_handle, insert_data, verify_rinex_multiday,
+                process_crinex_file)
     # import modules
     modules = ('pyRinex', 'pyArchiveStruct', 'pyOTL', 'pyPPP', 'pyStationInfo', 'dbConnection', 'Utils', 'os',
                'uuid', 'datetime', 'pyDate', 'numpy', 'traceback', 'platform', 'pyBrdc', 'pyProducts',
                'pyOptions', 'pyEvents')
 
-    JobServer.create_cluster(process_crinex_file, depfuncs, callback_handle, pbar, modules=modules)
+    JobServer.create_cluster(process_crinex_station, depfuncs, callback_handle, pbar, modules=modules)
 
-    for file_to_process, sfile in zip(files_path, files_list):
+    for _, crinez_files in groups:
 
-        JobServer.submit(file_to_process, sfile, data_reject, data_in_retry)
+        JobServer.submit(crinez_files, data_reject, data_in_retry)
 
     JobServer.wait()
 
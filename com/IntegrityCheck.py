@@ -51,7 +51,7 @@ def stnrnx_callback(job):
 def compare_stninfo_rinex(NetworkCode, StationCode, STime, ETime, rinex_serial):
 
     try:
-        cnn = dbConnection.Cnn("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
     except Exception:
         return traceback.format_exc() + ' open de database when processing ' \
                                          'processing %s.%s' % (NetworkCode, StationCode), None
@@ -94,8 +94,8 @@ def check_rinex_stn(NetworkCode, StationCode, start_date, end_date):
     # load the connection
     try:
         # try to open a connection to the database
-        cnn = dbConnection.Cnn("gnss_data.cfg")
-        Config = pyOptions.ReadOptions("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
+        Config = pyOptions.get_options("gnss_data.cfg")
     except Exception:
         return traceback.format_exc() + ' processing: (' + NetworkCode + '.' + StationCode \
                 + ') using node ' + platform.node(), None
@@ -8,6 +8,7 @@ Type python pyPlotETM.py -h for usage help
 """
 import pyETM
 import pyOptions
+import pyJobServer
 import argparse
 import dbConnection
 import os
@@ -16,13 +17,18 @@ import json
 import Utils
 from Utils import process_date
 from itertools import repeat
-import numpy as np
+from tqdm import tqdm
+import numpy
 import pyDate
+import matplotlib
+
+# messages and error of each station (NetworkCode, StationCode)
+results = dict()
 
 
 def from_file(args, cnn, stn):
     # execute on a file with wk XYZ coordinates
-    ts = np.genfromtxt(args.filename)
+    ts = numpy.genfromtxt(args.filename)
 
     # read the format options
     if args.format is None:
@@ -47,7 +53,7 @@ def from_file(args, cnn, stn):
 
     dd = [pyDate.Date(**d) for d in dd]
 
-    polyhedrons = np.array((x, y, z, [d.year for d in dd], [d.doy for d in dd])).transpose()
+    polyhedrons = numpy.array((x, y, z, [d.year for d in dd], [d.doy for d in dd])).transpose()
 
     soln = pyETM.ListSoln(cnn, polyhedrons.tolist(), stn['NetworkCode'], stn['StationCode'])
     etm = pyETM.FileETM(cnn, soln, False, args.no_model)
@@ -55,6 +61,118 @@ def from_file(args, cnn, stn):
     return etm
 
 
+def callback_handle(job):
+
+    global results
+
+    # the jobs finish in any order: the results are printed in the order of the station list after wait
+    if job.result is not None:
+        results[tuple(job.args[0:2])] = job.result
+    else:
+        results[tuple(job.args[0:2])] = ([], str(job.exception))
+
+
+def plot_etm(NetworkCode, StationCode, args, dates):
+    """
+    obtain the ETM of a station and write the plots, JSON file and query requested in args. Executed by the JobServer:
+    each process uses its own database connection and, unless in interactive mode, the Agg backend
+    :return: the messages to print and the error message (None if the station was processed)
+    """
+    messages = []
+    stn = {'NetworkCode': NetworkCode, 'StationCode': StationCode}
+
+    try:
+        if not args.interactive:
+            # plots are only saved to files
+            matplotlib.use('Agg')
+
+        cnn = dbConnection.get_connection('gnss_data.cfg')
+
+        # define the language
+        pyETM.LANG = args.language.lower()
+
+        if args.gamit is None and args.filename is None:
+            etm = pyETM.PPPETM(cnn, NetworkCode, StationCode, False, args.no_model)
+        elif args.filename is not None:
+            etm = from_file(args, cnn, stn)
+        else:
+            etm = pyETM.GamitETM(cnn, NetworkCode, StationCode, False, args.no_model, stack_name=args.gamit[0])
+
+            # print two largest outliers
+            if etm.A is not None:
+                lres = numpy.sqrt(numpy.sum(numpy.square(etm.R), axis=0))
+                slres = lres[numpy.argsort(-lres)]
+
+                messages.append(' >> Two largest residuals:')
+                for i in [0, 1]:
+                    messages.append(' %s %6.3f %6.3f %6.3f'
+                                    % (pyDate.Date(mjd=etm.soln.mjd[lres == slres[i]]).yyyyddd(),
+                                       etm.R[0, lres == slres[i]],
+                                       etm.R[1, lres == slres[i]],
+                                       etm.R[2, lres == slres[i]]))
+
+        if args.interactive:
+            xfile = None
+        else:
+            if args.gamit is None:
+                if args.filename is None:
+                    xfile = os.path.join(args.directory, '%s.%s_ppp' % (etm.NetworkCode, etm.StationCode))
+                else:
+                    xfile = os.path.join(args.directory, '%s.%s_file' % (etm.NetworkCode, etm.StationCode))
+            else:
+                xfile = os.path.join(args.directory, '%s.%s_gamit' % (etm.NetworkCode, etm.StationCode))
+
+        # leave pngfile empty to enter interactive mode (GUI)
+        if not args.no_plots:
+            etm.plot(xfile + '.png' if xfile else None, t_win=dates, residuals=args.residuals,
+                     plot_missing=not args.no_missing_data, plot_outliers=args.plot_outliers)
+
+            if args.histogram:
+                etm.plot_hist(xfile + '_hist.png' if xfile else None)
+
+        if args.json is not None:
+            with open(xfile + '.json', 'w') as f:
+                if args.json == 1:
+                    json.dump(etm.todictionary(time_series=True), f, indent=4, sort_keys=False)
+                elif args.json == 2:
+                    json.dump(etm.todictionary(time_series=True, model=True), f, indent=4, sort_keys=False)
+                else:
+                    json.dump(etm.todictionary(False), f, indent=4, sort_keys=False)
+
+        if args.query is not None:
+            model = True if args.query[0] == 'model' else False
+            q_date = pyDate.Date(fyear=float(args.query[1]))
+
+            xyz, _, _, txt = etm.get_xyz_s(q_date.year, q_date.doy, force_model=model)
+
+            strp = ''
+            # if user requests velocity too, output it
+            if args.velocity:
+                if etm.A is not None:
+                    vxyz = etm.rotate_2xyz(etm.Linear.p.params[:, 1])
+                    strp = '%8.5f %8.5f %8.5f ' \
+                           % (vxyz[0, 0], vxyz[1, 0], vxyz[2, 0])
+
+            # also output seasonal terms, if requested
+            if args.seasonal_terms:
+                if etm.Periodic.frequency_count > 0:
+                    strp += ' '.join(['%8.5f' % (x * 1000) for x in etm.Periodic.p.params.flatten().tolist()])
+
+            messages.append(' %s.%s %14.5f %14.5f %14.5f %8.3f %s -> %s'
+                            % (etm.NetworkCode, etm.StationCode, xyz[0], xyz[1], xyz[2], q_date.fyear, strp, txt))
+
+        messages.append('Successfully plotted ' + NetworkCode + '.' + StationCode)
+
+        return messages, None
+
+    except pyETM.pyETMException as e:
+        return messages, str(e)
+
+    except Exception:
+        return messages, 'Error during processing of ' + NetworkCode + '.' + StationCode + '\n' + \
+               traceback.format_exc()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Plot ETM for stations in the database')
 
@@ -102,8 +220,12 @@ def main():
     parser.add_argument('-seasonal', '--seasonal_terms', action='store_true',
                         help="During query, output the seasonal terms in NEU.")
 
+    parser.add_argument('-np', '--noparallel', action='store_true', help="Execute command without parallelization.")
+
     args = parser.parse_args()
 
+    Config = pyOptions.ReadOptions('gnss_data.cfg')
+
     cnn = dbConnection.Cnn('gnss_data.cfg')
 
     if len(args.stnlist) == 1 and os.path.isfile(args.stnlist[0]):
@@ -142,102 +264,49 @@ def main():
                 os.mkdir('production')
             args.directory = 'production'
 
+        # the jobs might not run in this directory
+        args.directory = os.path.abspath(args.directory)
+
+        modules = ('pyETM', 'pyDate', 'dbConnection', 'numpy', 'os', 'json', 'traceback', 'matplotlib')
+
+        # the interactive mode needs the display of this process
+        JobServer = pyJobServer.JobServer(Config, run_parallel=not args.noparallel and not args.interactive)
+
+        if args.filename is None and not args.no_model and not (JobServer.run_parallel or JobServer.run_local):
+            # load the stored parameters of all the stations at once
+            if args.gamit is None:
+                pyETM.get_cache().prefetch_parameters(cnn, stnlist)
+            else:
+                pyETM.get_cache().prefetch_parameters(cnn, stnlist, 'gamit', args.gamit[0])
+
+        pbar = tqdm(total=len(stnlist), ncols=160, desc=' >> Plotting ETMs', disable=args.interactive)
+
+        JobServer.create_cluster(plot_etm, (from_file,), callback_handle, pbar, modules=modules)
+
         for stn in stnlist:
-            try:
+            JobServer.submit(stn['NetworkCode'], stn['StationCode'], args, dates)
 
-                if args.gamit is None and args.filename is None:
-                    etm = pyETM.PPPETM(cnn, stn['NetworkCode'], stn['StationCode'], False, args.no_model)
-                elif args.filename is not None:
-                    etm = from_file(args, cnn, stn)
-                else:
-                    polyhedrons = cnn.query_float('SELECT "X", "Y", "Z", "Year", "DOY" FROM stacks '
-                                                  'WHERE "name" = \'%s\' AND "NetworkCode" = \'%s\' AND '
-                                                  '"StationCode" = \'%s\' '
-                                                  'ORDER BY "Year", "DOY", "NetworkCode", "StationCode"'
-                                                  % (args.gamit[0], stn['NetworkCode'], stn['StationCode']))
-
-                    soln = pyETM.GamitSoln(cnn, polyhedrons, stn['NetworkCode'], stn['StationCode'], args.gamit[0])
-
-                    etm = pyETM.GamitETM(cnn, stn['NetworkCode'], stn['StationCode'], False,
-                                         args.no_model, gamit_soln=soln)
-
-                    # print ' > %5.2f %5.2f %5.2f %i %i' % \
-                    #      (etm.factor[0]*1000, etm.factor[1]*1000, etm.factor[2]*1000, etm.soln.t.shape[0],
-                    #       etm.soln.t.shape[0] -
-                    #       np.sum(np.logical_and(np.logical_and(etm.F[0], etm.F[1]), etm.F[2])))
-
-                    # print two largest outliers
-                    if etm.A is not None:
-                        lres = np.sqrt(np.sum(np.square(etm.R), axis=0))
-                        slres = lres[np.argsort(-lres)]
-
-                        print ' >> Two largest residuals:'
-                        for i in [0, 1]:
-                            print(' %s %6.3f %6.3f %6.3f'
-                                  % (pyDate.Date(mjd=etm.soln.mjd[lres == slres[i]]).yyyyddd(),
-                                     etm.R[0, lres == slres[i]],
-                                     etm.R[1, lres == slres[i]],
-                                     etm.R[2, lres == slres[i]]))
-
-                if args.interactive:
-                    xfile = None
-                else:
-                    if args.gamit is None:
-                        if args.filename is None:
-                            xfile = os.path.join(args.directory, '%s.%s_ppp' % (etm.NetworkCode, etm.StationCode))
-                        else:
-                            xfile = os.path.join(args.directory, '%s.%s_file' % (etm.NetworkCode, etm.StationCode))
-                    else:
-                        xfile = os.path.join(args.directory, '%s.%s_gamit' % (etm.NetworkCode, etm.StationCode))
-
-                # leave pngfile empty to enter interactive mode (GUI)
-                if not args.no_plots:
-                    etm.plot(xfile + '.png', t_win=dates, residuals=args.residuals,
-                             plot_missing=not args.no_missing_data, plot_outliers=args.plot_outliers)
-
-                    if args.histogram:
-                        etm.plot_hist(xfile + '_hist.png')
-
-                if args.json is not None:
-                    with open(xfile + '.json', 'w') as f:
-                        if args.json == 1:
-                            json.dump(etm.todictionary(time_series=True), f, indent=4, sort_keys=False)
-                        elif args.json == 2:
-                            json.dump(etm.todictionary(time_series=True, model=True), f, indent=4, sort_keys=False)
-                        else:
-                            json.dump(etm.todictionary(False), f, indent=4, sort_keys=False)
-
-                if args.query is not None:
-                    model = True if args.query[0] == 'model' else False
-                    q_date = pyDate.Date(fyear=float(args.query[1]))
-
-                    xyz, _, _, txt = etm.get_xyz_s(q_date.year, q_date.doy, force_model=model)
-
-                    strp = ''
-                    # if user requests velocity too, output it
-                    if args.velocity:
-                        if etm.A is not None:
-                            vxyz = etm.rotate_2xyz(etm.Linear.p.params[:, 1])
-                            strp = '%8.5f %8.5f %8.5f ' \
-                                   % (vxyz[0, 0], vxyz[1, 0], vxyz[2, 0])
-
-                    # also output seasonal terms, if requested
-                    if args.seasonal_terms:
-                        if etm.Periodic.frequency_count > 0:
-                            strp += ' '.join(['%8.5f' % (x * 1000) for x in etm.Periodic.p.params.flatten().tolist()])
-
-                    print ' %s.%s %14.5f %14.5f %14.5f %8.3f %s -> %s' \
-                          % (etm.NetworkCode, etm.StationCode, xyz[0], xyz[1], xyz[2], q_date.fyear, strp, txt)
-
-                print 'Successfully plotted ' + stn['NetworkCode'] + '.' + stn['StationCode']
-
-            except pyETM.pyETMException as e:
-                print str(e)
-
-            except Exception:
-                print 'Error during processing of ' + stn['NetworkCode'] + '.' + stn['StationCode']
-                print traceback.format_exc()
-                pass
+        # wait returns after the callbacks of all the jobs were executed
+        JobServer.wait()
+
+        pbar.close()
+
+        JobServer.close_cluster()
+
+        errors = 0
+
+        for stn in stnlist:
+            messages, error = results.get((stn['NetworkCode'], stn['StationCode']), ([], None))
+
+            for message in messages:
+                print message
+
+            if error is not None:
+                print error
+                errors += 1
+
+        if errors:
+            print ' >> Errors were encountered while processing %i station(s)' % errors
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ Type python pyPlotETM.py -h for usage help
 """
 import pyETM
 import pyOptions
+import pyJobServer
 import argparse
 import dbConnection
 import os
@@ -16,13 +17,17 @@ import json
 import Utils
 from Utils import process_date
 from itertools import repeat
-import numpy as np
+from tqdm import tqdm
+import numpy
 import pyDate
 
+# messages and error of each station (NetworkCode, StationCode)
+results = dict()
+
 
 def from_file(args, cnn, stn):
     # execute on a file with wk XYZ coordinates
-    ts = np.genfromtxt(args.filename)
+    ts = numpy.genfromtxt(args.filename)
 
     # read the format options
     if args.format is None:
@@ -47,7 +52,7 @@ def from_file(args, cnn, stn):
 
     dd = [pyDate.Date(**d) for d in dd]
 
-    polyhedrons = np.array((x, y, z, [d.year for d in dd], [d.doy for d in dd])).transpose()
+    polyhedrons = numpy.array((x, y, z, [d.year for d in dd], [d.doy for d in dd])).transpose()
 
     soln = pyETM.ListSoln(cnn, polyhedrons.tolist(), stn['NetworkCode'], stn['StationCode'])
     etm = pyETM.FileETM(cnn, soln, False, args.no_model)
@@ -55,6 +60,69 @@ def from_file(args, cnn, stn):
     return etm
 
 
+def callback_handle(job):
+
+    global results
+
+    # the jobs finish in any order: the results are printed in the order of the station list after wait
+    if job.result is not None:
+        results[tuple(job.args[0:2])] = job.result
+    else:
+        results[tuple(job.args[0:2])] = ([], str(job.exception))
+
+
+def query_etm(NetworkCode, StationCode, args):
+    """
+    obtain the ETM of a station and run the query requested in args. Executed by the JobServer: each process uses its
+    own database connection
+    :return: the messages to print and the error message (None if the station was processed)
+    """
+    messages = []
+    stn = {'NetworkCode': NetworkCode, 'StationCode': StationCode}
+
+    try:
+        cnn = dbConnection.get_connection('gnss_data.cfg')
+
+        if args.gamit is None and args.filename is None:
+            etm = pyETM.PPPETM(cnn, NetworkCode, StationCode, False)
+        elif args.filename is not None:
+            etm = from_file(args, cnn, stn)
+        else:
+            etm = pyETM.GamitETM(cnn, NetworkCode, StationCode, False, stack_name=args.gamit[0])
+
+        if args.query is not None:
+            model = True if args.query[0] == 'model' else False
+            q_date = pyDate.Date(fyear=float(args.query[1]))
+
+            # get the coordinate
+            xyz, _, _, txt = etm.get_xyz_s(q_date.year, q_date.doy, force_model=model)
+
+            strp = ''
+            # if user requests velocity too, output it
+            if args.velocity:
+                if etm.A is not None:
+                    vxyz = etm.rotate_2xyz(etm.Linear.p.params[:, 1])
+                    strp = '%8.5f %8.5f %8.5f ' \
+                           % (vxyz[0, 0], vxyz[1, 0], vxyz[2, 0])
+
+            # also output seasonal terms, if requested
+            if args.seasonal_terms:
+                if etm.Periodic.frequency_count > 0:
+                    strp += ' '.join(['%8.5f' % (x * 1000) for x in etm.Periodic.p.params.flatten().tolist()])
+
+            messages.append(' %s.%s %14.5f %14.5f %14.5f %8.3f %s -> %s'
+                            % (etm.NetworkCode, etm.StationCode, xyz[0], xyz[1], xyz[2], q_date.fyear, strp, txt))
+
+        return messages, None
+
+    except pyETM.pyETMException as e:
+        return messages, None if args.quiet else str(e)
+
+    except Exception:
+        return messages, 'Error during processing of ' + NetworkCode + '.' + StationCode + '\n' + \
+               traceback.format_exc()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Query ETM for stations in the database. Default is PPP ETMs.')
 
@@ -81,8 +149,12 @@ def main():
     parser.add_argument('-seasonal', '--seasonal_terms', action='store_true',
                         help="Output the seasonal terms in NEU.")
 
+    parser.add_argument('-np', '--noparallel', action='store_true', help="Execute command without parallelization.")
+
     args = parser.parse_args()
 
+    Config = pyOptions.ReadOptions('gnss_data.cfg')
+
     cnn = dbConnection.Cnn('gnss_data.cfg')
 
     if len(args.stnlist) == 1 and os.path.isfile(args.stnlist[0]):
@@ -94,55 +166,45 @@ def main():
 
     if stnlist:
 
+        modules = ('pyETM', 'pyDate', 'dbConnection', 'numpy', 'traceback')
+
+        JobServer = pyJobServer.JobServer(Config, run_parallel=not args.noparallel)
+
+        if args.filename is None and not (JobServer.run_parallel or JobServer.run_local):
+            # load the stored parameters of all the stations at once
+            if args.gamit is None:
+                pyETM.get_cache().prefetch_parameters(cnn, stnlist)
+            else:
+                pyETM.get_cache().prefetch_parameters(cnn, stnlist, 'gamit', args.gamit[0])
+
+        pbar = tqdm(total=len(stnlist), ncols=160, desc=' >> Querying ETMs')
+
+        JobServer.create_cluster(query_etm, (from_file,), callback_handle, pbar, modules=modules)
+
         for stn in stnlist:
-            try:
-
-                if args.gamit is None and args.filename is None:
-                    etm = pyETM.PPPETM(cnn, stn['NetworkCode'], stn['StationCode'], False)
-                elif args.filename is not None:
-                    etm = from_file(args, cnn, stn)
-                else:
-                    polyhedrons = cnn.query_float('SELECT "X", "Y", "Z", "Year", "DOY" FROM stacks '
-                                                  'WHERE "name" = \'%s\' AND "NetworkCode" = \'%s\' AND '
-                                                  '"StationCode" = \'%s\' '
-                                                  'ORDER BY "Year", "DOY", "NetworkCode", "StationCode"'
-                                                  % (args.gamit[0], stn['NetworkCode'], stn['StationCode']))
-
-                    soln = pyETM.GamitSoln(cnn, polyhedrons, stn['NetworkCode'], stn['StationCode'], args.gamit[0])
-
-                    etm = pyETM.GamitETM(cnn, stn['NetworkCode'], stn['StationCode'], False, gamit_soln=soln)
-
-                if args.query is not None:
-                    model = True if args.query[0] == 'model' else False
-                    q_date = pyDate.Date(fyear=float(args.query[1]))
-
-                    # get the coordinate
-                    xyz, _, _, txt = etm.get_xyz_s(q_date.year, q_date.doy, force_model=model)
-
-                    strp = ''
-                    # if user requests velocity too, output it
-                    if args.velocity:
-                        if etm.A is not None:
-                            vxyz = etm.rotate_2xyz(etm.Linear.p.params[:, 1])
-                            strp = '%8.5f %8.5f %8.5f ' \
-                                   % (vxyz[0, 0], vxyz[1, 0], vxyz[2, 0])
-
-                    # also output seasonal terms, if requested
-                    if args.seasonal_terms:
-                        if etm.Periodic.frequency_count > 0:
-                            strp += ' '.join(['%8.5f' % (x * 1000) for x in etm.Periodic.p.params.flatten().tolist()])
-
-                    print ' %s.%s %14.5f %14.5f %14.5f %8.3f %s -> %s' \
-                          % (etm.NetworkCode, etm.StationCode, xyz[0], xyz[1], xyz[2], q_date.fyear, strp, txt)
-
-            except pyETM.pyETMException as e:
-                if not args.quiet:
-                    print str(e)
-
-            except Exception:
-                print 'Error during processing of ' + stn['NetworkCode'] + '.' + stn['StationCode']
-                print traceback.format_exc()
-                pass
+            JobServer.submit(stn['NetworkCode'], stn['StationCode'], args)
+
+        # wait returns after the callbacks of all the jobs were executed
+        JobServer.wait()
+
+        pbar.close()
+
+        JobServer.close_cluster()
+
+        errors = 0
+
+        for stn in stnlist:
+            messages, error = results.get((stn['NetworkCode'], stn['StationCode']), ([], None))
+
+            for message in messages:
+                print message
+
+            if error is not None:
+                print error
+                errors += 1
+
+        if errors:
+            print ' >> Errors were encountered while processing %i station(s)' % errors
 
 
 if __name__ == '__main__':
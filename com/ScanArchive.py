@@ -77,6 +77,8 @@ import pySp3
 import pyBrdc
 import pyClk
 import pyPPP
+import pyStationIndex
+import pyScanIndex
 from tqdm import tqdm
 import argparse
 import numpy
@@ -88,7 +90,6 @@ from Utils import print_columns
 from Utils import process_date
 from Utils import ecef2lla
 import pyEvents
-import scandir
 import json
 import shutil
 import glob
@@ -98,6 +99,12 @@ import zipfile
 
 error_message = False
 
+# files of the archive scan that were processed without errors by try_insert
+processed_files = set()
+
+# files checked against the rinex table with each query during the archive scan
+SCAN_BATCH = 1000
+
 
 class Encoder(json.JSONEncoder):
     def default(self, o):
@@ -138,6 +145,16 @@ def callback_handle(job):
         f.close()
 
 
+def scan_callback_handle(job):
+    global processed_files
+
+    callback_handle(job)
+
+    if job.result is None and not job.exception:
+        # the rinex path
+        processed_files.add(job.args[4])
+
+
 def verify_rinex_date_multiday(cnn, date, rinexinfo, Config):
     # function to verify if rinex is multiday or if the file is from the date it was stored in the archive
     # returns true if parent process can continue with insert
@@ -199,8 +216,8 @@ def try_insert(NetworkCode, StationCode, year, doy, rinex):
 
     try:
         # try to open a connection to the database
-        cnn = dbConnection.Cnn("gnss_data.cfg")
-        Config = pyOptions.ReadOptions("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
+        Config = pyOptions.get_options("gnss_data.cfg")
 
         # get the rejection directory ready
         data_reject = os.path.join(Config.repository_data_reject, 'bad_rinex/%i/%03i' % (year, doy))
@@ -311,8 +328,8 @@ def obtain_otl(NetworkCode, StationCode):
     z = []
 
     try:
-        cnn = dbConnection.Cnn("gnss_data.cfg")
-        Config = pyOptions.ReadOptions("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
+        Config = pyOptions.get_options("gnss_data.cfg")
 
         pyArchive = pyArchiveStruct.RinexStruct(cnn)
 
@@ -423,6 +440,9 @@ def obtain_otl(NetworkCode, StationCode):
                       'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
                       % (x, y, z, lat[0], lon[0], h[0], coeff, NetworkCode, StationCode))
 
+            # the station moved: reload the spatial index of this process
+            pyStationIndex.refresh(cnn)
+
         else:
             outmsg = 'Could not obtain a coordinate/otl coefficients for ' + NetworkCode + ' ' + StationCode + \
                      ' after 20 tries. Maybe there where few valid RINEX files or could not find an ephemeris file. ' \
@@ -449,7 +469,7 @@ def insert_stninfo(NetworkCode, StationCode, stninfofile):
     errors = []
 
     try:
-        cnn = dbConnection.Cnn("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
 
     except Exception:
 
@@ -519,9 +539,9 @@ def execute_ppp(record, rinex_path, h_tolerance):
 
     try:
         # try to open a connection to the database
-        cnn = dbConnection.Cnn("gnss_data.cfg")
+        cnn = dbConnection.get_connection("gnss_data.cfg")
 
-        Config = pyOptions.ReadOptions("gnss_data.cfg")
+        Config = pyOptions.get_options("gnss_data.cfg")
 
     except Exception:
         return traceback.format_exc() + ' processing rinex: %s.%s %s %s using node %s' \
@@ -649,38 +669,58 @@ def execute_ppp(record, rinex_path, h_tolerance):
                    % (NetworkCode, StationCode, str(year), str(doy), platform.node())
 
 
-def post_scan_rinex_job(cnn, Archive, rinex_file, rinexpath, master_list, JobServer, ignore):
+def post_scan_rinex_job(cnn, rinex_files, networks, stations, JobServer):
+    """
+    submit the files that are not in the rinex table yet (checked with one query for all the files)
+    :param rinex_files: list of (NetworkCode, StationCode, year, doy, path) of the files found by the scan
+    :param networks: set of the networks in the db (updated with the networks inserted)
+    :param stations: set of the stations (net.stnm) in the db (updated with the stations inserted)
+    :return: list of the paths of the files submitted
+    """
+    submitted = []
 
-    valid, result = Archive.parse_archive_keys(rinex_file, key_filter=('network', 'station', 'year', 'doy'))
+    if not rinex_files:
+        return submitted
 
-    if valid:
+    rs = cnn.query('SELECT "NetworkCode", "StationCode", "Filename" FROM rinex WHERE '
+                   '("NetworkCode", "StationCode", "Filename") IN (VALUES %s)'
+                   % ', '.join(['(\'%s\', \'%s\', \'%s\')'
+                                % (NetworkCode, StationCode, os.path.basename(rinexpath).replace('d.Z', 'o'))
+                                for NetworkCode, StationCode, _, _, rinexpath in rinex_files]))
 
-        NetworkCode = result['network']
-        StationCode = result['station']
-        year = result['year']
-        doy = result['doy']
+    known = set([tuple(record) for record in rs.getresult()])
 
-        # check the master_list
-        if NetworkCode + '.' + StationCode in master_list or ignore:
-            # check existence of network in the db
-            rs = cnn.query('SELECT * FROM networks WHERE "NetworkCode" = \'%s\'' % NetworkCode)
-            if rs.ntuples() == 0:
-                cnn.insert('networks', NetworkCode=NetworkCode, NetworkName='UNK')
+    for NetworkCode, StationCode, year, doy, rinexpath in rinex_files:
 
-            # check existence of station in the db
-            rs = cnn.query('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
-                           % (NetworkCode, StationCode))
-            if rs.ntuples() == 0:
-                # run grdtab to get the OTL parameters in HARPOS format and insert then in the db
-                # use the current rinex to get an approximate coordinate
-                cnn.insert('stations', NetworkCode=NetworkCode, StationCode=StationCode)
+        if (NetworkCode, StationCode, os.path.basename(rinexpath).replace('d.Z', 'o')) in known:
+            continue
 
-            JobServer.submit(NetworkCode, StationCode, year, doy, rinexpath)
+        # check existence of network in the db
+        if NetworkCode not in networks:
+            cnn.insert('networks', NetworkCode=NetworkCode, NetworkName='UNK')
+            networks.add(NetworkCode)
 
+        # check existence of station in the db
+        if NetworkCode + '.' + StationCode not in stations:
+            # run grdtab to get the OTL parameters in HARPOS format and insert then in the db
+            # use the current rinex to get an approximate coordinate
+            cnn.insert('stations', NetworkCode=NetworkCode, StationCode=StationCode)
+            stations.add(NetworkCode + '.' + StationCode)
 
-def scan_rinex(cnn, JobServer, pyArchive, archive_path, master_list, ignore):
+        JobServer.submit_batch(NetworkCode, StationCode, year, doy, rinexpath)
+        submitted.append(rinexpath)
+
+    return submitted
 
-    master_list = [item['NetworkCode'] + '.' + item['StationCode'] for item in master_list]
+
+def scan_rinex(cnn, JobServer, pyArchive, archive_path, master_list, ignore, index_file=None, full=False):
+    """
+    scan the archive for RINEX files that are not in the database. Only the directories that changed since the last
+    scan (see pyScanIndex) are listed, and only the new or modified files are checked against the database
+    :param index_file: scan index file (pyScanIndex.INDEX_FILE if None)
+    :param full: list all the directories of the archive and check all the files (and rebuild the index)
+    """
+    master_list = set([item['NetworkCode'] + '.' + item['StationCode'] for item in master_list])
 
     print " >> Analyzing the archive's structure..."
     pbar = tqdm(ncols=80, unit='crz')
@@ -689,27 +729,65 @@ def scan_rinex(cnn, JobServer, pyArchive, archive_path, master_list, ignore):
     modules = ('dbConnection', 'pyDate', 'pyRinex', 'shutil', 'platform', 'datetime',
                'traceback', 'pyOptions', 'pyEvents', 'Utils', 'os')
 
-    JobServer.create_cluster(try_insert, dependencies=depfuncs, modules=modules, callback=callback_handle)
+    # try_insert is fast for files that are already in the db: send the files in batches
+    JobServer.create_cluster(try_insert, depfuncs, modules=modules, callback=scan_callback_handle, batch=True)
 
     if ignore[0] == 1:
         ignore = True
     else:
         ignore = False
 
-    for path, _, files in scandir.walk(archive_path):
-        for sfile in files:
-            # DDG issue #15: match the name of the file to a valid rinex filename
-            if pyArchive.parse_crinex_filename(sfile):
-                # only examine valid rinex compressed files
-                rnx = os.path.join(path, sfile).rsplit(archive_path + '/')[1]
-                path2rnx = os.path.join(path, sfile)
+    networks = set([record[0] for record in cnn.query('SELECT "NetworkCode" FROM networks').getresult()])
+    stations = set([record[0] + '.' + record[1] for record in
+                    cnn.query('SELECT "NetworkCode", "StationCode" FROM stations').getresult()])
+
+    index = pyScanIndex.ScanIndex(index_file if index_file else pyScanIndex.INDEX_FILE)
+
+    rinex_files = []
+    deferred = []
+    submitted = []
+    # files already found (two jobs inserting the same file would move the archived file to duplicate_insert)
+    found = set()
 
-                pbar.set_postfix(crinex=rnx)
-                pbar.update()
+    processed_files.clear()
 
-                post_scan_rinex_job(cnn, pyArchive, rnx, path2rnx, master_list, JobServer, ignore)
+    # DDG issue #15: match the name of the file to a valid rinex filename (only examine valid rinex compressed files)
+    for path2rnx, _, _ in index.walk(archive_path, pyArchive.parse_crinex_filename, full):
 
-        JobServer.wait()
+        if path2rnx in found:
+            continue
+
+        found.add(path2rnx)
+
+        rnx = path2rnx.rsplit(archive_path + '/')[1]
+
+        pbar.set_postfix(crinex=rnx)
+        pbar.update()
+
+        valid, result = pyArchive.parse_archive_keys(rnx, key_filter=('network', 'station', 'year', 'doy'))
+
+        if valid:
+            # check the master_list
+            if result['network'] + '.' + result['station'] in master_list or ignore:
+                rinex_files.append((result['network'], result['station'], result['year'], result['doy'], path2rnx))
+            else:
+                # report the file again when scanning with other stations
+                deferred.append(path2rnx)
+
+        if len(rinex_files) >= SCAN_BATCH:
+            submitted += post_scan_rinex_job(cnn, rinex_files, networks, stations, JobServer)
+            rinex_files = []
+
+    submitted += post_scan_rinex_job(cnn, rinex_files, networks, stations, JobServer)
+
+    if JobServer.wait():
+        # files with errors (or lost jobs) are reported again by the next scan
+        index.defer(deferred + [path for path in submitted if path not in processed_files])
+        index.commit()
+    else:
+        tqdm.write(' -- The scan was interrupted: the scan index was not updated')
+
+    index.close()
 
     # handle any output messages during this batch
     if error_message:
@@ -932,7 +1010,8 @@ def process_ppp(cnn, Config, pyArchive, archive_path, JobServer, master_list, sd
 
     depfuncs = (remove_from_archive, verify_rinex_date_multiday)
 
-    JobServer.create_cluster(execute_ppp, depfuncs, callback=callback_handle, progress_bar=pbar, modules=modules)
+    JobServer.create_cluster(execute_ppp, depfuncs, callback=callback_handle, progress_bar=pbar, modules=modules,
+                             batch=True)
 
     for record in tblrinex:
 
@@ -942,7 +1021,7 @@ def process_ppp(cnn, Config, pyArchive, archive_path, JobServer, master_list, sd
         # add the base dir
         rinex_path = os.path.join(archive_path, rinex_path)
 
-        JobServer.submit(record, rinex_path, h_tolerance)
+        JobServer.submit_batch(record, rinex_path, h_tolerance)
 
     JobServer.wait()
 
@@ -1239,6 +1318,12 @@ def main():
                              "archive will be checked (and added to the db if missing) even if networks and stations "
                              "don't exist. Networks and stations will be added if they don't exist.")
 
+    parser.add_argument('-full', '--full_scan', action='store_true',
+                        help="Used with -rinex: list every directory of the archive and check every file instead of "
+                             "only the directories that changed since the last scan (see scan_index in "
+                             "gnss_data.cfg). Use to find files modified in place or after errors during a "
+                             "previous scan.")
+
     parser.add_argument('-otl', '--ocean_loading', action='store_true',
                         help="Calculate ocean loading coefficients using FES2004. To calculate FES2014b coefficients, "
                              "use OTL_FES2014b.py")
@@ -1314,7 +1399,8 @@ def main():
     #########################################
 
     if args.rinex is not None:
-        scan_rinex(cnn, JobServer, pyArchive, Config.archive_path, stnlist, args.rinex)
+        scan_rinex(cnn, JobServer, pyArchive, Config.archive_path, stnlist, args.rinex, Config.options['scan_index'],
+                   args.full_scan)
 
     #########################################
 
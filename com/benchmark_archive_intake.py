@@ -0,0 +1,92 @@
+"""
+Project: Parallel.Archive
+
+Benchmark of the intake of ArchiveService (lock check and grouping of the files by station) using a synthetic data_in
+tree. The tree is created in a temporary folder (empty files) and removed at the end.
+
+usage: python benchmark_archive_intake.py [-files 100000] [-locks 5000] [-stations 1000]
+"""
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import pyArchiveStruct
+import ArchiveService
+
+
+def create_tree(root, files, stations):
+
+    codes = ['s%03i' % i for i in range(stations)]
+
+    for i in range(files):
+        year = 2000 + (i / (stations * 365)) % 20
+        doy = (i / stations) % 365 + 1
+
+        path = os.path.join(root, str(year), '%03i' % doy)
+        filename = '%s%03i0.%02id.Z' % (codes[i % stations], doy, year % 100)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        open(os.path.join(path, filename), 'w').close()
+
+    return codes
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark of the ArchiveService intake')
+
+    parser.add_argument('-files', '--files', type=int, default=100000, help="Number of files in data_in.")
+    parser.add_argument('-locks', '--locks', type=int, default=5000, help="Number of locked files.")
+    parser.add_argument('-stations', '--stations', type=int, default=1000, help="Number of stations.")
+
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+
+    try:
+        t = time.time()
+        codes = create_tree(root, args.files, args.stations)
+        print ' -- Created %i files in %.1f s' % (args.files, time.time() - t)
+
+        # same scan as RinexStruct.scan_archive_struct (without a database connection)
+        t = time.time()
+        rpaths = []
+        files = []
+        for path, _, sfiles in os.walk(root):
+            for sfile in sfiles:
+                if pyArchiveStruct.RinexStruct.parse_crinex_filename(sfile):
+                    files.append(sfile)
+                    rpaths.append(os.path.relpath(os.path.join(path, sfile), root))
+        print ' -- Scanned the tree in %.1f s' % (time.time() - t)
+
+        locks = [{'filename': rpath} for rpath in random.sample(rpaths, min(args.locks, len(rpaths)))]
+        stations = set(codes[0:len(codes) / 2])
+
+        # previous intake: the list of locks was built for every file (measured on a sample and extrapolated)
+        sample = min(2000, len(files))
+        t = time.time()
+        selected = [path for path in rpaths[0:sample] if path not in [lock['filename'] for lock in locks]]
+        old = (time.time() - t) * len(files) / float(sample)
+        print ' -- List based lock check: %.2f s (estimated from %i files)' % (old, sample)
+
+        t = time.time()
+        groups = ArchiveService.group_crinex_files(rpaths, files, set([lock['filename'] for lock in locks]),
+                                                   stations)
+        new = time.time() - t
+        print ' -- Set based lock check and grouping: %.2f s (%i files in %i jobs, %.0fx)' \
+              % (new, sum([len(group[1]) for group in groups]), len(groups), old / new if new else 0)
+
+        assert set(selected) <= set([crinez for group in groups for crinez, _ in group[1]])
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,96 @@
+"""
+Project: Parallel.Archive
+
+Micro-benchmark of the vectorized date conversions of pyDate (DateArray and the *_vec functions) against the scalar
+Date class, using the epochs of a synthetic daily time series (the same conversions done when building an ETM). The
+outputs of both are compared for every epoch.
+
+usage: python benchmark_dates.py [-epochs 9000] [-repeat 3]
+"""
+
+import time
+import argparse
+import numpy as np
+import pyDate
+
+
+def timed(function, repeat):
+    """
+    :return: result of function and the best run time of repeat runs
+    """
+    best = np.inf
+    result = None
+
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        best = min(best, time.time() - start)
+
+    return result, best
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compare the vectorized date conversions with the Date class')
+
+    parser.add_argument('-epochs', '--epochs', type=int, default=9000,
+                        help="Number of epochs (about 25 years of daily solutions).")
+    parser.add_argument('-repeat', '--repeat', type=int, default=3, help="Runs of each conversion (best is reported).")
+
+    args = parser.parse_args()
+
+    np.random.seed(0)
+
+    # daily epochs since 1995 with some gaps
+    mjd = np.sort(np.random.choice(np.arange(49718, 49718 + int(args.epochs * 1.1)), args.epochs, replace=False))
+    year, doy = pyDate.mjd2yeardoy_vec(mjd)
+    fyear = pyDate.yeardoy2fyear_vec(year, doy)
+    week, wkday = pyDate.mjd2gpsDate_vec(mjd)
+
+    fields = ('year', 'doy', 'month', 'day', 'fyear', 'mjd', 'gpsWeek', 'gpsWeekDay')
+
+    inputs = (('year, doy', lambda: [pyDate.Date(year=y, doy=d) for y, d in zip(year.tolist(), doy.tolist())],
+               lambda: pyDate.DateArray(year=year, doy=doy)),
+              ('mjd', lambda: [pyDate.Date(mjd=m) for m in mjd.tolist()],
+               lambda: pyDate.DateArray(mjd=mjd)),
+              ('fyear', lambda: [pyDate.Date(fyear=f) for f in fyear.tolist()],
+               lambda: pyDate.DateArray(fyear=fyear)),
+              ('gpsweek', lambda: [pyDate.Date(gpsWeek=w, gpsWeekDay=d) for w, d in zip(week.tolist(), wkday.tolist())],
+               lambda: pyDate.DateArray(gpsWeek=week, gpsWeekDay=wkday)))
+
+    failed = 0
+
+    print ' >> %i epochs (best of %i runs)' % (args.epochs, args.repeat)
+
+    for name, scalar, vector in inputs:
+        dates, elapsed_scalar = timed(scalar, args.repeat)
+        array, elapsed_vector = timed(vector, args.repeat)
+
+        mismatch = [f for f in fields if not np.allclose([getattr(d, f) for d in dates], getattr(array, f),
+                                                         rtol=0, atol=1e-9)]
+        failed += len(mismatch)
+
+        print ' %-10s: Date %8.4f s DateArray %8.4f s speedup %6.0fx %s' \
+              % (name, elapsed_scalar, elapsed_vector, elapsed_scalar / elapsed_vector,
+                 'ok' if not mismatch else 'FAILED (' + ', '.join(mismatch) + ')')
+
+    # conversions used by the time series code (fyear and mjd of year + doy)
+    scalar = lambda: [(d.fyear, d.mjd) for d in [pyDate.Date(year=y, doy=d)
+                                                  for y, d in zip(year.tolist(), doy.tolist())]]
+    vector = lambda: (pyDate.yeardoy2fyear_vec(year, doy), pyDate.yeardoy2mjd_vec(year, doy))
+
+    (pairs, elapsed_scalar), (arrays, elapsed_vector) = timed(scalar, args.repeat), timed(vector, args.repeat)
+
+    passed = np.allclose(np.array(pairs).transpose(), np.array(arrays), rtol=0, atol=1e-9)
+    failed += not passed
+
+    print ' %-10s: Date %8.4f s *_vec     %8.4f s speedup %6.0fx %s' \
+          % ('fyear, mjd', elapsed_scalar, elapsed_vector, elapsed_scalar / elapsed_vector,
+             'ok' if passed else 'FAILED')
+
+    print ' %i comparisons failed' % failed
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,122 @@
+"""
+Project: Parallel.Archive
+
+Benchmark of the joint N/E/U ETM adjustment (pyETM.adjust_lsq_batch) against the adjustment of one component at a
+time (ETM.adjust_lsq, three calls per station) using synthetic stations: daily NEU positions of random length with a
+polynomial, random jumps, annual and semi-annual terms, white noise and outliers. Each station is adjusted by
+component, jointly (what run_adjustment does for each station) and all the stations together (batch mode). The
+parameters, sigmas and variance factors of the three methods are compared. No database connection is needed.
+
+usage: python benchmark_etm_solver.py [-stations 200] [-outliers 0.03]
+"""
+
+import time
+import argparse
+import numpy as np
+import pyETM
+from pyBunch import Bunch
+
+# maximum differences with the adjustment by component: parameters [m] and relative difference of sigmas and factors
+TOLERANCE_PARAMS = 1e-6
+TOLERANCE_SIGMAS = 1e-4
+
+
+class SyntheticFunction(object):
+
+    def __init__(self, design):
+
+        self.design = design
+        self.param_count = design.shape[1]
+        self.column_index = np.arange(self.param_count)
+
+
+class ComponentAdjustment(pyETM.ETM):
+
+    def __init__(self):
+        # only ETM.adjust_lsq is used: no database
+        pass
+
+
+def synthetic_station(outliers):
+
+    epochs = np.random.randint(1000, 9000)
+    t = 2000 + np.sort(np.random.choice(np.arange(int(epochs * 1.2)), epochs, replace=False)) / 365.25
+
+    w = 2 * np.pi * t
+    linear = SyntheticFunction(np.column_stack((np.ones(t.size), t - t[0])))
+    periodic = SyntheticFunction(np.column_stack((np.sin(w), np.cos(w), np.sin(2 * w), np.cos(2 * w))))
+
+    jumps = [SyntheticFunction((t >= jump).astype(float)[:, None])
+             for jump in np.sort(np.random.uniform(t[100], t[-100], np.random.randint(0, 4)))]
+
+    A = pyETM.Design(linear, Bunch(table=jumps, param_count=len(jumps), constrains=np.array([])), periodic)
+
+    truth = np.random.randn(3, A.shape[1]) * 0.01
+    l = np.dot(truth, np.asarray(A).T) + np.random.randn(3, epochs) * np.array([[0.002], [0.003], [0.006]])
+
+    out = np.random.rand(3, epochs) < outliers
+    l[out] += np.random.randn(np.sum(out)) * 0.05
+
+    return A, l
+
+
+def compare(a, b):
+    """
+    :return: maximum difference of the parameters and relative differences of the sigmas and factors
+    """
+    return np.abs(a[0] - b[0]).max(), np.abs(a[1] / b[1] - 1).max(), np.abs(a[4] / b[4] - 1).max()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compare the joint ETM adjustment with the adjustment by component')
+
+    parser.add_argument('-stations', '--stations', type=int, default=200, help="Number of synthetic stations.")
+    parser.add_argument('-outliers', '--outliers', type=float, default=0.03, help="Fraction of outliers.")
+
+    args = parser.parse_args()
+
+    np.random.seed(0)
+
+    stations = [synthetic_station(args.outliers) for _ in range(args.stations)]
+
+    print ' >> %i stations, %i epochs' % (args.stations, sum([A.shape[0] for A, _ in stations]))
+
+    etm = ComponentAdjustment()
+
+    start = time.time()
+    by_component = []
+    for A, l in stations:
+        result = [etm.adjust_lsq(A, l[i]) for i in range(3)]
+        by_component.append([np.array([r[j] for r in result]) for j in range(6)])
+    elapsed_component = time.time() - start
+
+    start = time.time()
+    joint = [pyETM.adjust_lsq_batch([A], [l])[0] for A, l in stations]
+    elapsed_joint = time.time() - start
+
+    start = time.time()
+    batch = pyETM.adjust_lsq_batch([A for A, _ in stations], [l for _, l in stations])
+    elapsed_batch = time.time() - start
+
+    print ' by component: %7.3f s (%.2f ms per station)' % (elapsed_component,
+                                                            elapsed_component / args.stations * 1000)
+
+    failed = 0
+
+    for name, results, elapsed in (('joint', joint, elapsed_joint), ('batch', batch, elapsed_batch)):
+        diff = np.array([compare(r, ref) for r, ref in zip(results, by_component)]).max(axis=0)
+
+        passed = diff[0] <= TOLERANCE_PARAMS and diff[1] <= TOLERANCE_SIGMAS and diff[2] <= TOLERANCE_SIGMAS
+        failed += not passed
+
+        print ' %-12s: %7.3f s (%.2f ms per station, speedup %.1fx) params %.1e m sigmas %.1e factors %.1e %s' \
+              % (name, elapsed, elapsed / args.stations * 1000, elapsed_component / elapsed, diff[0], diff[1],
+                 diff[2], 'ok' if passed else 'FAILED')
+
+    print ' %i comparisons failed' % failed
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,187 @@
+"""
+Project: Parallel.PPP
+
+Comparison of the incremental ETM update (ETM.adjust_incremental) with the full robust fit (adjust_lsq_batch) using a
+synthetic station: daily NEU positions with a polynomial, a jump, annual and semi-annual terms, white noise and
+outliers. The station is fitted with the first epochs and then updated with new epochs: from the fit in memory (rank
+update, same process) and from the etms records of the first fit (new process). The parameters, sigmas and variance
+factors of both updates are compared with a full fit of all the epochs. An update can be rejected (e.g. the chi**2 test
+of the updated fit does not pass): run_adjustment then does the full fit, which is reported as a fallback and checked
+against the full fit. A change in the jump table and a modified epoch of the first fit have to trigger the full fit. No
+database connection is needed.
+
+usage: python benchmark_etm_update.py [-epochs 3000] [-seeds 3] [-outliers 0.03]
+"""
+
+import time
+import argparse
+import numpy as np
+import pyETM
+from pyBunch import Bunch
+
+# maximum differences with the full fit: parameters [m] and relative difference of sigmas and variance factors
+TOLERANCE_PARAMS = 1e-4
+TOLERANCE_SIGMAS = 0.02
+
+JUMP_DATE = 2012.
+
+
+class SyntheticFunction(object):
+
+    def __init__(self, design, obj_hash, t_ref=None):
+
+        self.design = design
+        self.param_count = design.shape[1]
+        self.column_index = np.arange(self.param_count)
+        self.p = Bunch(hash=obj_hash, t_ref=t_ref, params=np.array([]), sigmas=np.array([]))
+
+    def load_parameters(self, params=None, sigmas=None, t_ref=None):
+
+        self.p.params = params
+        self.p.sigmas = sigmas
+
+        if t_ref is not None:
+            self.p.t_ref = t_ref
+
+
+class SyntheticETM(pyETM.ETM):
+
+    def __init__(self, t, jump_hash=22):
+        # same members as ETM.__init__, without the database
+        self.C = np.array([])
+        self.S = np.array([])
+        self.F = np.array([])
+        self.R = np.array([])
+        self.P = np.array([])
+        self.factor = np.array([])
+        self.param_origin = pyETM.ESTIMATION
+
+        self.NetworkCode = 'syn'
+        self.StationCode = 'stn1'
+        self.soln = Bunch(type='ppp', stack_name='ppp', mjd=55197 + np.round((t - 2010.) * 365.25))
+
+        w = 2 * np.pi * t
+
+        self.Linear = SyntheticFunction(np.column_stack((np.ones(t.size), t - t[0])), 11, t[0])
+        self.Periodic = SyntheticFunction(np.column_stack((np.sin(w), np.cos(w), np.sin(2 * w), np.cos(2 * w))), 33)
+
+        jump = SyntheticFunction((t >= JUMP_DATE).astype(float)[:, None], jump_hash)
+        self.Jumps = Bunch(table=[jump], param_count=1, constrains=np.array([]))
+
+        self.A = pyETM.Design(self.Linear, self.Jumps, self.Periodic)
+
+    def full_fit(self, l):
+
+        self.C, self.S, self.F, self.R, self.factor, self.P = pyETM.adjust_lsq_batch([self.A], [l])[0]
+
+    def records(self):
+        # etms records of the fit (as saved by save_parameters)
+        return [{'object': 'polynomial', 'hash': 11, 't_ref': self.Linear.p.t_ref,
+                 'params': self.C[:, 0:2], 'sigmas': self.S[:, 0:2]},
+                {'object': 'jump', 'hash': 22, 't_ref': None, 'params': self.C[:, 2:3], 'sigmas': self.S[:, 2:3]},
+                {'object': 'periodic', 'hash': 33, 't_ref': None, 'params': self.C[:, 3:], 'sigmas': self.S[:, 3:]},
+                {'object': 'var_factor', 'hash': 44, 't_ref': None, 'params': self.factor, 'sigmas': None}]
+
+
+def synthetic_series(epochs, outliers):
+
+    t = 2010 + np.arange(epochs) / 365.25
+
+    truth = np.array([[0.1, 0.01, 0.02, 0.002, 0.001, 0.0005, 0.0003],
+                      [-0.2, -0.005, -0.01, 0.001, 0.002, 0.0001, 0.0001],
+                      [0.05, 0.0, 0.03, 0.004, 0.003, 0.001, 0.0002]])
+
+    l = np.dot(truth, np.asarray(SyntheticETM(t).A).T) + \
+        np.random.randn(3, epochs) * np.array([[0.002], [0.003], [0.006]])
+
+    out = np.random.rand(3, epochs) < outliers
+    l[out] += np.random.randn(np.sum(out)) * 0.05
+
+    return t, l
+
+
+def compare(etm, ref):
+
+    return np.abs(etm.C - ref.C).max(), np.abs(etm.S / ref.S - 1).max(), np.abs(etm.factor / ref.factor - 1).max()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compare the incremental ETM update with the full robust fit')
+
+    parser.add_argument('-epochs', '--epochs', type=int, default=3000, help="Number of epochs of the first fit.")
+    parser.add_argument('-seeds', '--seeds', type=int, default=3, help="Number of synthetic stations.")
+    parser.add_argument('-outliers', '--outliers', type=float, default=0.03, help="Fraction of outliers.")
+
+    args = parser.parse_args()
+
+    cache = pyETM.get_cache()
+    key = ('syn', 'stn1', 'ppp', 'ppp')
+    failed = 0
+    fallbacks = 0
+
+    for seed in range(args.seeds):
+        np.random.seed(seed)
+
+        t, l = synthetic_series(args.epochs + 60, args.outliers)
+
+        first = SyntheticETM(t[:args.epochs])
+        first.full_fit(l[:, :args.epochs])
+
+        for add in (1, 5, 30, 60):
+            n = args.epochs + add
+
+            ref = SyntheticETM(t[:n])
+            start = time.time()
+            ref.full_fit(l[:, :n])
+            elapsed_full = time.time() - start
+
+            # rank update of the fit in memory
+            cache.fits[key] = first
+            memory = SyntheticETM(t[:n])
+            start = time.time()
+            ok_memory = memory.adjust_incremental([], l[:, :n])
+            elapsed_memory = time.time() - start
+
+            # normal equations rebuilt from the etms records
+            records = SyntheticETM(t[:n])
+            ok_records = records.adjust_incremental(first.records(), l[:, :n])
+
+            for name, etm, ok in (('memory', memory, ok_memory), ('etms', records, ok_records)):
+                if not ok:
+                    # what run_adjustment does when the update is rejected
+                    etm.full_fit(l[:, :n])
+                    fallbacks += 1
+
+                dc, ds, df = compare(etm, ref)
+
+                passed = dc <= TOLERANCE_PARAMS and ds <= TOLERANCE_SIGMAS and df <= TOLERANCE_SIGMAS
+                failed += not passed
+
+                print ' seed %i +%2i epochs %-6s: params %.1e m sigmas %.1e factors %.1e %s%s' \
+                      % (seed, add, name, dc, ds, df, 'ok' if passed else 'FAILED', '' if ok else ' (full fit)')
+
+            print '                         rank update %.4f s full fit %.4f s' % (elapsed_memory, elapsed_full)
+
+        # changes that require the full fit
+        cache.fits[key] = first
+        jump = SyntheticETM(t[:args.epochs + 5], jump_hash=99)
+        if jump.adjust_incremental(first.records(), l[:, :args.epochs + 5]):
+            print ' seed %i: a change in the jump table did not trigger the full fit FAILED' % seed
+            failed += 1
+
+        cache.fits[key] = first
+        modified = l[:, :args.epochs + 5].copy()
+        modified[0, 10] += 0.01
+        if SyntheticETM(t[:args.epochs + 5]).adjust_incremental([], modified):
+            print ' seed %i: a modified epoch did not trigger the full fit FAILED' % seed
+            failed += 1
+
+    cache.clear()
+
+    print ' %i comparisons failed, %i updates rejected (full fit)' % (failed, fallbacks)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,250 @@
+"""
+Project: Parallel.Stacker
+
+Validation of the normal equation stack (pyNEQStack.NEQStack) against the iterative alignment of Stacker (align each
+polyhedron to the PPP ETMs, then to the ETMs of the aligned stack) using a synthetic network: stations with a
+position, velocity, annual term and (some of them) a jump, observed every day with white noise and outliers, and
+displaced every day by a random Helmert transformation. Two thirds of the stations have a PPP ETM (the true
+trajectory plus a small bias per station), which defines the frame of both methods. The aligned coordinates and the
+velocities of both methods are compared with the truth and with each other: the error of the alignment is the
+difference between the aligned coordinates and the observed coordinates before the daily transformations were applied
+(noise and outliers are not part of it). No database connection is needed.
+
+usage: python benchmark_neq_stack.py [-stations 40] [-days 730] [-iterations 4] [-seed 0]
+"""
+
+import time
+import argparse
+import numpy as np
+import pyDate
+import pyStack
+import pyNEQStack
+
+# noise of the daily coordinates, outlier fraction and bias of the PPP ETMs [m]
+NOISE = 0.003
+OUTLIERS = 0.01
+PPP_BIAS = 0.001
+
+# maximum rms error [m] of the alignment of both methods
+TOLERANCE = 0.002
+
+
+class Network(object):
+
+    def __init__(self, stations, days, seed):
+
+        np.random.seed(seed)
+
+        self.stations = ['syn.s%03i' % s for s in range(stations)]
+
+        lat = np.arcsin(np.random.uniform(-1, 1, stations))
+        lon = np.random.uniform(-np.pi, np.pi, stations)
+        self.x0 = 6371000. * np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+        # parameters of each station: position, velocity, annual sin and cos (X Y Z) and jump (zero if none)
+        self.vel = np.random.randn(stations, 3) * 0.02
+        self.sin = np.random.randn(stations, 3) * 0.003
+        self.cos = np.random.randn(stations, 3) * 0.003
+        self.jump = np.random.randn(stations, 3) * 0.02 * (np.arange(stations) % 3 == 0)[:, np.newaxis]
+
+        self.mjd = 57023 + np.arange(days)
+        self.t = (self.mjd - self.mjd[0]) / 365.25
+        self.jump_t = self.t[days / 2]
+
+        self.ppp = np.arange(stations) % 3 != 2
+        self.ppp_bias = np.random.randn(stations, 3) * PPP_BIAS
+
+        # daily transformation: rotations (x 1e-9 rad) and translations [m], as in pyStack.Polyhedron
+        self.helmert = np.column_stack((np.random.randn(days, 3) * 2, np.random.randn(days, 3) * 0.01))
+
+        # about 5% of the station-days are missing
+        self.observed = np.random.rand(stations, days) > 0.05
+
+    def design(self, s):
+
+        A = np.column_stack((np.ones(self.t.size), self.t, np.sin(2 * np.pi * self.t), np.cos(2 * np.pi * self.t)))
+
+        if self.jump[s].any():
+            A = np.column_stack((A, (self.t >= self.jump_t).astype(float)))
+
+        return A[self.observed[s]]
+
+    def truth(self, s):
+
+        t = self.t[:, np.newaxis]
+        return self.x0[s] + self.vel[s] * t + self.sin[s] * np.sin(2 * np.pi * t) + \
+            self.cos[s] * np.cos(2 * np.pi * t) + self.jump[s] * (t >= self.jump_t)
+
+    def polyhedrons(self):
+
+        truth = [self.truth(s) for s in range(len(self.stations))]
+        stack = []
+
+        # observed coordinates before the daily transformations
+        self.observations = np.empty((len(self.stations), self.mjd.size, 3))
+        self.observations.fill(np.nan)
+
+        for d, mjd in enumerate(self.mjd):
+            date = pyDate.Date(mjd=mjd)
+            vertices = []
+
+            for s, stn in enumerate(self.stations):
+                if self.observed[s, d]:
+                    xyz = truth[s][d] + np.random.randn(3) * NOISE
+                    if np.random.rand() < OUTLIERS:
+                        xyz += np.random.randn(3) * 0.05
+                    self.observations[s, d] = xyz
+                    vertices.append((stn, xyz[0], xyz[1], xyz[2], date.year, date.doy, date.fyear))
+
+            vertices = np.array(vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
+                                                 ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')])
+            poly = pyStack.Polyhedron(vertices, 'synthetic', date)
+
+            # displace the polyhedron with the transformation of the day
+            poly.align(helmert=self.helmert[d], set_aligned=False)
+
+            stack.append(poly)
+
+        return stack
+
+    def designs(self):
+
+        designs = []
+
+        for s, stn in enumerate(self.stations):
+            A = self.design(s)
+            labels = ['polynomial 0', 'polynomial 1', 'periodic sin 1', 'periodic cos 1'] + \
+                     ['%s jump 0' % stn] * (A.shape[1] - 4)
+
+            design = {'stn': stn, 'mjd': self.mjd[self.observed[s]], 'A': A, 'labels': labels,
+                      'constrains': np.zeros((0, A.shape[1])), 'target_mjd': None, 'target': None}
+
+            if self.ppp[s]:
+                design['target_mjd'] = self.mjd
+                design['target'] = self.truth(s) + self.ppp_bias[s]
+
+            designs.append(design)
+
+        return designs
+
+
+def iterative_stack(net, stack, iterations):
+    """
+    alignment loop of Stacker: iteration 0 aligns to the PPP ETMs, the next ones to the ETMs of the aligned stack
+    """
+    for i in range(iterations):
+        targets = dict()
+
+        for s, stn in enumerate(net.stations):
+            if i == 0:
+                if net.ppp[s]:
+                    targets[stn] = net.truth(s) + net.ppp_bias[s]
+            else:
+                A = net.design(s)
+                ts = np.array([poly.vertices[poly.vertices['stn'] == stn][['x', 'y', 'z']].tolist()[0]
+                               for poly, o in zip(stack, net.observed[s]) if o])
+
+                model = np.zeros((net.mjd.size, 3))
+                for c in range(3):
+                    C = pyStack.adjust_lsq(A, ts[:, c])[0]
+                    model[net.observed[s], c] = np.dot(A, C)
+
+                targets[stn] = model
+
+        for d, poly in enumerate(stack):
+            target = [(stn, xyz[d][0], xyz[d][1], xyz[d][2], poly.date.year, poly.date.doy, poly.date.fyear)
+                      for stn, xyz in sorted(targets.items()) if i == 0 or net.observed[net.stations.index(stn), d]]
+
+            target = np.array(target, dtype=poly.vertices.dtype)
+
+            poly.align(pyStack.Polyhedron(target, 'etm', poly.date), i == iterations - 1)
+
+
+def aligned(net, stack):
+    """
+    :return: aligned coordinates of the stack (stations, days, 3) (nan if not observed)
+    """
+    xyz = np.empty((len(net.stations), net.mjd.size, 3))
+    xyz.fill(np.nan)
+
+    for d, poly in enumerate(stack):
+        s = np.searchsorted(net.stations, poly.vertices['stn'])
+        xyz[s, d] = np.column_stack((poly.vertices['x'], poly.vertices['y'], poly.vertices['z']))
+
+    return xyz
+
+
+def velocities(net, xyz):
+
+    vel = np.zeros((len(net.stations), 3))
+
+    for s in range(len(net.stations)):
+        A = net.design(s)
+        for c in range(3):
+            vel[s, c] = pyStack.adjust_lsq(A, xyz[s, net.observed[s], c])[0][1]
+
+    return vel
+
+
+def rms(x):
+
+    x = x[np.isfinite(x)]
+    return np.sqrt(np.mean(np.square(x)))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compare the normal equation stack with the iterative alignment')
+
+    parser.add_argument('-stations', '--stations', type=int, default=40, help="Number of stations.")
+    parser.add_argument('-days', '--days', type=int, default=730, help="Number of days.")
+    parser.add_argument('-iterations', '--iterations', type=int, default=4,
+                        help="Iterations of the iterative alignment (Stacker --max_iters).")
+    parser.add_argument('-seed', '--seed', type=int, default=0, help="Seed of the synthetic network.")
+
+    args = parser.parse_args()
+
+    net = Network(args.stations, args.days, args.seed)
+
+    print ' >> %i stations, %i days' % (args.stations, args.days)
+
+    # the same observations for both methods
+    state = np.random.get_state()
+    stack = net.polyhedrons()
+    np.random.set_state(state)
+    neq_stack = net.polyhedrons()
+
+    start = time.time()
+    iterative_stack(net, stack, args.iterations)
+    elapsed_iterative = time.time() - start
+
+    start = time.time()
+    neq = pyNEQStack.NEQStack(neq_stack, net.designs())
+    neq.solve()
+    neq.apply()
+    elapsed_neq = time.time() - start
+
+    xyz_iterative = aligned(net, stack)
+    xyz_neq = aligned(net, neq_stack)
+
+    failed = 0
+
+    for name, xyz, elapsed in (('iterative', xyz_iterative, elapsed_iterative), ('neq', xyz_neq, elapsed_neq)):
+        error = rms(xyz - net.observations)
+
+        passed = error <= TOLERANCE
+        failed += not passed
+
+        print ' %-9s: %6.2f s alignment error %.2f mm velocities (with the truth) %.2f mm/yr %s' \
+              % (name, elapsed, error * 1000, rms(velocities(net, xyz) - net.vel) * 1000, 'ok' if passed else 'FAILED')
+
+    print ' neq - iterative: coordinates %.1f mm velocities %.2f mm/yr' \
+          % (rms(xyz_neq - xyz_iterative) * 1000,
+             rms(velocities(net, xyz_neq) - velocities(net, xyz_iterative)) * 1000)
+
+    print ' %i comparisons failed' % failed
+
+
+if __name__ == '__main__':
+
+    main()
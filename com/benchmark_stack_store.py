@@ -0,0 +1,142 @@
+"""
+Project: Parallel.Stacker
+
+Benchmark of the station-indexed vertex store of pyStack (VertexStore) against the previous per-polyhedron scans,
+using a synthetic stack (by default 1000 stations x 7000 days, each station observed during a random span of the
+period). Loading the polyhedrons (one boolean filter of all the vertices per date before, a view of the store now) and
+extracting the time series of the stations (one mask per polyhedron and station before, a slice of the store now) are
+timed. The previous methods are timed on a sample of dates and stations and extrapolated to the whole stack. Both
+methods are compared for the sample, and changes made to a polyhedron have to be seen by the store.
+
+usage: python benchmark_stack_store.py [-stations 1000] [-days 7000] [-sample 50]
+"""
+
+import time
+import argparse
+import numpy as np
+import pyDate
+import pyStack
+
+VERTEX = [('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+          ('fy', 'float64')]
+
+
+def synthetic_vertices(stations, days):
+
+    start_mjd = 49718
+    vertices = []
+
+    for s in range(stations):
+        # each station is observed during a random span, with about 5% of missing days
+        span = np.sort(np.random.randint(0, days, 2))
+        mjd = start_mjd + np.arange(span[0], span[1] + 1)
+        mjd = mjd[np.random.rand(mjd.size) > 0.05]
+
+        v = np.zeros(mjd.size, dtype=VERTEX)
+        v['stn'] = 'syn.%04i' % s
+        v['x'], v['y'], v['z'] = (np.random.randn(3, 1) * 4e6 + np.random.randn(3, mjd.size) * 0.005)
+        v['yr'], v['dd'] = pyDate.mjd2yeardoy_vec(mjd)
+        v['fy'] = pyDate.yeardoy2fyear_vec(v['yr'], v['dd'])
+
+        vertices.append(v)
+
+    vertices = np.concatenate(vertices)
+
+    # the database returns the vertices sorted by station
+    return vertices, [pyDate.Date(mjd=mjd) for mjd in range(start_mjd, start_mjd + days)]
+
+
+def old_get_station(stack, stnstr):
+    # Stack.get_station before the vertex store
+    ts = []
+
+    for poly in stack:
+        p = poly.vertices[poly.vertices['stn'] == stnstr]
+        if p.size:
+            ts.append([p['x'][0], p['y'][0], p['z'][0], p['yr'][0], p['dd'][0], p['fy'][0]])
+
+    return np.array(ts)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark of the vertex store of the stack')
+
+    parser.add_argument('-stations', '--stations', type=int, default=1000, help="Number of stations.")
+    parser.add_argument('-days', '--days', type=int, default=7000, help="Number of days.")
+    parser.add_argument('-sample', '--sample', type=int, default=50,
+                        help="Number of dates and stations used to time the previous methods.")
+
+    args = parser.parse_args()
+
+    np.random.seed(0)
+
+    vertices, dates = synthetic_vertices(args.stations, args.days)
+
+    print ' >> %i stations, %i days, %i vertices' % (args.stations, args.days, vertices.size)
+
+    # dates with data (as returned by the database)
+    keys = np.unique(vertices['yr'].astype(np.int64) * 1000 + vertices['dd'])
+    dates = [d for d in dates if d.year * 1000 + d.doy in keys]
+
+    sample_dates = [dates[i] for i in np.linspace(0, len(dates) - 1, min(args.sample, len(dates))).astype(int)]
+    stations = np.unique(vertices['stn'])
+    sample_stations = stations[np.linspace(0, stations.size - 1, min(args.sample, stations.size)).astype(int)]
+
+    # load the polyhedrons
+    start = time.time()
+    old = [pyStack.Polyhedron(vertices, 'synthetic', d) for d in sample_dates]
+    elapsed_old = (time.time() - start) * len(dates) / len(sample_dates)
+
+    start = time.time()
+    store = pyStack.VertexStore(vertices)
+    stack = [pyStack.Polyhedron(store.get_date(d), 'synthetic', d, view=True) for d in dates]
+    elapsed_new = time.time() - start
+
+    print ' load polyhedrons   : scans %8.2f s (estimated) store %6.2f s speedup %6.0fx' \
+          % (elapsed_old, elapsed_new, elapsed_old / elapsed_new)
+
+    failed = 0
+
+    for poly in old:
+        new = stack[dates.index(poly.date)]
+        if not np.array_equal(poly.vertices, new.vertices):
+            print ' -- %s: the polyhedrons are different FAILED' % poly.date.yyyyddd()
+            failed += 1
+
+    # time series of the stations
+    start = time.time()
+    old = [old_get_station(stack, stn) for stn in sample_stations]
+    elapsed_old = (time.time() - start) * stations.size / sample_stations.size
+
+    start = time.time()
+    new = [store.get_time_series(stn) for stn in stations]
+    elapsed_new = time.time() - start
+
+    print ' get_station        : scans %8.2f s (estimated) store %6.2f s speedup %6.0fx' \
+          % (elapsed_old, elapsed_new, elapsed_old / elapsed_new)
+
+    for stn, ts in zip(sample_stations, old):
+        if not np.array_equal(ts, new[int(np.searchsorted(stations, stn))]):
+            print ' -- %s: the time series are different FAILED' % stn
+            failed += 1
+
+    # the polyhedrons are views of the store: an alignment has to be seen by get_station
+    poly = stack[len(stack) / 2]
+    poly.align(helmert=np.array([0., 0., 0., 1., 2., 3.]))
+
+    stn = poly.vertices['stn'][0]
+    ts = store.get_time_series(stn)
+    row = np.flatnonzero(np.logical_and(ts[:, 3] == poly.date.year, ts[:, 4] == poly.date.doy))
+
+    if not np.allclose(ts[row[0], 0:3], [poly.vertices['x'][0], poly.vertices['y'][0], poly.vertices['z'][0]],
+                       rtol=0, atol=0):
+        print ' -- the changes made to a polyhedron are not seen by the store FAILED'
+        failed += 1
+
+    print ' %i comparisons failed' % failed
+
+
+if __name__ == '__main__':
+
+    main()
@@ -24,7 +24,8 @@ class GamitSessionException(Exception):
 
 class GamitSession(object):
 
-    def __init__(self, cnn, archive, name, org, subnet, date, GamitConfig, stations, ties=(), centroid=()):
+    def __init__(self, cnn, archive, name, org, subnet, date, GamitConfig, stations, ties=(), centroid=(),
+                 metadata=None):
         """
         The GAMIT session object creates all the directory structure and configuration files according to the parameters
         set in GamitConfig. Two stations list are passed and merged to create the session
@@ -37,6 +38,7 @@ class GamitSession(object):
         :param GamitConfig: configuration to run gamit
         :param stations: list of stations to be processed
         :param ties: tie stations as obtained by pyNetwork
+        :param metadata: pyStation.ProjectMetadataCache with the preloaded station metadata (optional)
         """
         self.NetName = name
         self.org = org
@@ -71,11 +73,11 @@ class GamitSession(object):
         # make StationInstances
         station_instances = []
         for stn in stations:
-            station_instances += [StationInstance(cnn, archive, stn, date, GamitConfig)]
+            station_instances += [StationInstance(cnn, archive, stn, date, GamitConfig, metadata)]
 
         # do the same with ties
         for stn in ties:
-            station_instances += [StationInstance(cnn, archive, stn, date, GamitConfig)]
+            station_instances += [StationInstance(cnn, archive, stn, date, GamitConfig, metadata)]
 
         self.StationInstances = station_instances
 
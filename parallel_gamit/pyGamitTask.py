@@ -14,6 +14,16 @@ import re
 import glob
 import platform
 import traceback
+import hashlib
+import tempfile
+import pyProducts
+from multiprocessing.pool import ThreadPool
+
+# sampling interval of the RINEX files used by GAMIT
+DECIMATE = 30
+
+# RINEX files prepared at the same time by each task
+RINEX_THREADS = 4
 
 
 class GamitTask(object):
@@ -96,66 +106,18 @@ class GamitTask(object):
                 pyBrdc.GetBrdcOrbits(self.orbits['brdc_path'], self.date, self.pwd_brdc,
                                      no_cleanup=True)  # type: pyBrdc.GetBrdcOrbits
 
-                for rinex in self.params['rinex']:
-
-                    monitor.write(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') +
-                                  ' -> fetching rinex for %s.%s %s %s\n'
-                                  % (rinex['NetworkCode'], rinex['StationCode'], rinex['StationAlias'],
-                                     '{:10.6f} {:11.6f}'.format(rinex['lat'], rinex['lon'])))
-
+                # prepare the RINEX files in parallel. The files of the tie stations are shared with the other
+                # subnetworks processed in this node through the rinex cache (see prepare_rinex)
+                if self.params['rinex']:
+                    pool = ThreadPool(min(RINEX_THREADS, len(self.params['rinex'])))
                     try:
-                        with pyRinex.ReadRinex(rinex['NetworkCode'],
-                                               rinex['StationCode'],
-                                               rinex['source'], False) as Rinex:  # type: pyRinex.ReadRinex
-
-                            # WARNING! some multiday RINEX were generating conflicts because the RINEX has a name, say,
-                            # tuc12302.10o and the program wants to rename it as tuc12030.10o but because it's a
-                            # multiday file, during __init__ it's already split and renamed as tuc12300.10o and
-                            # additional folders are generated with the information for each file. Therefore, find
-                            # the rinex that corresponds to the date being processed and use that one instead of the
-                            # original file. These files are not allowed by pyArchiveService, but the "start point" of
-                            # the database (i.e. the files already in the folders read by pyScanArchive) has such
-                            # problems.
-
-                            # figure out if this station has been affected by an earthquake
-                            # if so, window the data
-                            if rinex['jump'] is not None:
-                                monitor.write(
-                                    '                    -> RINEX file has been windowed: ETM detected jump on ' +
-                                    rinex['jump'].datetime().strftime('%Y-%m-%d %H:%M:%S') + '\n')
-
-                            if Rinex.multiday:
-                                # find the rinex that corresponds to the session being processed
-                                for Rnx in Rinex.multiday_rnx_list:
-                                    if Rnx.date == self.date:
-                                        Rnx.rename(rinex['destiny'])
-
-                                        if rinex['jump'] is not None:
-                                            self.window_rinex(Rnx, rinex['jump'])
-                                        # before creating local copy, decimate file
-                                        Rnx.decimate(30)
-                                        Rnx.purge_comments()
-                                        Rnx.compress_local_copyto(self.pwd_rinex)
-                                        break
-                            else:
-                                Rinex.rename(rinex['destiny'])
-
-                                if rinex['jump'] is not None:
-                                    self.window_rinex(Rinex, rinex['jump'])
-                                # before creating local copy, decimate file
-                                Rinex.decimate(30)
-                                Rinex.purge_comments()
-                                Rinex.compress_local_copyto(self.pwd_rinex)
-
-                    except (OSError, IOError):
-                        monitor.write(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') +
-                                      ' -> An error occurred while trying to copy ' +
-                                      rinex['source'] + ' to ' + rinex['destiny'] + ': File skipped.\n')
-
-                    except (pyRinex.pyRinexException, Exception) as e:
-                        monitor.write(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') +
-                                      ' -> An error occurred while trying to copy ' +
-                                      rinex['source'] + ': ' + str(e) + '\n')
+                        messages = pool.map(self.prepare_rinex, self.params['rinex'])
+                    finally:
+                        pool.close()
+                        pool.join()
+
+                    for message in messages:
+                        monitor.write(message)
 
                 monitor.write(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ' -> executing GAMIT\n')
 
@@ -241,6 +203,101 @@ class GamitTask(object):
             # return useful information to the main node
             return result
 
+    def prepare_rinex(self, rinex):
+        """
+        copy the RINEX file of a station to the rinex folder of the task: rename, window (if there is a jump),
+        decimate, purge the comments and compress. The prepared file is kept in the rinex cache of the node, keyed by
+        the station, date, origin file (path, size and modification time), destiny name, window and sampling interval,
+        so the other subnetworks that include the same station (ties) use it without preparing it again
+        :param rinex: dictionary with the information of the RINEX file (see pyStation.StationInstance)
+        :return: text for the monitor.log
+        """
+        message = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + \
+            ' -> fetching rinex for %s.%s %s %s\n' % (rinex['NetworkCode'], rinex['StationCode'], rinex['StationAlias'],
+                                                      '{:10.6f} {:11.6f}'.format(rinex['lat'], rinex['lon']))
+
+        # figure out if this station has been affected by an earthquake
+        # if so, window the data
+        if rinex['jump'] is not None:
+            message += '                    -> RINEX file has been windowed: ETM detected jump on ' + \
+                       rinex['jump'].datetime().strftime('%Y-%m-%d %H:%M:%S') + '\n'
+
+        destination = os.path.join(self.pwd_rinex, os.path.basename(rinex['destiny']))
+
+        try:
+            cache = pyProducts.get_cache(name='rinex')
+
+            if cache is None:
+                self.create_rinex(rinex, self.pwd_rinex)
+            else:
+                st = os.stat(rinex['source'])
+
+                key = hashlib.sha1(repr((rinex['NetworkCode'], rinex['StationCode'], self.date.yyyyddd(),
+                                         os.path.abspath(rinex['source']), st.st_size, int(st.st_mtime),
+                                         os.path.basename(rinex['destiny']), str(rinex['jump']), DECIMATE)))
+
+                def create(tmp):
+                    # staging folder for the compressed file (it survives the cleanup of the RINEX object)
+                    staging = tempfile.mkdtemp()
+                    try:
+                        shutil.move(self.create_rinex(rinex, staging), tmp)
+                    finally:
+                        shutil.rmtree(staging, ignore_errors=True)
+
+                if cache.get(key.hexdigest()[0:16] + '_' + os.path.basename(destination), destination, create,
+                             st.st_size):
+                    message += '                    -> RINEX file taken from the rinex cache of the node\n'
+
+        except (OSError, IOError):
+            message += datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + \
+                       ' -> An error occurred while trying to copy ' + \
+                       rinex['source'] + ' to ' + rinex['destiny'] + ': File skipped.\n'
+
+        except (pyRinex.pyRinexException, Exception) as e:
+            message += datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + \
+                       ' -> An error occurred while trying to copy ' + rinex['source'] + ': ' + str(e) + '\n'
+
+        return message
+
+    def create_rinex(self, rinex, path):
+        """
+        prepare the RINEX file for GAMIT (see prepare_rinex)
+        :param rinex: dictionary with the information of the RINEX file
+        :param path: folder where the compressed file is copied
+        :return: path of the compressed file
+        """
+        with pyRinex.ReadRinex(rinex['NetworkCode'],
+                               rinex['StationCode'],
+                               rinex['source'], False) as Rinex:  # type: pyRinex.ReadRinex
+
+            # WARNING! some multiday RINEX were generating conflicts because the RINEX has a name, say,
+            # tuc12302.10o and the program wants to rename it as tuc12030.10o but because it's a
+            # multiday file, during __init__ it's already split and renamed as tuc12300.10o and
+            # additional folders are generated with the information for each file. Therefore, find
+            # the rinex that corresponds to the date being processed and use that one instead of the
+            # original file. These files are not allowed by pyArchiveService, but the "start point" of
+            # the database (i.e. the files already in the folders read by pyScanArchive) has such
+            # problems.
+            if Rinex.multiday:
+                # find the rinex that corresponds to the session being processed
+                for Rnx in Rinex.multiday_rnx_list:
+                    if Rnx.date == self.date:
+                        break
+                else:
+                    raise pyRinex.pyRinexException('Multiday RINEX file without data for ' + self.date.yyyyddd())
+            else:
+                Rnx = Rinex
+
+            Rnx.rename(rinex['destiny'])
+
+            if rinex['jump'] is not None:
+                self.window_rinex(Rnx, rinex['jump'])
+            # before creating local copy, decimate file
+            Rnx.decimate(DECIMATE)
+            Rnx.purge_comments()
+
+            return Rnx.compress_local_copyto(path)
+
     def window_rinex(self, Rinex, window):
 
         # windows the data:
@@ -32,7 +32,7 @@ class NetworkException(Exception):
 
 class Network(object):
 
-    def __init__(self, cnn, archive, GamitConfig, stations, date):
+    def __init__(self, cnn, archive, GamitConfig, stations, date, metadata=None):
 
         self.name = GamitConfig.NetworkConfig.network_id.lower()
         self.org = GamitConfig.gamitopt['org']
@@ -120,7 +120,7 @@ class Network(object):
                 ties = []
                 backbone = []
 
-        self.sessions = self.create_gamit_sessions(cnn, archive, clusters, backbone, ties, date)
+        self.sessions = self.create_gamit_sessions(cnn, archive, clusters, backbone, ties, date, metadata)
 
     def check_stn_diff_aliases(self, stn_diff, cfg_stations, stations):
 
@@ -515,22 +515,24 @@ class Network(object):
                                    subnet=i + 1)
         return clusters
 
-    def create_gamit_sessions(self, cnn, archive, clusters, backbone, ties, date):
+    def create_gamit_sessions(self, cnn, archive, clusters, backbone, ties, date, metadata=None):
 
         sessions = []
 
         if len(backbone):
             # a backbone network was created: at least two or more clusters
             # backbone if always network 00
-            sessions.append(GamitSession(cnn, archive, self.name, self.org, 0, date, self.GamitConfig, backbone))
+            sessions.append(GamitSession(cnn, archive, self.name, self.org, 0, date, self.GamitConfig, backbone,
+                                         metadata=metadata))
 
             for c in range(len(clusters['centroids'])):
                 # create a session for each cluster
                 sessions.append(GamitSession(cnn, archive, self.name, self.org, c + 1, date, self.GamitConfig,
-                                             clusters['stations'][c], ties[c], clusters['centroids'][c].tolist()))
+                                             clusters['stations'][c], ties[c], clusters['centroids'][c].tolist(),
+                                             metadata))
 
         else:
             sessions.append(GamitSession(cnn, archive, self.name, self.org, None, date, self.GamitConfig,
-                                         clusters['stations'][0]))
+                                         clusters['stations'][0], metadata=metadata))
 
         return sessions
@@ -26,15 +26,22 @@ from Utils import process_date
 from Utils import process_stnlist
 from Utils import parseIntSet
 from pyStation import Station
+from pyStation import ProjectMetadataCache
 from pyETM import pyETMException
+import pyETM
 import pyArchiveStruct
 import logging
 import simplekml
 import numpy as np
 from itertools import repeat
+import multiprocessing
+import traceback
 
 cnn = None
 
+# project information inherited by the processes that create the GAMIT sessions (see init_session_worker)
+session_worker = dict()
+
 
 def print_summary(stations, sessions, dates):
     # output a summary of each network
@@ -173,6 +180,9 @@ def station_list(cnn, NetworkConfig, dates):
     stations = process_stnlist(cnn, NetworkConfig['stn_list'].split(','))
     stn_obj = []
 
+    # load the stored ETM parameters of all the stations at once
+    pyETM.get_cache().prefetch_parameters(cnn, stations)
+
     # use the connection to the db to get the stations
     for Stn in tqdm(sorted(stations), ncols=80):
 
@@ -203,6 +213,56 @@ def station_list(cnn, NetworkConfig, dates):
     return stn_obj
 
 
+def build_network(cnn, archive, GamitConfig, stations, date, metadata):
+    """
+    creates the Network object (clusters, backbone, ties and GAMIT sessions) for date. All the changes to the
+    gamit_subnets and gamit_stats tables of this date are done in a single transaction
+    :return: list of GamitSession objects for date
+    """
+    cnn.begin_transac()
+
+    try:
+        net_object = Network(cnn, archive, GamitConfig, stations, date, metadata)
+
+        cnn.commit_transac()
+    except Exception:
+        cnn.rollback_transac()
+        raise
+
+    return net_object.sessions
+
+
+def init_session_worker(GamitConfig, stations, metadata):
+    # the project information is inherited by each worker process (no need to send it with each date)
+    session_worker['GamitConfig'] = GamitConfig
+    session_worker['stations'] = stations
+    session_worker['metadata'] = metadata
+    session_worker['aliases'] = [stn.StationAlias for stn in stations]
+
+
+def create_sessions(date):
+    """
+    worker process function to create the sessions of a date. Each worker process uses its own database connection
+    """
+    GamitConfig = session_worker['GamitConfig']
+    stations = session_worker['stations']
+
+    try:
+        cnn = dbConnection.get_connection(GamitConfig.gamitopt['gnss_data'])
+        archive = pyArchiveStruct.RinexStruct(cnn)
+
+        # Network might change the aliases of the stations when recovering a processing: restore the original aliases
+        # so that the result does not depend on the dates previously processed by this worker
+        for stn, alias in zip(stations, session_worker['aliases']):
+            stn.StationAlias = alias
+
+        return build_network(cnn, archive, GamitConfig, stations, date, session_worker['metadata'])
+
+    except Exception:
+        raise Exception('Error while creating the GAMIT sessions for %s:\n%s'
+                        % (date.yyyyddd(), traceback.format_exc()))
+
+
 def check_station_codes(stn_obj):
 
     for i, stn1 in enumerate(stn_obj[:-1]):
@@ -329,7 +389,11 @@ def main():
     sessions = []
     archive = pyArchiveStruct.RinexStruct(cnn)  # type: pyArchiveStruct.RinexStruct
 
-    for date in tqdm(dates, ncols=80):
+    # preload the station info, rinex and ppp metadata of the whole project (avoids per station-day queries)
+    start_time = datetime.now()
+    metadata = ProjectMetadataCache(cnn, archive, stations, drange)
+
+    for date in dates:
 
         # make the dir for these sessions
         # this avoids a racing condition when starting each process
@@ -338,9 +402,21 @@ def main():
         if not os.path.exists(pwd):
             os.makedirs(pwd)
 
-        net_object = Network(cnn, archive, GamitConfig, stations, date)
+    if args.noparallel or len(dates) == 1:
+        for date in tqdm(dates, ncols=80):
+            sessions += build_network(cnn, archive, GamitConfig, stations, date, metadata)
+    else:
+        # each date is processed by a different process, sessions are merged in date order
+        pool = multiprocessing.Pool(processes=min(JobServer.cpus, len(dates)), initializer=init_session_worker,
+                                    initargs=(GamitConfig, stations, metadata))
+        try:
+            for date_sessions in tqdm(pool.imap(create_sessions, dates), total=len(dates), ncols=80):
+                sessions += date_sessions
+        finally:
+            pool.terminate()
+            pool.join()
 
-        sessions += net_object.sessions
+    tqdm.write(' -- Session instances created in %s' % str(datetime.now() - start_time))
 
     if args.generate_kml:
         # generate a KML of the sessions
@@ -355,7 +431,7 @@ def main():
 
     # execute globk on doys that had to be divided into subnets
     if not args.dry_run:
-        ExecuteGlobk(GamitConfig, sessions, dates)
+        ExecuteGlobk(GamitConfig, sessions, dates, 1 if args.noparallel else JobServer.cpus)
 
         # parse the zenith delay outputs
         ParseZTD(GamitConfig.NetworkConfig.network_id, sessions, GamitConfig)
@@ -417,13 +493,46 @@ def generate_kml(dates, sessions, GamitConfig):
     kml.savekmz('production/' + GamitConfig.NetworkConfig.network_id.lower() + '.kmz')
 
 
+# fields of the ATM_ZEN records of the .znd files
+ZTD_DTYPE = [('stn', 'S4'), ('y', 'i4'), ('m', 'i4'), ('d', 'i4'), ('h', 'i4'), ('mm', 'i4'),
+             ('mo', 'float64'), ('s', 'float64'), ('z', 'float64'), ('yr', 'i4'), ('doy', 'i4')]
+
+# the records with the same values in these fields are averaged
+ZTD_KEYS = ['stn', 'yr', 'doy', 'y', 'm', 'd', 'h', 'mm']
+
+
+def read_znd(znd, date):
+    """
+    read the ATM_ZEN records of a .znd file
+    :param znd: path to the file
+    :param date: pyDate.Date of the session
+    :return: structured array (ZTD_DTYPE) with the records of the file
+    """
+    with open(znd, 'r') as f:
+        v = re.findall(r'ATM_ZEN X (\w+) .. (\d+)\s*(\d*)\s*(\d*)\s*(\d*)\s*(\d*)\s*\d*\s*([- ]?'
+                       r'\d*.\d+)\s*[+-]*\s*(\d*.\d*)\s*(\d*.\d*)', f.read(), re.MULTILINE)
+
+    zd = np.empty(len(v), dtype=ZTD_DTYPE)
+
+    if len(v):
+        # convert each column at once
+        columns = zip(*v)
+        for field, column in zip(('stn', 'y', 'm', 'd', 'h', 'mm', 'mo', 's', 'z'), columns):
+            zd[field] = np.array(column).astype(zd.dtype[field])
+
+        zd['yr'] = date.year
+        zd['doy'] = date.doy
+
+    return zd
+
+
 def ParseZTD(project, Sessions, GamitConfig):
 
     global cnn
 
     tqdm.write(' >> Parsing the zenith tropospheric delays...')
 
-    # atmospheric zenith delay list
+    # atmospheric zenith delay arrays (one per session)
     atmzen = []
     # a dictionary for the station aliases lookup table
     alias = dict()
@@ -433,110 +542,91 @@ def ParseZTD(project, Sessions, GamitConfig):
             znd = os.path.join(GamitSession.pwd_glbf, GamitConfig.gamitopt['org'] + GamitSession.date.wwwwd() + '.znd')
 
             if os.path.isfile(znd):
-                # read the content of the file
-                f = open(znd, 'r')
-                output = f.readlines()
-                f.close()
-                v = re.findall(r'ATM_ZEN X (\w+) .. (\d+)\s*(\d*)\s*(\d*)\s*(\d*)\s*(\d*)\s*\d*\s*([- ]?'
-                               r'\d*.\d+)\s*[+-]*\s*(\d*.\d*)\s*(\d*.\d*)', ''.join(output), re.MULTILINE)
-                # add the year doy tuple to the result
-                atmzen += [i + (GamitSession.date.year, GamitSession.date.doy) for i in v]
-            else:
-                v = []
+                atmzen.append(read_znd(znd, GamitSession.date))
 
-            # create a lookup table for station aliases
-            for zd in v:
+                # create a lookup table for station aliases
                 for StnIns in GamitSession.StationInstances:
-                    if StnIns.StationAlias.upper() == zd[0]:
-                        alias[zd[0]] = [StnIns.NetworkCode, StnIns.StationCode]
+                    alias[StnIns.StationAlias.upper()] = [StnIns.NetworkCode, StnIns.StationCode]
 
         except Exception as e:
             tqdm.write(' -- Error parsing zenith delays for session %s: %s' % (GamitSession.NetName, str(e)))
 
+    atmzen = np.concatenate(atmzen) if atmzen else np.empty(0, dtype=ZTD_DTYPE)
+
     if not len(atmzen):
         tqdm.write(' -- No sessions with usable atmospheric zenith delays were found!')
         return
 
     # all station days are in the atmzen
-    # convert to numpy to sort and average
+    # sort once to group the records of the same station, session date and epoch
 
-    atmzen = np.array(atmzen, dtype=[('stn', 'S4'), ('y', 'i4'), ('m', 'i4'), ('d', 'i4'), ('h', 'i4'), ('mm', 'i4'),
-                                     ('mo', 'float64'), ('s', 'float64'), ('z', 'float64'),
-                                     ('yr', 'i4'), ('doy', 'i4')])
+    tqdm.write(' -- Averaging zenith delays from stations in multiple sessions...')
 
-    atmzen.sort(order=['stn', 'y', 'm', 'd', 'h', 'mm'])
+    atmzen.sort(order=ZTD_KEYS)
 
-    tqdm.write(' -- Averaging zenith delays from stations in multiple sessions...')
-    # get the stations in the processing
-    stations = np.unique(atmzen['stn'])
-    # get the unique dates for this process
-    date_vec = np.unique(np.array([atmzen['yr'], atmzen['doy']]).transpose(), axis=0)
-    # unique ztd
-    uztd = []
-    for stn in stations:
-        for date in date_vec:
-            # select the station and date
-            zd = atmzen[np.logical_and.reduce((atmzen['stn'] == stn,
-                                               atmzen['yr'] == date[0], atmzen['doy'] == date[1]))]
-            # careful, not do anything if there is not data for this station-day
-            if zd.size > 0:
-                # find the unique days
-                days = np.unique(np.array([zd['y'], zd['m'], zd['d'], zd['h'], zd['mm']]).transpose(), axis=0)
-                # average over the existing records
-                for d in days:
-                    rows = zd[np.logical_and.reduce((zd['y'] == d[0], zd['m'] == d[1],
-                                                     zd['d'] == d[2], zd['h'] == d[3], zd['mm'] == d[4]))]
-
-                    uztd.append(alias[stn] + [datetime(d[0], d[1], d[2], d[3], d[4]).strftime('%Y-%m-%d %H:%M:%S')] +
-                                [project.lower()] +
-                                [np.mean(rows['z']) - np.mean(rows['mo']), np.mean(rows['s']), np.mean(rows['z'])] +
-                                date.tolist())
+    # first record of each group
+    first = np.ones(atmzen.size, dtype=bool)
+    first[1:] = np.logical_or.reduce([atmzen[field][1:] != atmzen[field][:-1] for field in ZTD_KEYS])
+    first = np.flatnonzero(first)
+
+    count = np.diff(np.append(first, atmzen.size)).astype(float)
+
+    # average over the existing records
+    mo = np.add.reduceat(atmzen['mo'], first) / count
+    sigma = np.add.reduceat(atmzen['s'], first) / count
+    ztd = np.add.reduceat(atmzen['z'], first) / count
+
+    keys = atmzen[first]
+    epochs = zip(*[keys[field].tolist() for field in ('y', 'm', 'd', 'h', 'mm')])
+
+    uztd = [alias[stn] + ['%04i-%02i-%02i %02i:%02i:00' % epoch, project.lower(), z - m, s, z, yr, doy]
+            for stn, epoch, m, s, z, yr, doy in zip(keys['stn'].tolist(), epochs, mo.tolist(), sigma.tolist(),
+                                                    ztd.tolist(), keys['yr'].tolist(), keys['doy'].tolist())]
 
     # drop all records from the database to make sure there will be no problems with massive insert
     tqdm.write(' -- Deleting previous zenith tropospheric delays from the database...')
-    for date in date_vec:
-        cnn.query('DELETE FROM gamit_ztd WHERE "Project" = \'%s\' AND "Year" = %i AND "DOY" = %i'
-                  % (project.lower(), date[0], date[1]))
+
+    date_vec = np.unique(keys['yr'] * 1000 + keys['doy'])
+
+    cnn.query('DELETE FROM gamit_ztd WHERE "Project" = \'%s\' AND ("Year", "DOY") IN (VALUES %s)'
+              % (project.lower(), ', '.join(['(%i, %i)' % (date / 1000, date % 1000) for date in date_vec])))
 
     # now do a bulk insert
     try:
         tqdm.write(' -- Inserting zenith tropospheric delays into the database...')
 
-        cnn.executemany('INSERT INTO gamit_ztd ("NetworkCode", "StationCode", "Date", "Project", "model", "sigma", '
-                        '                       "ZTD", "Year", "DOY") VALUES (%s, %s, %s, %s, %f, %f, %f, %i, %i)',
-                        uztd)
+        cnn.copy_records('gamit_ztd', ('NetworkCode', 'StationCode', 'Date', 'Project', 'model', 'sigma', 'ZTD',
+                                       'Year', 'DOY'), uztd)
     except Exception as e:
         tqdm.write(' -- Error inserting parsed zenith delays: %s' % str(e))
 
 
-def ExecuteGlobk(GamitConfig, sessions, dates):
-
-    global cnn
-
+def globk_combination(GamitConfig, date, GlobkComb):
+    """
+    run the GLOBK combination of the sessions of date (if more than one) and parse the resulting SINEX
+    :param GamitConfig: GAMIT configuration
+    :param date: date being combined
+    :param GlobkComb: list of GamitSession objects of date
+    :return: list of rows for gamit_soln and list of messages to report
+    """
     project = GamitConfig.NetworkConfig.network_id.lower()
 
-    tqdm.write(' >> Combining with GLOBK sessions with more than one subnetwork...')
+    pwd = GamitConfig.gamitopt['solutions_dir'].rstrip('/') + '/' + date.yyyy() + '/' + date.ddd()
 
-    for date in tqdm(dates, ncols=80):
-
-        pwd = GamitConfig.gamitopt['solutions_dir'].rstrip('/') + '/' + date.yyyy() + '/' + date.ddd()
+    messages = []
+    rows = []
 
-        GlobkComb = []
+    try:
         Fatal = False
 
-        for GamitSession in sessions:
-
-            if GamitSession.date == date:
-                # add to combination
-                GlobkComb.append(GamitSession)
+        for GamitSession in GlobkComb:
+            cmd = 'grep -q \'FATAL\' ' + os.path.join(GamitSession.solution_pwd, 'monitor.log')
+            fatal = os.system(cmd)
 
-                cmd = 'grep -q \'FATAL\' ' + os.path.join(GamitSession.solution_pwd, 'monitor.log')
-                fatal = os.system(cmd)
-
-                if fatal == 0:
-                    Fatal = True
-                    tqdm.write(' >> GAMIT FATAL found in monitor of session %s %s. This combined solution will not be '
-                               'added to the database.' % (GamitSession.NetName, GamitSession.date.yyyyddd()))
+            if fatal == 0:
+                Fatal = True
+                messages.append(' >> GAMIT FATAL found in monitor of session %s %s. This combined solution will not '
+                                'be added to the database.' % (GamitSession.NetName, GamitSession.date.yyyyddd()))
 
         if not Fatal:
             if len(GlobkComb) > 1:
@@ -558,32 +648,73 @@ def ExecuteGlobk(GamitConfig, sessions, dates):
                 # parse the sinex for the only session for this doy
                 polyhedron, variance = GlobkComb[0].parse_sinex()
 
-            # insert polyherdon in gamit_soln table
+            # rows of the polyherdon for the gamit_soln table
             for key, value in polyhedron.iteritems():
                 if '.' in key:
-                    try:
-                        cnn.insert('gamit_soln',
-                                   NetworkCode=key.split('.')[0],
-                                   StationCode=key.split('.')[1],
-                                   Project=project,
-                                   Year=date.year,
-                                   DOY=date.doy,
-                                   FYear=date.fyear,
-                                   X=value.X,
-                                   Y=value.Y,
-                                   Z=value.Z,
-                                   sigmax=value.sigX * sqrt(variance),
-                                   sigmay=value.sigY * sqrt(variance),
-                                   sigmaz=value.sigZ * sqrt(variance),
-                                   sigmaxy=value.sigXY * sqrt(variance),
-                                   sigmaxz=value.sigXZ * sqrt(variance),
-                                   sigmayz=value.sigYZ * sqrt(variance),
-                                   VarianceFactor=variance)
-                    except dbConnection.dbErrInsert as e:
-                        # tqdm.write('    --> Error inserting ' + key + ' -> ' + str(e))
-                        pass
+                    rows.append((key.split('.')[0], key.split('.')[1], project, date.year, date.doy, date.fyear,
+                                 value.X, value.Y, value.Z,
+                                 value.sigX * sqrt(variance),
+                                 value.sigY * sqrt(variance),
+                                 value.sigZ * sqrt(variance),
+                                 value.sigXY * sqrt(variance),
+                                 value.sigXZ * sqrt(variance),
+                                 value.sigYZ * sqrt(variance),
+                                 variance))
                 else:
-                    tqdm.write(' >> Invalid key found in session %s -> %s' % (date.yyyyddd(), key))
+                    messages.append(' >> Invalid key found in session %s -> %s' % (date.yyyyddd(), key))
+
+    except Exception:
+        raise Exception('Error while combining the GAMIT sessions for %s:\n%s'
+                        % (date.yyyyddd(), traceback.format_exc()))
+
+    return rows, messages
+
+
+def ExecuteGlobk(GamitConfig, sessions, dates, cpus=1):
+
+    global cnn
+
+    tqdm.write(' >> Combining with GLOBK sessions with more than one subnetwork...')
+
+    columns = ('NetworkCode', 'StationCode', 'Project', 'Year', 'DOY', 'FYear', 'X', 'Y', 'Z',
+               'sigmax', 'sigmay', 'sigmaz', 'sigmaxy', 'sigmaxz', 'sigmayz', 'VarianceFactor')
+
+    combinations = []
+    for date in dates:
+        GlobkComb = [GamitSession for GamitSession in sessions if GamitSession.date == date]
+        if GlobkComb:
+            combinations.append((date, GlobkComb))
+
+    pool = None
+    if cpus > 1 and len(combinations) > 1:
+        # the combinations of each day are independent: run them in a process pool, results collected in date order
+        pool = multiprocessing.Pool(processes=min(cpus, len(combinations)))
+        results = [pool.apply_async(globk_combination, (GamitConfig, date, GlobkComb))
+                   for date, GlobkComb in combinations]
+    else:
+        results = None
+
+    try:
+        for i, (date, GlobkComb) in enumerate(tqdm(combinations, ncols=80)):
+
+            if pool is not None:
+                rows, messages = results[i].get()
+            else:
+                rows, messages = globk_combination(GamitConfig, date, GlobkComb)
+
+            for msg in messages:
+                tqdm.write(msg)
+
+            # insert polyherdon in gamit_soln table (existing solutions are left untouched)
+            try:
+                cnn.copy_records('gamit_soln', columns, rows)
+            except dbConnection.dbErrInsert as e:
+                tqdm.write('    --> Error inserting the solution for %s -> %s' % (date.yyyyddd(), str(e)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
     return
 
 
@@ -12,6 +12,7 @@ import pyDate
 import random
 import string
 import os
+import copy
 
 COMPLETION = 0.5
 INTERVAL = 120
@@ -105,9 +106,117 @@ class Station(object):
         return 'pyStation.Station(' + str(self) + ')'
 
 
+class ProjectMetadataCache(object):
+    """
+    Bulk loader of the metadata needed to create the StationInstances of a project. Instead of querying the station
+    info, rinex_proc and ppp_soln tables once per station-day, the information for all the stations and dates of the
+    project is read once and served from memory
+    """
+    def __init__(self, cnn, archive, stations, dates):
+        """
+        :param cnn: connection to database object
+        :param archive: archive object to build the rinex paths
+        :param stations: list of pyStation.Station objects in the project
+        :param dates: list with the first and last date (pyDate.Date) of the project
+        """
+        self.stninfo = dict()
+        self.rinex = dict()
+        self.ppp = dict()
+        # a priori coordinates (evaluated on demand, see get_apr)
+        self.apr = dict()
+
+        if not len(stations):
+            return
+
+        # the conversion to DHARP is done once per station on a copy of the records, so that station.StationInfo is
+        # left untouched. Done here so that no queries are needed when the cache is used by other processes
+        for stn in stations:
+            self.stninfo[str(stn)] = '\n'.join([str(stn.StationInfo.to_dharp(copy.copy(record)))
+                                                for record in stn.StationInfo.records])
+
+        stn_list = ','.join(['\'%s.%s\'' % (stn.NetworkCode, stn.StationCode) for stn in stations])
+
+        date_range = '(%i, %i) AND (%i, %i)' % (dates[0].year, dates[0].doy, dates[-1].year, dates[-1].doy)
+
+        # rinex files for processing: select the archive structure columns to build the paths
+        sql_list = ['"%s"' % level['rinex_col_in'] for level in archive.levels]
+
+        rs = cnn.query('SELECT "NetworkCode" as net, "StationCode" as stn, "ObservationYear" as y, '
+                       '"ObservationDOY" as d, %s, "Filename" FROM rinex_proc '
+                       'WHERE "NetworkCode" || \'.\' || "StationCode" IN (%s) AND '
+                       '("ObservationYear", "ObservationDOY") BETWEEN %s'
+                       % (', '.join(sql_list), stn_list, date_range))
+
+        for record in rs.dictresult():
+            key = (record['net'], record['stn'], record['y'], record['d'])
+            # keep the first record, as build_rinex_path would
+            if key not in self.rinex:
+                self.rinex[key] = archive.rinex_path_from_record(record)
+
+        # ppp solutions (for debugging purposes)
+        rs = cnn.query_float('SELECT * FROM ppp_soln '
+                             'WHERE "NetworkCode" || \'.\' || "StationCode" IN (%s) AND '
+                             '("Year", "DOY") BETWEEN %s' % (stn_list, date_range), as_dict=True)
+
+        for record in rs:
+            key = (record['NetworkCode'], record['StationCode'], record['Year'], record['DOY'])
+            if key not in self.ppp:
+                self.ppp[key] = record
+
+    def get_stninfo(self, station, date):
+        """
+        returns the station information string (converted to DHARP) of station
+        :param station: pyStation.Station object
+        :param date: date being processed. Raises pyStationInfoException if no record covers date
+        :return: a string in station information format
+        """
+        stninfo = station.StationInfo
+
+        if stninfo.find_record(date) is None:
+            raise pyStationInfo.pyStationInfoException('Could not find a matching station.info record for ' +
+                                                       station.NetworkCode + '.' + station.StationCode + ' ' +
+                                                       date.yyyymmdd() + ' (' + date.yyyyddd() + ')')
+
+        return self.stninfo[str(station)]
+
+    def get_rinex_path(self, station, date):
+
+        return self.rinex.get((station.NetworkCode, station.StationCode, date.year, date.doy))
+
+    def get_ppp(self, station, date):
+
+        return self.ppp.get((station.NetworkCode, station.StationCode, date.year, date.doy))
+
+    def get_apr(self, station, date, sigma_h, sigma_v):
+        """
+        returns the a priori coordinate, sigmas, jump window and source of station for date (same as
+        station.etm.get_xyz_s). The first time a station is requested, all its days with RINEX data are evaluated at
+        once
+        :param station: pyStation.Station object
+        :param date: date being processed
+        """
+        key = (str(station), sigma_h, sigma_v)
+
+        if key not in self.apr:
+            self.apr[key] = dict()
+
+            if station.good_rinex:
+                xyz, sig, window, source = station.etm.get_xyz_s_vec([d.year for d in station.good_rinex],
+                                                                     [d.doy for d in station.good_rinex],
+                                                                     sigma_h=sigma_h, sigma_v=sigma_v)
+
+                for i, d in enumerate(station.good_rinex):
+                    self.apr[key][d.mjd] = (xyz[:, i:i + 1], sig[:, i:i + 1], window[i], source[i])
+
+        if date.mjd in self.apr[key]:
+            return self.apr[key][date.mjd]
+        else:
+            return station.etm.get_xyz_s(date.year, date.doy, sigma_h=sigma_h, sigma_v=sigma_v)
+
+
 class StationInstance(object):
 
-    def __init__(self, cnn, archive, station, date, GamitConfig):
+    def __init__(self, cnn, archive, station, date, GamitConfig, metadata=None):
 
         self.NetworkCode = station.NetworkCode
         self.StationCode = station.StationCode
@@ -121,33 +230,49 @@ class StationInstance(object):
         self.otl_H = station.otl_H
 
         # save the station information as text
-        self.StationInfo = pyStationInfo.StationInfo(cnn,
-                                                     station.NetworkCode, station.StationCode, date).return_stninfo()
+        if metadata is not None:
+            self.StationInfo = metadata.get_stninfo(station, date)
+        else:
+            self.StationInfo = pyStationInfo.StationInfo(cnn, station.NetworkCode, station.StationCode,
+                                                         date).return_stninfo()
 
         self.date = date  # type: pyDate.Date
         self.Archive_path = GamitConfig.archive_path
 
         # get the APR and sigmas for this date (let get_xyz_s determine which side of the jump returns, if any)
-        self.Apr, self.Sigmas, \
-            self.Window, self.source = station.etm.get_xyz_s(self.date.year, self.date.doy,
-                                                             sigma_h=float(GamitConfig.gamitopt['sigma_floor_h']),
-                                                             sigma_v=float(GamitConfig.gamitopt['sigma_floor_v']))
+        if metadata is not None:
+            self.Apr, self.Sigmas, \
+                self.Window, self.source = metadata.get_apr(station, self.date,
+                                                            float(GamitConfig.gamitopt['sigma_floor_h']),
+                                                            float(GamitConfig.gamitopt['sigma_floor_v']))
+        else:
+            self.Apr, self.Sigmas, \
+                self.Window, self.source = station.etm.get_xyz_s(self.date.year, self.date.doy,
+                                                                 sigma_h=float(GamitConfig.gamitopt['sigma_floor_h']),
+                                                                 sigma_v=float(GamitConfig.gamitopt['sigma_floor_v']))
 
         # rinex file
-        self.ArchiveFile = archive.build_rinex_path(self.NetworkCode, self.StationCode,
-                                                    self.date.year, self.date.doy)
+        if metadata is not None:
+            self.ArchiveFile = metadata.get_rinex_path(station, self.date)
+        else:
+            self.ArchiveFile = archive.build_rinex_path(self.NetworkCode, self.StationCode,
+                                                        self.date.year, self.date.doy)
 
         self.filename = self.StationAlias + self.date.ddd() + '0.' + self.date.yyyy()[2:4] + 'd.Z'
 
         # save some information for debugging purposes
-        rs = cnn.query_float('SELECT * FROM ppp_soln WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' AND '
-                             '"Year" = %s AND "DOY" = %s'
-                             % (self.NetworkCode, self.StationCode, self.date.yyyy(), self.date.ddd()), as_dict=True)
-
-        if len(rs) > 0:
-            self.ppp = rs[0]
+        if metadata is not None:
+            self.ppp = metadata.get_ppp(station, self.date)
         else:
-            self.ppp = None
+            rs = cnn.query_float('SELECT * FROM ppp_soln WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
+                                 'AND "Year" = %s AND "DOY" = %s'
+                                 % (self.NetworkCode, self.StationCode, self.date.yyyy(), self.date.ddd()),
+                                 as_dict=True)
+
+            if len(rs) > 0:
+                self.ppp = rs[0]
+            else:
+                self.ppp = None
 
     def GetRinexFilename(self):
 
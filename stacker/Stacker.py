@@ -13,6 +13,7 @@ import numpy
 from pyDate import Date
 from tqdm import tqdm
 import pyStack
+import pyNEQStack
 import os
 import re
 from Utils import process_date
@@ -22,6 +23,7 @@ import json
 
 pi = 3.141592653589793
 etm_vertices = []
+neq_designs = []
 
 
 def plot_etm(cnn, stack, station, directory):
@@ -45,7 +47,7 @@ def plot_etm(cnn, stack, station, directory):
 
 def station_etm(station, stn_ts, stack_name, iteration=0):
 
-    cnn = dbConnection.Cnn("gnss_data.cfg")
+    cnn = dbConnection.get_connection("gnss_data.cfg")
 
     vertices = None
 
@@ -71,6 +73,31 @@ def station_etm(station, stn_ts, stack_name, iteration=0):
     return vertices if vertices else None
 
 
+def station_neq(station, stn_ts, stack_name):
+
+    cnn = dbConnection.get_connection("gnss_data.cfg")
+
+    try:
+        design = pyNEQStack.station_design(cnn, station['NetworkCode'], station['StationCode'], stn_ts, stack_name)
+
+    except pyETM.pyETMException:
+
+        design = None
+
+    return design
+
+
+def neq_callback_handler(job):
+
+    global neq_designs
+
+    if job.exception:
+        tqdm.write(' -- Fatal error on node %s message from node follows -> \n%s' % (job.ip_addr, job.exception))
+    else:
+        if job.result is not None:
+            neq_designs.append(job.result)
+
+
 def callback_handler(job):
 
     global etm_vertices
@@ -123,12 +150,15 @@ def calculate_etms(cnn, stack, JobServer, iterations, create_target=True):
                                                 ('fy', 'float64')])
 
     if create_target:
+        # sort the vertices by date once, each target polyhedron is a view of the store
+        store = pyStack.VertexStore(vertices)
+
         target = []
         for i in tqdm(range(len(stack.dates)), ncols=160, desc=' >> Initializing the target polyhedrons'):
             dd = stack.dates[i]
             if not stack[i].aligned:
                 # not aligned, put in a target polyhedron
-                target.append(pyStack.Polyhedron(vertices, 'etm', dd))
+                target.append(pyStack.Polyhedron(store.get_date(dd), 'etm', dd, view=True))
             else:
                 # already aligned, no need for a target polyhedron
                 target.append([])
@@ -136,6 +166,42 @@ def calculate_etms(cnn, stack, JobServer, iterations, create_target=True):
         return target
 
 
+def calculate_designs(cnn, stack, JobServer):
+    """
+    Parallel calculation of the station design matrices used to stack using normal equations
+    :param cnn: connection to the db
+    :param stack: object with the list of polyhedrons
+    :param JobServer: parallel.python object
+    :return: list of designs (see pyNEQStack.station_design)
+    """
+    global neq_designs
+
+    qbar = tqdm(total=len(stack.stations), desc=' >> Calculating design matrices', ncols=160)
+
+    modules = ('pyETM', 'pyDate', 'dbConnection', 'traceback', 'pyNEQStack')
+    deps = [os.path.splitext(module.__file__)[0] + '.py' for module in (pyNEQStack, pyStack)]
+
+    JobServer.create_cluster(station_neq, deps=deps, progress_bar=qbar, callback=neq_callback_handler,
+                             modules=modules)
+
+    neq_designs = []
+
+    for station in stack.stations:
+
+        # extract the time series from the polyhedron data
+        stn_ts = stack.get_station(station['NetworkCode'], station['StationCode'])
+
+        JobServer.submit(station, stn_ts, stack.name)
+
+    JobServer.wait()
+
+    qbar.close()
+
+    JobServer.close_cluster()
+
+    return neq_designs
+
+
 def load_periodic_space(periodic_file):
     """
     Load the periodic space parameters from an ITRF file
@@ -253,6 +319,13 @@ def main():
     parser.add_argument('-d', '--date_end', nargs=1, metavar='date',
                         help='Limit the polyhedrons to the specified date. Can be in wwww-d, yyyy_ddd, yyyy/mm/dd '
                              'or fyear format')
+    parser.add_argument('-neq', '--normal_equations', action='store_true',
+                        help="Align the polyhedrons by solving the station ETMs and the daily transformations in a "
+                             "single adjustment of normal equations instead of iterating between the alignment and "
+                             "the ETMs. The frame is defined by the PPP ETMs (or by the polyhedrons already in the "
+                             "stack). Ignores --max_iters")
+    parser.add_argument('-scale', '--estimate_scale', action='store_true',
+                        help="Estimate scale in the daily transformations (only with --normal_equations)")
     parser.add_argument('-np', '--noparallel', action='store_true', help="Execute command without parallelization.")
 
     args = parser.parse_args()
@@ -309,39 +382,51 @@ def main():
     # stack.to_json('alignment.json')
     # exit()
 
-    for i in range(max_iters):
-        # create the target polyhedrons based on iteration number (i == 0: PPP)
-
-        target = calculate_etms(cnn, stack, JobServer, i)
-
-        qbar = tqdm(total=len(stack), ncols=160, desc=' >> Aligning polyhedrons (%i of %i)' % (i+1, max_iters))
+    if args.normal_equations:
+        designs = calculate_designs(cnn, stack, JobServer)
 
-        # work on each polyhedron of the stack
-        for j in range(len(stack)):
+        neq = pyNEQStack.NEQStack(stack, designs, args.estimate_scale)
 
-            qbar.update()
+        print ' >> Solving %i ETM parameters and %i daily transformations' % (neq.params, neq.helmert_days.size)
 
-            if not stack[j].aligned:
-                # do not move this if up one level: to speed up the target polyhedron loading process, the target is
-                # set to an empty list when the polyhedron is already aligned
-                if stack[j].date != target[j].date:
-                    # raise an error if dates don't agree!
-                    raise StandardError('Error processing %s: dates don\'t agree (target date %s)'
-                                        % (stack[j].date.yyyyddd(), target[j].date.yyyyddd()))
-                else:
-                    # should only attempt to align a polyhedron that is unaligned
-                    # do not set the polyhedron as aligned unless we are in the max iteration step
-                    stack[j].align(target[j], True if i == max_iters - 1 else False)
-                    # write info to the screen
-                    qbar.write(' -- %s (%3i) %2i it: wrms: %4.1f T %5.1f %5.1f %5.1f '
-                               'R (%5.1f %5.1f %5.1f)*1e-9' %
-                               (stack[j].date.yyyyddd(), stack[j].stations_used, stack[j].iterations,
-                                stack[j].wrms * 1000, stack[j].helmert[-3] * 1000, stack[j].helmert[-2] * 1000,
-                                stack[j].helmert[-1] * 1000, stack[j].helmert[-6], stack[j].helmert[-5],
-                                stack[j].helmert[-4]))
+        neq.solve()
+        neq.apply(verbose=True)
 
         stack.transformations.append([poly.info() for poly in stack])
-        qbar.close()
+    else:
+        for i in range(max_iters):
+            # create the target polyhedrons based on iteration number (i == 0: PPP)
+
+            target = calculate_etms(cnn, stack, JobServer, i)
+
+            qbar = tqdm(total=len(stack), ncols=160, desc=' >> Aligning polyhedrons (%i of %i)' % (i+1, max_iters))
+
+            # work on each polyhedron of the stack
+            for j in range(len(stack)):
+
+                qbar.update()
+
+                if not stack[j].aligned:
+                    # do not move this if up one level: to speed up the target polyhedron loading process, the target is
+                    # set to an empty list when the polyhedron is already aligned
+                    if stack[j].date != target[j].date:
+                        # raise an error if dates don't agree!
+                        raise StandardError('Error processing %s: dates don\'t agree (target date %s)'
+                                            % (stack[j].date.yyyyddd(), target[j].date.yyyyddd()))
+                    else:
+                        # should only attempt to align a polyhedron that is unaligned
+                        # do not set the polyhedron as aligned unless we are in the max iteration step
+                        stack[j].align(target[j], True if i == max_iters - 1 else False)
+                        # write info to the screen
+                        qbar.write(' -- %s (%3i) %2i it: wrms: %4.1f T %5.1f %5.1f %5.1f '
+                                   'R (%5.1f %5.1f %5.1f)*1e-9' %
+                                   (stack[j].date.yyyyddd(), stack[j].stations_used, stack[j].iterations,
+                                    stack[j].wrms * 1000, stack[j].helmert[-3] * 1000, stack[j].helmert[-2] * 1000,
+                                    stack[j].helmert[-1] * 1000, stack[j].helmert[-6], stack[j].helmert[-5],
+                                    stack[j].helmert[-4]))
+
+            stack.transformations.append([poly.info() for poly in stack])
+            qbar.close()
 
     if args.redo_stack:
         # before removing common modes (or inheriting periodic terms), calculate ETMs with final aligned solutions
@@ -12,6 +12,7 @@ import os
 import numpy as np
 from Utils import process_date
 from pyStack import Polyhedron
+from pyStack import VertexStore
 from datetime import datetime
 from tqdm import tqdm
 from pyDate import Date
@@ -49,9 +50,9 @@ class DRA(list):
             'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i)'
             'ORDER BY "NetworkCode", "StationCode"' % (project, end_date.year, end_date.doy))
 
-        self.gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
-                                                              ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
-                                                              ('fy', 'float64')])
+        self.store = VertexStore(np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
+                                                                 ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+                                                                 ('fy', 'float64')]))
 
         dates = self.cnn.query_float('SELECT "Year", "DOY" FROM gamit_soln WHERE "Project" = \'%s\' '
                                      'AND ("Year", "DOY") <= (%i, %i) '
@@ -67,7 +68,7 @@ class DRA(list):
                                              % (project, end_date.year, end_date.doy), as_dict=True)
 
         for d in tqdm(self.dates, ncols=160, desc=' >> Initializing the stack polyhedrons'):
-            self.append(Polyhedron(self.gamit_vertices, project, d))
+            self.append(Polyhedron(self.store.get_date(d), project, d, view=True))
 
     def stack_dra(self):
 
@@ -94,16 +95,7 @@ class DRA(list):
         :return: a numpy array with the time series [x, y, z, yr, doy, fyear]
         """
 
-        stnstr = NetworkCode + '.' + StationCode
-
-        ts = []
-
-        for poly in self:
-            p = poly.vertices[poly.vertices['stn'] == stnstr]
-            if p.size:
-                ts.append([p['x'][0], p['y'][0], p['z'][0], p['yr'][0], p['dd'][0], p['fy'][0]])
-
-        return np.array(ts)
+        return self.store.get_time_series(NetworkCode + '.' + StationCode)
 
     def to_json(self, json_file):
         json_dump = dict()
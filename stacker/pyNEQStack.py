@@ -4,26 +4,29 @@ Date: 6/12/18 10:28 AM
 Author: Demian D. Gomez
 """
 
-import dbConnection
 import pyOptions
-import argparse
 import pyETM
 import pyJobServer
 import numpy
 import pyDate
-from pyDate import Date
 from tqdm import tqdm
 import traceback
 from pprint import pprint
 import os
 import numpy as np
 from scipy.stats import chi2
-from Utils import process_date
+from scipy.linalg import cho_factor, cho_solve
+from scipy.linalg.blas import dsyrk
+import pyStack
 from Utils import ct2lg
 from Utils import ecef2lla
 from Utils import rotct2lg
 
 LIMIT = 2.5
+# polyhedrons with less stations do not enter the normal equations
+MIN_STATIONS = 3
+# number of days reduced at once (Schur complement) when forming the normal equations
+CHUNK_DAYS = 64
 
 
 def adjust_lsq(A, L, P=None):
@@ -150,86 +153,482 @@ def rotate_sigmas(ecef, lat, lon):
     return dneu
 
 
-def dra(cnn, project, dates):
+def helmert_design(xyz, rot=True, scale=False):
+    """
+    partials of the daily Helmert transformation (same column order and 1e-9 scaling used by pyStack.Polyhedron)
+    :param xyz: array (n, 3) with the coordinates where the transformation is evaluated
+    :return: array of shape (n, 3, params)
+    """
+    x = xyz[:, 0] * 1e-9
+    y = xyz[:, 1] * 1e-9
+    z = xyz[:, 2] * 1e-9
+
+    B = np.zeros((xyz.shape[0], 3, (6 if rot else 3) + (1 if scale else 0)))
+
+    if rot:
+        B[:, 0, 1] = -z
+        B[:, 0, 2] = y
+        B[:, 1, 0] = z
+        B[:, 1, 2] = -x
+        B[:, 2, 0] = -y
+        B[:, 2, 1] = x
+        B[:, :, 3:6] = np.eye(3)
+    else:
+        B[:, :, 0:3] = np.eye(3)
+
+    if scale:
+        B[:, 0, -1] = x
+        B[:, 1, -1] = y
+        B[:, 2, -1] = z
+
+    return B
 
-    rs = cnn.query('SELECT "NetworkCode", "StationCode" FROM gamit_soln '
-                   'WHERE "Project" = \'%s\' AND "FYear" BETWEEN %.4f AND %.4f GROUP BY "NetworkCode", "StationCode" '
-                   'ORDER BY "NetworkCode", "StationCode"' % (project, dates[0].fyear, dates[1].fyear))
 
-    stnlist = rs.dictresult()
+def station_design(cnn, NetworkCode, StationCode, stn_ts, stack_name):
+    """
+    obtain the ETM design matrix of a station to stack the time series using normal equations
+    :param stn_ts: time series of the station (as returned by Stack.get_station)
+    :return: dictionary with the design matrix (one row per epoch in mjd), the label of each column and the PPP ETM
+    evaluated at the epochs of the time series (used to define the frame). None if the station has no design matrix
+    """
+    soln = pyETM.GamitSoln(cnn, stn_ts, NetworkCode, StationCode, stack_name)
 
-    # get the epochs
-    ep = cnn.query('SELECT "Year", "DOY" FROM gamit_soln '
-                   'WHERE "Project" = \'%s\' AND "FYear" BETWEEN %.4f AND %.4f'
-                   'GROUP BY "Year", "DOY" ORDER BY "Year", "DOY"' % (project, dates[0].fyear, dates[1].fyear))
+    etm = pyETM.ETM(cnn, soln)
 
-    ep = ep.dictresult()
+    if etm.A is None:
+        return None
 
-    epochs = [Date(year=item['Year'], doy=item['DOY']) for item in ep]
+    stnstr = NetworkCode + '.' + StationCode
 
-    A = np.array([])
-    Ax = []
-    Ay = []
-    Az = []
+    # columns with the same label represent the same function of time in all the stations, which is what the
+    # minimal constraints need. Jumps are particular to each station
+    labels = ['polynomial %i' % i for i in range(etm.A.linear_params)] + \
+             ['%s jump %i' % (stnstr, i) for i in range(etm.A.jump_params)] + \
+             ['periodic sin %.8f' % f for f in etm.Periodic.p.frequencies] + \
+             ['periodic cos %.8f' % f for f in etm.Periodic.p.frequencies]
 
-    for station in stnlist:
+    # jump constraints of the ETM (pseudo-observations equal to zero, see pyETM.Design)
+    constrains = np.array(etm.A(constrains=True))[etm.A.shape[0]:]
 
-        print 'stacking %s.%s' % (station['NetworkCode'], station['StationCode'])
+    design = {'stn': stnstr, 'mjd': soln.mjd, 'A': np.array(etm.A), 'labels': labels, 'constrains': constrains,
+              'target_mjd': None, 'target': None}
 
+    try:
+        ppp = pyETM.PPPETM(cnn, NetworkCode, StationCode)
+
+        if ppp.A is not None:
+            index = np.isin(ppp.soln.mjds, soln.mjd)
+
+            neu = [np.dot(ppp.As[index, :], ppp.C[i]) for i in range(3)]
+
+            xyz = ppp.rotate_2xyz(np.array(neu)) + np.array([ppp.soln.auto_x, ppp.soln.auto_y, ppp.soln.auto_z])
+
+            design['target_mjd'] = ppp.soln.mjds[index]
+            design['target'] = xyz.transpose()
+
+    except pyETM.pyETMException:
+        # no PPP ETM: the station does not participate in the definition of the frame
+        pass
+
+    return design
+
+
+class NEQStack(object):
+    """
+    Stack the polyhedrons by accumulating the normal equations of the station ETMs (one design matrix per station,
+    shared by the X Y Z components) and of the daily Helmert transformations. The normal equations of each day are
+    reduced (Schur complement) before solving for the ETM parameters, so the daily parameters are never part of the
+    global system (a day with a singular block uses its pseudo-inverse and is reported, see singular_days). The jump
+    constraints of the ETMs enter as pseudo-observations, as in the ETM adjustment. Polyhedrons that are already aligned
+    enter the system without a transformation. When all the polyhedrons are being aligned, the datum is given by minimal
+    constraints: the mean transformation between the ETMs and the PPP ETMs (evaluated at the stations with PPP) is zero
+    for every function of time shared by all the stations (position, velocity, periodic terms).
+    """
+    def __init__(self, stack, designs, scale=False, min_stations=MIN_STATIONS, chunk_days=CHUNK_DAYS):
+        """
+        :param stack: pyStack.Stack object
+        :param designs: list of dictionaries returned by station_design (None items are ignored)
+        :param scale: estimate scale in the daily transformations
+        :param min_stations: polyhedrons with less stations than this are not part of the system (they are aligned to
+        the stacked ETMs once the system is solved, see apply)
+        :param chunk_days: number of days reduced at once
+        """
+        self.stack = stack
+        self.scale = scale
+        self.rot = stack[0].rot if len(stack) else True
+        self.chunk_days = chunk_days
+
+        self.designs = [d for d in designs if d is not None]
+        self.designs.sort(key=lambda d: d['stn'])
+
+        self.stations = np.array([d['stn'] for d in self.designs], dtype='S8')
+
+        k = np.array([d['A'].shape[1] for d in self.designs], dtype=int)
+        self.k = k
+        self.kmax = int(k.max()) if k.size else 0
+        # offset of the parameters of each station in the global system: X parameters, then Y, then Z
+        self.offset = np.concatenate(([0], np.cumsum(3 * k)))
+        self.params = int(self.offset[-1])
+
+        if not self.params:
+            raise ValueError('No station ETM design matrices to stack')
+
+        # all the vertices of the stack (day major, sorted by station within each day)
+        vertices = np.concatenate([poly.vertices for poly in stack])
+        day = np.repeat(np.arange(len(stack)), [poly.rows for poly in stack])
+
+        # station of each vertex
+        sid = np.searchsorted(self.stations, vertices['stn'])
+        sid[sid == self.stations.size] = 0
+        valid = self.stations[sid] == vertices['stn']
+
+        # design matrix row of each vertex (epochs removed by GamitSoln as blunders are not used)
+        mjd = pyDate.yeardoy2mjd_vec(vertices['yr'], vertices['dd'])
+        row = np.zeros(vertices.size, dtype=int)
+
+        order = np.argsort(sid, kind='mergesort')
+        bounds = np.searchsorted(sid[order], np.arange(self.stations.size + 1))
+
+        for s, d in enumerate(self.designs):
+            i = order[bounds[s]:bounds[s + 1]]
+            i = i[valid[i]]
+            r = np.searchsorted(d['mjd'], mjd[i])
+            r[r == d['mjd'].size] = 0
+            valid[i[d['mjd'][r] != mjd[i]]] = False
+            row[i] = r
+
+        # classify the days: already aligned (no transformation), in the system or with too few stations
+        count = np.bincount(day[valid], minlength=len(stack))
+        aligned = np.array([poly.aligned for poly in stack], dtype=bool)
+
+        self.helmert_days = np.flatnonzero(np.logical_and(~aligned, count >= min_stations))
+        self.excluded_days = np.flatnonzero(np.logical_and(~aligned, count < min_stations))
+        self.fixed = bool(np.any(aligned[count > 0]))
+
+        hd = -np.ones(len(stack), dtype=int)
+        hd[self.helmert_days] = np.arange(self.helmert_days.size)
+
+        use = np.logical_and(valid, np.logical_or(aligned, hd >= 0)[day])
+
+        self.sid = sid[use]
+        self.row = row[use]
+        self.day = day[use]
+        self.hd = hd[self.day]
+        self.obs = self.sid.size
+
+        xyz = np.column_stack((vertices['x'][use], vertices['y'][use], vertices['z'][use]))
+
+        # a priori coordinate of each station
+        self.x0 = np.zeros((self.stations.size, 3))
+        order = np.argsort(self.sid, kind='mergesort')
+        bounds = np.searchsorted(self.sid[order], np.arange(self.stations.size + 1))
+        self.stn_obs = [order[bounds[s]:bounds[s + 1]] for s in range(self.stations.size)]
+
+        for s, i in enumerate(self.stn_obs):
+            if i.size:
+                self.x0[s] = np.median(xyz[i], axis=0)
+
+        self.l = xyz - self.x0[self.sid]
+        self.B = helmert_design(self.x0[self.sid], self.rot, self.scale)
+        self.nh = self.B.shape[2]
+
+        # design matrix row of each observation (padded to kmax) and its position in the global system (parameters
+        # beyond the number of parameters of the station point to an extra row that is discarded)
+        self.a = np.zeros((self.obs, self.kmax))
+        self.index = np.empty((self.obs, 3, self.kmax), dtype=int)
+        self.index.fill(self.params)
+
+        for s, d in enumerate(self.designs):
+            i = self.stn_obs[s]
+            ks = k[s]
+            self.a[i, :ks] = d['A'][self.row[i]]
+            self.index[i, :, :ks] = self.offset[s] + np.arange(3)[:, np.newaxis] * ks + np.arange(ks)
+
+        # the helmert days are consecutive in the observation vector
+        self.hobs = np.flatnonzero(self.hd >= 0)
+        self.hstart = np.searchsorted(self.hd[self.hobs], np.arange(self.helmert_days.size + 1))
+
+        self.constrains = self.datum_constrains()
+
+        # jump constraints of each station (rows of the station design matrix, see station_design)
+        self.jump_constrains = [d.get('constrains', np.zeros((0, d['A'].shape[1]))) for d in self.designs]
+        self.jump_rows = sum([c.shape[0] for c in self.jump_constrains])
+
+        # helmert days with a singular normal matrix (solved with the pseudo-inverse)
+        self.singular_days = set()
+
+        self.P = np.ones((self.obs, 3))
+        self.x = np.zeros(self.params)
+        self.h = np.zeros((self.helmert_days.size, self.nh))
+        self.v = np.zeros((self.obs, 3))
+        self.factor = 1.
+        self.iterations = 0
+
+    def datum_constrains(self):
+        """
+        minimal constraints for the functions of time shared by all the stations, only when no polyhedron is already
+        aligned (otherwise the aligned polyhedrons define the frame)
+        :return: tuple (C, r) such that C x = r, or None
+        """
+        if self.fixed or not self.helmert_days.size:
+            return None
+
+        shared = set(self.designs[0]['labels'])
+        for d in self.designs[1:]:
+            shared &= set(d['labels'])
+
+        shared = sorted(shared)
+
+        # stations that define the frame: those with a PPP ETM. If none has one, use an inner constraint
+        frame = [s for s, d in enumerate(self.designs) if d['target'] is not None and self.stn_obs[s].size]
+        if len(frame) < MIN_STATIONS:
+            frame = [s for s in range(len(self.designs)) if self.stn_obs[s].size]
+
+        C = np.zeros((len(shared) * self.nh, self.params))
+        q = np.zeros(self.params)
+
+        B0 = helmert_design(self.x0, self.rot, self.scale)
+
+        for s in frame:
+            d = self.designs[s]
+            ks = self.k[s]
+            o = self.offset[s]
+
+            for j, label in enumerate(shared):
+                col = d['labels'].index(label)
+                for c in range(3):
+                    C[j * self.nh:(j + 1) * self.nh, o + c * ks + col] += B0[s, c]
+
+            if d['target'] is not None:
+                r = np.searchsorted(d['mjd'], d['target_mjd'])
+                r[r == d['mjd'].size] = 0
+                f = d['mjd'][r] == d['target_mjd']
+                if np.sum(f) > ks:
+                    # parameters of the PPP ETM in the basis of the station design matrix
+                    q[o:o + 3 * ks] = np.linalg.lstsq(d['A'][r[f]], d['target'][f] - self.x0[s],
+                                                      rcond=-1)[0].transpose().ravel()
+
+        return C, np.dot(C, q)
+
+    def model(self):
+        """
+        :return: value of the station ETMs for each observation (array of shape (obs, 3))
+        """
+        x = np.append(self.x, 0.)
+        return np.einsum('ij,icj->ic', self.a, x[self.index])
+
+    def normal_equations(self):
+        """
+        accumulate the normal equations of the station ETMs and reduce the daily Helmert parameters
+        :return: reduced normal matrix and vector, and the factors needed to recover the Helmert parameters
+        """
+        P = self.P
+
+        # Fortran order so that dsyrk can update N in place
+        N = np.zeros((self.params, self.params), order='F')
+        u = np.zeros(self.params)
+
+        # station blocks (the three components use the same design matrix)
+        for s, i in enumerate(self.stn_obs):
+            ks = self.k[s]
+            a = self.a[i, :ks]
+            for c in range(3):
+                o = self.offset[s] + c * ks
+                aw = a * P[i, c][:, np.newaxis]
+                N[o:o + ks, o:o + ks] += np.dot(aw.transpose(), a)
+                u[o:o + ks] += np.dot(aw.transpose(), self.l[i, c])
+
+                # jump constraints (equal to zero) with the weight of an observation that was not reweighed
+                if self.jump_constrains[s].shape[0]:
+                    cs = self.jump_constrains[s]
+                    N[o:o + ks, o:o + ks] += np.dot(cs.transpose(), cs) / self.factor ** 2
+
+        # Cholesky factors of the daily blocks and reduced daily vectors
+        Linv = np.zeros((self.helmert_days.size, self.nh, self.nh))
+        y = np.zeros((self.helmert_days.size, self.nh))
+
+        for d0 in range(0, self.helmert_days.size, self.chunk_days):
+            d1 = min(d0 + self.chunk_days, self.helmert_days.size)
+
+            i = self.hobs[self.hstart[d0]:self.hstart[d1]]
+            dc = self.hd[i] - d0
+            starts = self.hstart[d0:d1] - self.hstart[d0]
+
+            B = self.B[i]
+            Pc = P[i]
+
+            Ndd = np.add.reduceat(np.einsum('ic,ich,ick->ihk', Pc, B, B), starts, axis=0)
+            ud = np.add.reduceat(np.einsum('ic,ich,ic->ih', Pc, B, self.l[i]), starts, axis=0)
+
+            try:
+                Linv[d0:d1] = np.linalg.inv(np.linalg.cholesky(Ndd))
+            except np.linalg.LinAlgError:
+                # at least one of the days cannot be solved (e.g. not enough geometry after reweighing)
+                for d in range(d0, d1):
+                    Linv[d] = self.inverse_factor(Ndd[d - d0], d)
+            y[d0:d1] = np.einsum('dkh,dh->dk', Linv[d0:d1], ud)
+
+            # G = N_sd L^-T for all the days in the chunk
+            E = np.einsum('ich,ikh->ick', B, Linv[d0:d1][dc])
+            G = np.zeros((self.params + 1, (d1 - d0) * self.nh))
+
+            rows = np.broadcast_to(self.index[i][:, :, :, np.newaxis], (i.size, 3, self.kmax, self.nh))
+            cols = np.broadcast_to((dc[:, np.newaxis] * self.nh + np.arange(self.nh))[:, np.newaxis, np.newaxis, :],
+                                   (i.size, 3, self.kmax, self.nh))
+
+            G[rows, cols] = Pc[:, :, np.newaxis, np.newaxis] * self.a[i][:, np.newaxis, :, np.newaxis] * \
+                E[:, :, np.newaxis, :]
+            G = G[:-1]
+
+            # only the upper triangle is updated
+            N = dsyrk(-1., G.transpose(), beta=1., c=N, trans=1, overwrite_c=True)
+            u -= np.dot(G, y[d0:d1].ravel())
+
+        N = np.triu(N) + np.triu(N, 1).transpose()
+
+        return N, u, Linv, y
+
+    def inverse_factor(self, Ndd, d):
+        """
+        factor F of the inverse of the normal matrix of a helmert day (F^T F = Ndd^-1): inverse of the Cholesky factor
+        or, if Ndd is singular, the factor of its pseudo-inverse (the day is added to singular_days)
+        :param d: index of the day in helmert_days
+        """
         try:
-            etm = pyETM.GamitETM(cnn, station['NetworkCode'], station['StationCode'], project=project)
-        except Exception as e:
-            print " Exception: " + str(e)
-            continue
+            return np.linalg.inv(np.linalg.cholesky(Ndd))
+        except np.linalg.LinAlgError:
+            self.singular_days.add(d)
 
-        x = etm.soln.x
-        y = etm.soln.y
-        z = etm.soln.z
+            e, V = np.linalg.eigh(Ndd)
+            w = np.zeros(e.size)
+            use = e > e.max() * Ndd.shape[0] * np.finfo(np.float).eps
+            w[use] = 1 / np.sqrt(e[use])
 
-        Ax.append(np.array([np.zeros(x.shape), -z, y, np.ones(x.shape), np.zeros(x.shape), np.zeros(x.shape)]).transpose())
-        Ay.append(np.array([z, np.zeros(x.shape), -x, np.zeros(x.shape), np.ones(x.shape), np.zeros(x.shape)]).transpose())
-        Az.append(np.array([-y, x, np.zeros(x.shape), np.zeros(x.shape), np.zeros(x.shape), np.ones(x.shape)]).transpose())
+            return w[:, np.newaxis] * V.transpose()
 
-        x = np.column_stack((Ax, etm.A, np.zeros(etm.A.shape), np.zeros(etm.A.shape)))
-        y = np.column_stack((Ay, np.zeros(etm.A.shape), etm.A, np.zeros(etm.A.shape)))
-        z = np.column_stack((Az, np.zeros(etm.A.shape), np.zeros(etm.A.shape), etm.A))
+    def solve(self, max_iters=10):
+        """
+        solve the stack and reweigh the observations until the chi**2 test passes (same criteria as adjust_lsq)
+        :return: number of iterations
+        """
+        dof = 3 * self.obs + 3 * self.jump_rows - self.params - self.nh * self.helmert_days.size
+        if self.constrains is not None:
+            dof += self.constrains[0].shape[0]
 
-        A = np.row_stack((x, y, z))
+        X1 = chi2.ppf(1 - 0.05 / 2, dof)
+        X2 = chi2.ppf(0.05 / 2, dof)
 
+        cst_pass = False
+        self.iterations = 0
+        self.factor = 1.
+        self.singular_days = set()
 
+        while not cst_pass and self.iterations <= max_iters:
 
-def main():
+            N, u, Linv, y = self.normal_equations()
 
-    parser = argparse.ArgumentParser(description='GNSS time series stacker')
+            if self.constrains is not None:
+                C, r = self.constrains
+                N += np.dot(C.transpose(), C)
+                u += np.dot(C.transpose(), r)
 
-    parser.add_argument('project', type=str, nargs=1, metavar='{project name}',
-                        help="Specify the project name used to process the GAMIT solutions in Parallel.GAMIT.")
-    parser.add_argument('-d', '--date_filter', nargs='+', metavar='date',
-                        help='Date range filter Can be specified in yyyy/mm/dd yyyy_doy  wwww-d format')
+            try:
+                self.x = cho_solve(cho_factor(N), u)
+            except np.linalg.LinAlgError:
+                self.x = np.linalg.lstsq(N, u, rcond=-1)[0]
 
-    args = parser.parse_args()
+            m = self.model()
 
-    cnn = dbConnection.Cnn("gnss_data.cfg")
-    Config = pyOptions.ReadOptions("gnss_data.cfg")  # type: pyOptions.ReadOptions
+            # back substitution of the daily parameters: h = N_dd^-1 (u_d - N_ds x)
+            if self.helmert_days.size:
+                i = self.hobs
+                t = np.add.reduceat(np.einsum('ic,ich,ic->ih', self.P[i], self.B[i], m[i]), self.hstart[:-1], axis=0)
+                z = y - np.einsum('dkh,dh->dk', Linv, t)
+                self.h = np.einsum('dhk,dh->dk', Linv, z)
 
-    # create the execution log
+            self.v = self.l - m
+            self.v[self.hobs] -= np.einsum('ich,ih->ic', self.B[self.hobs], self.h[self.hd[self.hobs]])
 
-    dates = [pyDate.Date(year=1980, doy=1), pyDate.Date(year=2100, doy=1)]
-    try:
-        dates = process_date(args.date_filter)
-    except ValueError as e:
-        parser.error(str(e))
+            # unit variance
+            So = np.sqrt(np.sum(self.P * np.square(self.v)) / dof)
 
-    # create folder for plots
+            x = np.power(So, 2) * dof
 
-    if not os.path.isdir(args.project[0]):
-        os.makedirs(args.project[0])
+            self.factor = self.factor * So
 
-    ########################################
-    # load polyhedrons
+            s = np.abs(self.v / self.factor)
 
-    project = dra(cnn, args.project[0], dates)
+            if x < X2 or x > X1:
+                f = np.ones(s.shape)
 
+                sw = np.power(10, LIMIT - s[s > LIMIT])
+                sw[sw < np.finfo(np.float).eps] = np.finfo(np.float).eps
+
+                f[s > LIMIT] = sw
+
+                self.P = np.square(f / self.factor)
+            else:
+                cst_pass = True
+
+            self.iterations += 1
+
+        if self.singular_days:
+            tqdm.write(' -- The transformations of %i day(s) could not be fully determined (singular normal '
+                       'equations, pseudo-inverse used): %s'
+                       % (len(self.singular_days), ' '.join([self.stack[self.helmert_days[d]].date.yyyyddd()
+                                                            for d in sorted(self.singular_days)])))
+
+        return self.iterations
+
+    def station_params(self, stnstr):
+        """
+        :return: a priori coordinate and ETM parameters (one row per X Y Z component) of a station
+        """
+        s = int(np.searchsorted(self.stations, stnstr))
+        o = self.offset[s]
+        return self.x0[s], self.x[o:o + 3 * self.k[s]].reshape((3, self.k[s]))
+
+    def apply(self, verbose=False):
+        """
+        apply the daily transformations to the polyhedrons of the stack and align the polyhedrons with too few
+        stations to the stacked ETMs
+        """
+        for j, hd in zip(self.helmert_days, range(self.helmert_days.size)):
+            poly = self.stack[j]
+            i = self.hobs[self.hstart[hd]:self.hstart[hd + 1]]
+
+            poly.helmert = -self.h[hd]
+            poly.align(helmert=poly.helmert, scale=self.scale)
+
+            poly.wrms = np.sqrt(np.sum(self.P[i] * np.square(self.v[i])) / np.sum(self.P[i]))
+            poly.stations_used = i.size
+            poly.iterations = self.iterations
+
+            if verbose:
+                tqdm.write(' -- %s (%3i) %2i it: wrms: %4.1f T %5.1f %5.1f %5.1f R (%5.1f %5.1f %5.1f)*1e-9' %
+                           (poly.date.yyyyddd(), poly.stations_used, poly.iterations, poly.wrms * 1000,
+                            poly.helmert[-3] * 1000, poly.helmert[-2] * 1000, poly.helmert[-1] * 1000,
+                            poly.helmert[-6], poly.helmert[-5], poly.helmert[-4]))
+
+        designs = dict((d['stn'], d) for d in self.designs)
+
+        for j in self.excluded_days:
+            poly = self.stack[j]
+            target = []
+
+            for vertex in poly.vertices:
+                d = designs.get(vertex['stn'])
+                if d is not None:
+                    r = np.flatnonzero(d['mjd'] == poly.date.mjd)
+                    if r.size:
+                        x0, p = self.station_params(vertex['stn'])
+                        xyz = x0 + np.dot(p, d['A'][r[0]])
+                        target.append((vertex['stn'], xyz[0], xyz[1], xyz[2], vertex['yr'], vertex['dd'],
+                                       vertex['fy']))
+
+            if target:
+                target = np.array(target, dtype=poly.vertices.dtype)
+                poly.align(pyStack.Polyhedron(target, 'neq', poly.date), scale=self.scale)
+            else:
+                tqdm.write(' -- %s could not be aligned: no station with an ETM' % poly.date.yyyyddd())
 
-if __name__ == '__main__':
-    main()
\ No newline at end of file
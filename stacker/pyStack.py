@@ -102,6 +102,76 @@ def print_residuals(NetworkCode, StationCode, residuals, lat, lon, components=('
     tqdm.write(' -- %s.%s\n' % (NetworkCode, StationCode) + r)
 
 
+class VertexStore(object):
+    """
+    Columnar store of the vertices of a stack. All the vertices are kept in one array sorted by date and station, with
+    the offsets of each date (the polyhedrons are views of this array, so changes made to the polyhedrons are seen by
+    the store) and the index of the vertices of each station, sorted by date
+    """
+    def __init__(self, vertices):
+
+        # work with integer station ids: sorting the station strings is much slower. Viewed as big endian integers, the
+        # 8 byte station codes keep the same order as the strings
+        self.stations, stn_id = np.unique(np.ascontiguousarray(vertices['stn'], dtype='S8').view('>u8'),
+                                          return_inverse=True)
+        self.stations = self.stations.view('S8')
+
+        keys = vertices['yr'].astype(np.int64) * 1000 + vertices['dd']
+
+        order = np.argsort(keys * self.stations.size + stn_id)
+
+        self.vertices = vertices[order]
+        keys = keys[order]
+        stn_id = stn_id[order]
+
+        # offsets of each date (keys are already sorted)
+        self.date_start = np.flatnonzero(np.append(True, keys[1:] != keys[:-1])[:keys.size])
+        self.date_end = np.append(self.date_start[1:], keys.size)
+        self.dates = keys[self.date_start]
+
+        # a stable sort by station keeps the vertices of each station in date order
+        self.stn_index = np.argsort(stn_id, kind='mergesort')
+
+        self.stn_end = np.cumsum(np.bincount(stn_id, minlength=self.stations.size))
+        self.stn_start = self.stn_end - np.bincount(stn_id, minlength=self.stations.size)
+
+    def get_date(self, date):
+        """
+        :param date: pyDate.Date object
+        :return: view of the vertices of date, sorted by station (empty if there is no data for date)
+        """
+        i = np.searchsorted(self.dates, date.year * 1000 + date.doy)
+
+        if i < self.dates.size and self.dates[i] == date.year * 1000 + date.doy:
+            return self.vertices[self.date_start[i]:self.date_end[i]]
+        else:
+            return self.vertices[0:0]
+
+    def get_station(self, stnstr):
+        """
+        :param stnstr: station in NetworkCode.StationCode format
+        :return: the vertices of the station, sorted by date
+        """
+        i = np.searchsorted(self.stations, stnstr)
+
+        if i < self.stations.size and self.stations[i] == stnstr:
+            return self.vertices[self.stn_index[self.stn_start[i]:self.stn_end[i]]]
+        else:
+            return self.vertices[0:0]
+
+    def get_time_series(self, stnstr):
+        """
+        :param stnstr: station in NetworkCode.StationCode format
+        :return: a numpy array with the time series [x, y, z, yr, doy, fyear]
+        """
+        v = self.get_station(stnstr)
+
+        if v.size:
+            return np.column_stack((v['x'], v['y'], v['z'], v['yr'], v['dd'], v['fy']))
+        else:
+            return np.array([])
+
+
 class Stack(list):
 
     def __init__(self, cnn, project, name, redo=False, end_date=None):
@@ -132,9 +202,9 @@ class Stack(list):
                 'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i)'
                 'ORDER BY "NetworkCode", "StationCode"' % (project, end_date.year, end_date.doy))
 
-            self.gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
-                                                                  ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
-                                                                  ('fy', 'float64')])
+            self.store = VertexStore(np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'),
+                                                                     ('y', 'float64'), ('z', 'float64'),
+                                                                     ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')]))
 
             dates = self.cnn.query_float('SELECT "Year", "DOY" FROM gamit_soln WHERE "Project" = \'%s\' '
                                          'AND ("Year", "DOY") <= (%i, %i) '
@@ -150,7 +220,7 @@ class Stack(list):
                                                  % (project, end_date.year, end_date.doy), as_dict=True)
 
             for d in tqdm(self.dates, ncols=160, desc=' >> Initializing the stack polyhedrons'):
-                self.append(Polyhedron(self.gamit_vertices, project, d))
+                self.append(Polyhedron(self.store.get_date(d), project, d, view=True))
 
         else:
             print ' >> Preserving the existing stack ' + name
@@ -186,13 +256,20 @@ class Stack(list):
                 'ORDER BY "NetworkCode", "StationCode"'
                 % (project, project, name, project, end_date.year, end_date.doy))
 
-            self.stack_vertices = np.array(stack_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
-                                                                  ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
-                                                                  ('fy', 'float64')])
+            stack_vertices = np.array(stack_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
+                                                             ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+                                                             ('fy', 'float64')])
+
+            gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
+                                                             ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+                                                             ('fy', 'float64')])
+
+            # the days that exist in the stack are taken from the stack, the rest from the GAMIT solutions
+            stack_days = np.unique(stack_vertices['yr'].astype(np.int64) * 1000 + stack_vertices['dd'])
+            gamit_days = gamit_vertices['yr'].astype(np.int64) * 1000 + gamit_vertices['dd']
 
-            self.gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
-                                                                  ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
-                                                                  ('fy', 'float64')])
+            self.store = VertexStore(np.concatenate((stack_vertices,
+                                                     gamit_vertices[np.logical_not(np.in1d(gamit_days, stack_days))])))
 
             dates = self.cnn.query_float('SELECT "Year", "DOY" FROM stacks WHERE "name" = \'%s\' '
                                          'AND ("Year", "DOY") <= (%i, %i) '
@@ -214,14 +291,12 @@ class Stack(list):
                                                     project, end_date.year, end_date.doy), as_dict=True)
 
             for d in tqdm(self.dates, ncols=160, desc=' >> Initializing the stack polyhedrons'):
-                try:
-                    # try to append the stack vertices
-                    self.append(Polyhedron(self.stack_vertices, project, d, aligned=True))
+                aligned = d.year * 1000 + d.doy in stack_days
 
-                except ValueError:
-                    # if value error is risen, then append the gamit vertices
+                if not aligned:
                     tqdm.write(' -- Appending %s from GAMIT solutions' % d.yyyyddd())
-                    self.append(Polyhedron(self.gamit_vertices, project, d, aligned=False))
+
+                self.append(Polyhedron(self.store.get_date(d), project, d, aligned=aligned, view=True))
 
     def get_station(self, NetworkCode, StationCode):
         """
@@ -231,16 +306,7 @@ class Stack(list):
         :return: a numpy array with the time series [x, y, z, yr, doy, fyear]
         """
 
-        stnstr = NetworkCode + '.' + StationCode
-
-        ts = []
-
-        for poly in self:
-            p = poly.vertices[poly.vertices['stn'] == stnstr]
-            if p.size:
-                ts.append([p['x'][0], p['y'][0], p['z'][0], p['yr'][0], p['dd'][0], p['fy'][0]])
-
-        return np.array(ts)
+        return self.store.get_time_series(NetworkCode + '.' + StationCode)
 
     def calculate_etms(self):
         """
@@ -756,19 +822,14 @@ class Stack(list):
         save the polyhedrons to the database
         :return: nothing
         """
-        for poly in tqdm(self, ncols=160, desc='Saving ' + self.name):
+        rows = [(self.project, vert['stn'].split('.')[0], vert['stn'].split('.')[1],
+                 float(vert['x']), float(vert['y']), float(vert['z']), float(vert['fy']),
+                 int(vert['yr']), int(vert['dd']), 0., 0., 0., self.name)
+                for poly in tqdm(self, ncols=160, desc='Saving ' + self.name) for vert in poly.vertices]
 
-            try:
-                self.cnn.executemany('INSERT INTO stacks ("Project", "NetworkCode", "StationCode", "X", "Y", "Z", '
-                                     '"FYear", "Year", "DOY", sigmax, sigmay, sigmaz, name) VALUES '
-                                     '(%s, %s, %s, %f, %f, %f, %f, %i, %i, 0.000, 0.000, 0.000, %s)',
-                                     [(self.project, vert['stn'].split('.')[0], vert['stn'].split('.')[1],
-                                       float(vert['x']), float(vert['y']), float(vert['z']), float(vert['fy']),
-                                       int(vert['yr']), int(vert['dd']), self.name)
-                                      for vert in poly.vertices])
-            except dbConnection.dbErrInsert:
-                # the element already exists in the database (polyhedron already aligned)
-                pass
+        # elements that already exist in the database (polyhedron already aligned) are skipped
+        self.cnn.copy_records('stacks', ('Project', 'NetworkCode', 'StationCode', 'X', 'Y', 'Z', 'FYear', 'Year', 'DOY',
+                                         'sigmax', 'sigmay', 'sigmaz', 'name'), rows)
 
     def to_json(self, json_file):
         json_dump = dict()
@@ -782,7 +843,11 @@ class Stack(list):
 
 
 class Polyhedron(object):
-    def __init__(self, vertices, project, date, rot=True, aligned=False):
+    def __init__(self, vertices, project, date, rot=True, aligned=False, view=False):
+        """
+        :param vertices: array of vertices. If view is set, vertices only contains the vertices of date sorted by
+        station (e.g. VertexStore.get_date) and the polyhedron works directly on them without making a copy
+        """
 
         self.project = project
         self.date = date
@@ -795,33 +860,57 @@ class Polyhedron(object):
         # initialize the vertices of the polyhedron
         # self.vertices = [v for v in vertices if v[5] == date.year and v[6] == date.doy]
 
-        self.vertices = vertices[np.logical_and(vertices['yr'] == date.year, vertices['dd'] == date.doy)]
-        # sort using network code station code to make sure that intersect (in align) will get the data in the correct
-        # order, otherwise the differences in X Y Z don't make sense...
-        self.vertices.sort(order='stn')
+        if view:
+            self.vertices = vertices
+        else:
+            self.vertices = vertices[np.logical_and(vertices['yr'] == date.year, vertices['dd'] == date.doy)]
+            # sort using network code station code to make sure that intersect (in align) will get the data in the
+            # correct order, otherwise the differences in X Y Z don't make sense...
+            self.vertices.sort(order='stn')
 
         if not self.vertices.size:
             raise ValueError('No polyhedron data found for ' + str(date))
 
         self.rows = self.vertices.shape[0]
 
-        # create the design matrix for this day
-        rx = np.array([np.zeros(self.rows), -self.vertices['z'], self.vertices['y']]).transpose() * 1e-9
-        ry = np.array([self.vertices['z'], np.zeros(self.rows), -self.vertices['x']]).transpose() * 1e-9
-        rz = np.array([-self.vertices['y'], self.vertices['x'], np.zeros(self.rows)]).transpose() * 1e-9
+        # the design matrix is created on first use (see design)
+        self._A = None
+
+    def design(self):
+        """
+        create the design matrix blocks of the polyhedron (rotations and translations for x, y and z) in a single array
+        :return: array of shape (3, rows, 6), or (3, rows, 3) if not estimating rotations
+        """
+        if self._A is None:
+            if self.rot:
+                x = self.vertices['x'] * 1e-9
+                y = self.vertices['y'] * 1e-9
+                z = self.vertices['z'] * 1e-9
+
+                self._A = np.zeros((3, self.rows, 6))
+                self._A[0, :, 1] = -z
+                self._A[0, :, 2] = y
+                self._A[1, :, 0] = z
+                self._A[1, :, 2] = -x
+                self._A[2, :, 0] = -y
+                self._A[2, :, 1] = x
+                self._A[:, :, 3:] = np.eye(3)[:, np.newaxis, :]
+            else:
+                self._A = np.repeat(np.eye(3)[:, np.newaxis, :], self.rows, axis=1)
+
+        return self._A
 
-        tx = np.array([np.ones(self.rows), np.zeros(self.rows), np.zeros(self.rows)]).transpose()
-        ty = np.array([np.zeros(self.rows), np.ones(self.rows), np.zeros(self.rows)]).transpose()
-        tz = np.array([np.zeros(self.rows), np.zeros(self.rows), np.ones(self.rows)]).transpose()
+    @property
+    def Ax(self):
+        return self.design()[0]
 
-        if rot:
-            self.Ax = np.concatenate((rx, tx), axis=1)
-            self.Ay = np.concatenate((ry, ty), axis=1)
-            self.Az = np.concatenate((rz, tz), axis=1)
-        else:
-            self.Ax = tx
-            self.Ay = ty
-            self.Az = tz
+    @property
+    def Ay(self):
+        return self.design()[1]
+
+    @property
+    def Az(self):
+        return self.design()[2]
 
     def ax(self, scale=False):
         """